@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_api.py: micro-benchmark of the stats reply parsing
+# --------------------------------------------------------------------------
+#
+# Compares the old string concatenation + replace() + json.loads path of
+# l3plus_autotune.py with cgminer_api on stats replies of all firmwares,
+# both for parsing only and including the receive over a local socket.
+#
+# Usage: ./bench_api.py [iterations]
+
+import socket, json, sys, time, threading
+
+import cgminer_api
+
+STATS_HEAD = '{"STATUS":[{"STATUS":"S","When":1526135868,"Code":70,"Msg":"CGMiner stats","Description":"cgminer 4.9.0"}],' \
+  '"STATS":[{"CGMiner":"4.9.0","Miner":"1.0.1.3","CompileTime":"Fri Jan 12 15:06:21 CST 2018","Type":"%s"}'
+STATS_BODY = '{"STATS":0,"ID":"L30","Elapsed":282139,"Calls":0,"Wait":0.000000,"Max":0.000000,"Min":99999999.000000,' \
+  '"GHS 5s":"523.897","GHS av":520.37,"miner_count":4,"frequency":"400","fan_num":2,"fan1":5040,"fan2":5160,' \
+  '"temp_num":4,"temp1":55,"temp2":56,"temp3":56,"temp4":54,"temp2_1":61,"temp2_2":63,"temp2_3":63,"temp2_4":60,' \
+  '"temp31":0,"temp32":0,"temp33":0,"temp34":0,"temp4_1":0,"temp4_2":0,"temp4_3":0,"temp4_4":0,"temp_max":56,' \
+  '"Device Hardware%":0.0000,"no_matching_work":10358,"chain_acn1":72,"chain_acn2":72,"chain_acn3":72,"chain_acn4":72,' \
+  '"chain_acs1":" oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo",' \
+  '"chain_acs2":" oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo",' \
+  '"chain_acs3":" oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo",' \
+  '"chain_acs4":" oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo",' \
+  '"chain_hw1":3,"chain_hw2":10167,"chain_hw3":186,"chain_hw4":2,' \
+  '"chain_rate1":"131.20","chain_rate2":"130.93","chain_rate3":"130.97","chain_rate4":"130.80"}],' \
+  '"id":1}\x00'
+
+FIRMWARE_TYPES = [('stock', 'Antminer L3+'), ('l3++', 'Antminer L3++'), ('blissz', 'Antminer L3+ Blissz v1.02')]
+
+
+def sample_reply(fw_type):
+  """A stats reply as sent by the given firmware, including its JSON quirk"""
+  return STATS_HEAD %fw_type + STATS_BODY
+
+
+def legacy_parse(json_resp):
+  """The parsing part of the original get_minerstats()"""
+  if json_resp.find('Blissz v1.02"}') > -1:
+    json_resp = json_resp.replace('\x00','')
+    json_resp = json_resp.replace('Blissz v1.02"}', 'Blissz v1.02"},').strip()
+  elif json_resp.find('Antminer L3++') > -1:
+    json_resp = json_resp.replace('\x00','')
+    json_resp = json_resp.replace('Antminer L3++"}', 'Antminer L3++"},').strip()
+  else:
+    json_resp = json_resp.replace('\x00','')
+    json_resp = json_resp.replace("L3+\"}", "L3+\"},").strip()
+  resp = json.loads(json_resp)
+  miner_stats = {'err': [], 'chainrate': [], 'temp_pcb': [], 'temp_chip': [], 'asic_status': []}
+  for i in range (1,5):
+    miner_stats['err'].append( resp['STATS'][1]['chain_hw'+str(i)] )
+    miner_stats['chainrate'].append( resp['STATS'][1]['chain_rate'+str(i)] )
+    miner_stats['temp_pcb'].append( resp['STATS'][1]['temp'+str(i)] )
+    miner_stats['temp_chip'].append( resp['STATS'][1]['temp2_'+str(i)] )
+    miner_stats['asic_status'].append( resp['STATS'][1]['chain_acs'+str(i)] )
+  miner_stats['speed'] = [resp['STATS'][1]['GHS av'], resp['STATS'][1]['GHS 5s']]
+  miner_stats['uptime'] = resp['STATS'][1]['Elapsed']
+  miner_stats['frequency'] = resp['STATS'][1]['frequency']
+  miner_stats['device_error'] = resp['STATS'][1]['Device Hardware%']
+  return miner_stats
+
+
+def legacy_fetch(ip, port):
+  """The receive part of the original get_minerstats()"""
+  json_resp = ""
+  s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+  s.connect((ip, port))
+  s.send(json.dumps({"command":'stats'}))
+  while True:
+    data = s.recv(1024)
+    if not data:
+      break
+    json_resp += data
+  s.close()
+  return legacy_parse(json_resp)
+
+
+def new_parse(reply):
+  fw = cgminer_api.detect_firmware(reply)
+  return cgminer_api.MinerStats(fw.name, fw.parse(reply), fw.chains)
+
+
+def serve(reply):
+  """Answer every connection on a local port with reply, returns the port"""
+  srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  srv.bind(('127.0.0.1', 0))
+  srv.listen(64)
+  def loop():
+    while True:
+      c, addr = srv.accept()
+      c.recv(1024)
+      c.sendall(reply)
+      c.close()
+  t = threading.Thread(target=loop)
+  t.daemon = True
+  t.start()
+  return srv.getsockname()[1]
+
+
+def timed(func, n):
+  start = time.time()
+  for i in xrange(n):
+    func()
+  return (time.time() - start) / n * 1e6
+
+
+if __name__ == '__main__':
+  n = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+  print "| firmware |  parse old  |  parse new  | speedup | fetch old  | fetch new  |"
+  for name, fw_type in FIRMWARE_TYPES:
+    reply = sample_reply(fw_type)
+    # both paths must agree before we compare their speed
+    old = legacy_parse(reply)
+    new = new_parse(reply).as_dict()
+    assert old['err'] == new['err'] and old['temp_chip'] == new['temp_chip'] and \
+      old['asic_status'] == new['asic_status'] and old['frequency'] == new['frequency'], name
+    assert cgminer_api.detect_firmware(reply).name == name, name
+    t_old = timed(lambda: legacy_parse(reply), n)
+    t_new = timed(lambda: new_parse(reply), n)
+    port = serve(reply)
+    client = cgminer_api.CgminerClient()
+    f_old = timed(lambda: legacy_fetch('127.0.0.1', port), n / 10)
+    f_new = timed(lambda: client.stats('127.0.0.1', port), n / 10)
+    print "| %-8s | %8.1f us | %8.1f us | %6.1fx | %7.1f us | %7.1f us |" %(name, t_old, t_new, t_old / t_new, f_old, f_new)
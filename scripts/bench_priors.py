@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_priors.py: tuning with and without the priors of finished siblings
+# --------------------------------------------------------------------------
+#
+# Tunes a fleet of simulated miners one after the other on a simulated
+# clock, once from the default voltage and once with a PriorStore that
+# collects the final voltages of the miners tuned before. Two fleets are
+# compared: boards of one batch whose sweet spots are in a narrow band, and
+# boards with sweet spots all over the range. Per run the time to converge,
+# work lost to hw errors while tuning, chains left over the error limit and
+# chains rolled back from their prior are printed.
+#
+# Usage: ./bench_priors.py [-n <miners>] [-s <seed>]
+
+import sys, random, shutil, getopt, tempfile
+
+import l3plus_autotune
+from priors import PriorStore, priors_path
+from replay import ReplayMiner, tune, percentile
+from simminer import ChainModel, SimClock
+
+# sweet spot code of the boards of the narrow fleet and its spread
+BATCH_SWEET = 0xc4
+BATCH_SPREAD = 6
+
+
+def batch_chains(rnd):
+  return [ChainModel(max(0xa0, min(0xe8, int(rnd.gauss(BATCH_SWEET, BATCH_SPREAD))))) for c in range(4)]
+
+
+def mixed_chains(rnd):
+  return [ChainModel(rnd.randint(0xa0, 0xe8)) for c in range(4)]
+
+
+def bench(count, chains, seed, priors):
+  """Tune count miners in turn, returns one (hours, lost, over, rollbacks) per miner"""
+  rnd = random.Random(seed)
+  results = []
+  for i in range(count):
+    clock = SimClock()
+    miner = ReplayMiner("sim-%i" %i, chains(rnd), seed=rnd.randint(0, 1 << 30), clock=clock.time)
+    took, tuner, finished = tune(miner, clock, False, l3plus_autotune.DEFAULT_SEARCH, priors=priors)
+    over = len([c for c in range(4) if miner.chains[c].rate(miner.voltage[c], miner.frequency, miner.temp(c)) >
+                l3plus_autotune.MAX_ERR_RATE])
+    results.append((took / 3600.0, miner.lost(), over, tuner.rollbacks))
+  return results
+
+
+def main():
+  opts, args = getopt.getopt(sys.argv[1:], "n:s:")
+  count, seed = 100, 1
+  for opt, arg in opts:
+    if opt == '-n':
+      count = int(arg)
+    elif opt == '-s':
+      seed = int(arg)
+  print "%i simulated miners tuned one after the other" %count
+  print "| fleet | priors | median h | p90 h | lost % | over limit | rollbacks |"
+  for name, chains in (("batch", batch_chains), ("mixed", mixed_chains)):
+    for label in ("no", "yes"):
+      directory = tempfile.mkdtemp()
+      try:
+        priors = label == "yes" and PriorStore(priors_path(directory)) or None
+        results = bench(count, chains, seed, priors)
+      finally:
+        shutil.rmtree(directory)
+      hours = [r[0] for r in results]
+      print "| %-5s | %-6s | %8.2f | %5.2f | %6.2f | %10i | %9i |" %(name, label, percentile(hours, 0.5),
+        percentile(hours, 0.9), 100.0 * sum([r[1] for r in results]) / count, sum([r[2] for r in results]),
+        sum([r[3] for r in results]))
+
+
+if __name__ == '__main__':
+  main()
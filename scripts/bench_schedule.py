@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_schedule.py: time to converge of the schedules and search strategies
+# --------------------------------------------------------------------------
+#
+# Tunes simminer miners on a simulated clock, so hours of tuning take a few
+# seconds. Stats are taken from the miner model directly instead of over
+# TCP, see bench_sim.py for the end to end benchmark. Reports how long
+# tuning took, how many samples and decision rounds (cycles changing at
+# least one chain) it needed and how the final voltages compare to the
+# error limit. replay.py runs the same on recorded miners, with any tuner
+# parameters and on several processes.
+#
+# Usage: ./bench_schedule.py [miners] [seed]
+
+import sys, random
+
+import l3plus_autotune
+import replay
+from replay import ReplayMiner, percentile
+from simminer import ChainModel, SimClock
+
+
+def tune(sweet, seed, fixed, search):
+  """Tune one simulated miner, returns (seconds, tuner, finished)"""
+  clock = SimClock()
+  miner = ReplayMiner('sim', [ChainModel(s) for s in sweet], seed=seed, clock=clock.time)
+  return replay.tune(miner, clock, fixed, search)
+
+
+def main():
+  miners = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+  seed = len(sys.argv) > 2 and int(sys.argv[2]) or 1
+  rnd = random.Random(seed)
+  fleet = [([rnd.randint(0xa0, 0xe8) for c in range(4)], rnd.randint(0, 1 << 30)) for m in range(miners)]
+  limit = l3plus_autotune.MAX_ERR_RATE
+  print "%i simulated miners, error limit %.2f/min" %(miners, limit)
+  print "| schedule | search | converged | median h | p90 h | samples | rounds | chains over limit | codes below limit |"
+  for fixed, search in ((True, 'step'), (False, 'step'), (False, 'bisect'), (False, 'bandit')):
+    times, samples, rounds, over, margin, done = [], [], [], 0, [], 0
+    for sweet, s in fleet:
+      took, tuner, finished = tune(sweet, s, fixed, search)
+      miner = tuner.miner
+      times.append(took / 3600.0)
+      samples.append(tuner.samples)
+      rounds.append(tuner.rounds)
+      done += finished
+      for c, chain in enumerate(miner.chains):
+        code = miner.voltage[c]
+        if chain.rate(code, miner.frequency, miner.temp(c)) > limit:
+          over += 1
+        # how many codes below the highest voltage code that keeps the limit
+        margin.append(chain.best(miner.frequency, limit, miner.ambient) - code)
+    print "| %-8s | %-6s | %4i/%-4i | %8.2f | %5.2f | %7i | %6.1f | %17i | %17.1f |" %(fixed and 'fixed' or 'adaptive',
+      search, done, miners, percentile(times, 0.5), percentile(times, 0.9), sum(samples) / len(samples),
+      float(sum(rounds)) / len(rounds), over, float(sum(margin)) / len(margin))
+
+if __name__ == '__main__':
+  main()
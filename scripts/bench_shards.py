@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_shards.py: tuning cycle throughput of a fleet spread over processes
+# --------------------------------------------------------------------------
+#
+# Runs a fleet of simminer miners on a ShardCoordinator with 1, 2, 4, ..
+# processes and counts the tuning cycles reported back to it. Every cycle
+# parses a full cgminer stats reply, pushes the history and runs the
+# decisions like against a real miner, and the tuners ask for their next
+# cycle right away instead of sleeping, so the shards are kept busy and the
+# cycles per second show how far the fleet is from being CPU bound.
+# Voltages are set through simminer.SimSSH in each shard process.
+#
+# With -k one shard process is killed halfway through each run, its miners
+# have to be moved to the others and the run keeps going.
+#
+# Usage: ./bench_shards.py [-n <miners>] [-P 1,2,4] [-t <seconds>] [-w <workers>] [-k]
+
+import sys, os, time, signal, random, getopt
+
+import l3plus_autotune
+from cgminer_api import MinerStats, identify_firmware
+from simminer import SimSSH, stats_reply, loopback_ips, random_miner
+
+PROCESSES = (1, 2, 4)
+# seconds the first cycles of a shard are spread over, REPEAT is for real miners
+STAGGER = 1
+
+
+class BenchShardTuner(l3plus_autotune.MinerTuner):
+  """MinerTuner of a simulated miner that never sleeps and keeps quiet"""
+
+  def __init__(self, miner, metrics):
+    l3plus_autotune.MinerTuner.__init__(self, miner.ip, ssh=SimSSH([miner]), metrics=metrics, export=None)
+    self.miner = miner
+
+  def log(self, msg):
+    pass
+
+  def report_stats(self):
+    pass
+
+  def get_minerstats(self):
+    data = stats_reply(self.miner)
+    fw = identify_firmware(data)
+    return MinerStats(fw.name, fw.parse(data), fw.chains).as_dict()
+
+  def step(self):
+    if l3plus_autotune.MinerTuner.step(self) is None:
+      return None
+    return 0
+
+
+def make_tuner(host, ssh, metrics):
+  # the same miner whichever shard builds it
+  return BenchShardTuner(random_miner(host, random.Random(host)), metrics)
+
+
+def bench(hosts, processes, seconds, workers, kill):
+  coordinator = l3plus_autotune.ShardCoordinator(hosts, make_tuner, processes, workers, stagger=STAGGER)
+  start = time.time()
+  try:
+    if kill:
+      coordinator.run(start + seconds / 2.0)
+      victim = coordinator.shards.keys()[0]
+      os.kill(coordinator.shards[victim][0].pid, signal.SIGKILL)
+    coordinator.run(start + seconds)
+  finally:
+    coordinator.terminate()
+  return coordinator.cycles / (time.time() - start), coordinator
+
+
+def main():
+  opts, args = getopt.getopt(sys.argv[1:], "n:P:t:w:k")
+  miners, counts, seconds, workers, kill = 200, PROCESSES, 10.0, 4, False
+  for opt, arg in opts:
+    if opt == '-n':
+      miners = int(arg)
+    elif opt == '-P':
+      counts = [int(p) for p in arg.split(',')]
+    elif opt == '-t':
+      seconds = float(arg)
+    elif opt == '-w':
+      workers = int(arg)
+    elif opt == '-k':
+      kill = True
+  hosts = loopback_ips(miners)
+  print "%i simulated miners, %.0fs per run, %i workers per process, %i cpus" %(miners, seconds, workers,
+    l3plus_autotune.multiprocessing.cpu_count())
+  print "| processes | cycles/s | speedup | died | moved | unfinished |"
+  base = None
+  dead = []
+  for processes in counts:
+    rate, coordinator = bench(hosts, processes, seconds, workers, kill)
+    # speedups are relative to the first run that got any cycles done
+    if base is None and rate > 0:
+      base = rate
+    speedup = rate > 0 and "%7.2f" %(rate / base) or "      -"
+    print "| %9i | %8.0f | %s | %4i | %5i | %10i |" %(processes, rate, speedup, len(coordinator.died),
+      len(coordinator.moved), len(hosts) - len(coordinator.done))
+    dead.extend([(processes, shard, code) for shard, code in coordinator.died])
+  for processes, shard, code in dead:
+    print "run with %i processes: shard %i died with exit code %s" %(processes, shard, code)
+  if base is None:
+    print "no run got any tuning cycles done, see the output of the shard processes above"
+
+
+if __name__ == '__main__':
+  main()
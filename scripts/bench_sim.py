@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_sim.py: end to end tuning benchmark against simulated miners
+# --------------------------------------------------------------------------
+#
+# Starts a cgminer API server for a fleet of simminer miners on loopback
+# addresses and tunes all of them with the unmodified MinerTuner, stats go
+# over TCP and sv commands to simminer.SimSSH. Time runs on a simulated
+# clock driven by an event loop, so a fleet is tuned in minutes instead of
+# hours, while each tuning cycle is timed on the wall clock.
+#
+# Reports per fleet size: miners converged, time to converge, work lost to
+# hw errors while tuning and the wall clock latency of a tuning cycle.
+#
+# Usage: ./bench_sim.py [-n 1,100,1000] [-t <max hours>] [-s <seed>] [--fixed]
+
+import sys, time, heapq, random, getopt
+
+import l3plus_autotune
+from replay import percentile
+from simminer import CgminerServer, SimSSH, SimClock, loopback_ips, random_miner
+
+# simulated hours after which a miner counts as not converged
+MAX_HOURS = 24
+FLEET_SIZES = (1, 100, 1000)
+
+
+class BenchTuner(l3plus_autotune.MinerTuner):
+  """MinerTuner without console output and report files"""
+
+  def log(self, msg):
+    pass
+
+  def report_stats(self):
+    pass
+
+
+def run_fleet(size, seed, max_hours, fixed):
+  """Tune size simulated miners, returns a dict of results"""
+  clock = SimClock()
+  rnd = random.Random(seed)
+  miners = [random_miner(ip, rnd, clock.time) for ip in loopback_ips(size)]
+  server = CgminerServer(miners, port=0)
+  server.start()
+  ssh = SimSSH(miners)
+  try:
+    queue = []
+    for seq, m in enumerate(miners):
+      tuner = BenchTuner(m.ip, ssh=ssh, tag=True, fixed=fixed, export=None, clock=clock, api_port=server.port)
+      heapq.heappush(queue, (clock.now + rnd.uniform(0, l3plus_autotune.REPEAT), seq, tuner, m))
+    start = clock.now
+    latency, converged, lost = [], [], []
+    while queue:
+      due, seq, tuner, miner = heapq.heappop(queue)
+      clock.now = due
+      t = time.time()
+      delay = tuner.step()
+      latency.append(time.time() - t)
+      if delay is None or clock.now - start > max_hours * 3600:
+        if delay is None:
+          converged.append((clock.now - tuner.start_time) / 3600)
+        lost.append(miner.lost())
+        continue
+      heapq.heappush(queue, (clock.now + delay, seq, tuner, miner))
+  finally:
+    server.stop()
+  return {'size': size, 'converged': converged, 'lost': lost, 'latency': latency}
+
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "n:t:s:", ["fixed"])
+  except getopt.GetoptError, e:
+    print e
+    print "Usage: %s [-n 1,100,1000] [-t <max hours>] [-s <seed>] [--fixed]" %sys.argv[0]
+    sys.exit(1)
+  sizes, max_hours, seed, fixed = FLEET_SIZES, MAX_HOURS, 1, False
+  for opt, arg in opts:
+    if opt == "-n":
+      sizes = [int(n) for n in arg.split(',')]
+    elif opt == "-t":
+      max_hours = float(arg)
+    elif opt == "-s":
+      seed = int(arg)
+    elif opt == "--fixed":
+      fixed = True
+  print "%s schedule, max %.1f simulated hours" %(fixed and "fixed" or "adaptive", max_hours)
+  print "| miners | converged | median h | p90 h | work lost | cycles | cycle ms p50 | p99  | wall s |"
+  for size in sizes:
+    t = time.time()
+    r = run_fleet(size, seed, max_hours, fixed)
+    wall = time.time() - t
+    lat = [l * 1000 for l in r['latency']]
+    print "| %6i | %4i/%-4i | %8.2f | %5.2f | %8.3f%% | %6i | %12.2f | %4.1f | %6.1f |" %(size,
+      len(r['converged']), size, percentile(r['converged'], 0.5), percentile(r['converged'], 0.9),
+      100 * sum(r['lost']) / len(r['lost']), len(lat), percentile(lat, 0.5), percentile(lat, 0.99), wall)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# bench_watchdog.py: how fast chains that go bad while tuning get more voltage
+# --------------------------------------------------------------------------
+#
+# Tunes simulated miners on a simulated clock and, at a random time while
+# tuning, moves the sweet spot of one chain to a number of codes below the
+# voltage it is at, like a board that heats up or starts to fail: 8 codes
+# make it 0.5 errors/min, 12 codes 2.6, 16 codes 13 and 20 codes 66. Measured is the time until that
+# chain gets more voltage and the hw errors it makes until then, once with
+# tuning cycles only and once with the watchdog polling the miner every
+# few seconds between them. Tuning cycles and polls are run in one thread
+# in the order they are due, polls go through watchdog.react() and
+# MinerTuner.protect() like in the watchdog threads.
+#
+# Usage: ./bench_watchdog.py [-n <miners>] [-c 8,12,16,20] [-i <seconds>] [-s <seed>]
+
+import sys, random, getopt
+
+import l3plus_autotune
+from replay import ReplayMiner, ReplayTuner, percentile
+from simminer import ChainModel, SimClock
+from watchdog import FaultDetector, react, WATCHDOG_INTERVAL
+
+# codes of undervolt past its sweet spot the faulty chain is left at
+FAULT_CODES = (8, 12, 16, 20)
+# seconds after the start of tuning the fault happens in
+FAULT_AFTER = (600, 3600)
+# seconds after the fault a chain counts as never reacted to
+MAX_REACTION = 7200
+
+
+def bench_miner(spec, interval, codes):
+  """Tune a miner made of spec = (sweet spots, seed, fault time, chain) and
+  break it, returns (seconds, errors) until the chain got more voltage or
+  None if tuning was over before the fault"""
+  sweet, seed, fault_at, chain = spec
+  clock = SimClock()
+  miner = ReplayMiner("sim", [ChainModel(s) for s in sweet], seed=seed, clock=clock.time)
+  tuner = ReplayTuner(miner, False, l3plus_autotune.DEFAULT_SEARCH, clock=clock)
+  detector = FaultDetector()
+  start = clock.now
+  next_cycle = start
+  next_poll = interval and start + interval or None
+  fault = start + fault_at
+  broken = None
+  while True:
+    due = min([t for t in (next_cycle, next_poll, broken is None and fault or None) if t is not None])
+    clock.now = due
+    if broken is None and due == fault:
+      # errors up to now at the old sweet spot
+      miner.lost()
+      miner.chains[chain].sweet = miner.voltage[chain] - codes
+      miner.cached = None
+      broken = (due, miner.voltage[chain], miner.errors[chain])
+      continue
+    if due == next_cycle:
+      delay = tuner.step()
+      if delay is None and broken is None:
+        return None
+      next_cycle = delay is not None and due + delay or None
+    else:
+      react(tuner, detector, miner.sample(), due)
+      next_poll = due + interval
+    if broken is not None:
+      if next_cycle is None or due - broken[0] > MAX_REACTION:
+        # tuning is over or gave up on the chain
+        clock.now = broken[0] + MAX_REACTION
+      elif miner.voltage[chain] >= broken[1]:
+        continue
+      miner.lost()
+      return clock.now - broken[0], miner.errors[chain] - broken[2]
+
+
+def main():
+  opts, args = getopt.getopt(sys.argv[1:], "n:c:i:s:")
+  count, faults, interval, seed = 100, FAULT_CODES, WATCHDOG_INTERVAL, 1
+  for opt, arg in opts:
+    if opt == '-n':
+      count = int(arg)
+    elif opt == '-c':
+      faults = [int(c) for c in arg.split(',')]
+    elif opt == '-i':
+      interval = float(arg)
+    elif opt == '-s':
+      seed = int(arg)
+  rnd = random.Random(seed)
+  specs = [([rnd.randint(0xa0, 0xe8) for c in range(4)], rnd.randint(0, 1 << 30), rnd.uniform(*FAULT_AFTER),
+            rnd.randrange(4)) for i in range(count)]
+  print "%i simulated miners, one chain of each ends up codes past its sweet spot while tuning" %count
+  print "| codes | watchdog | faults | median s | p90 s | errors median | errors p90 | never |"
+  for codes in faults:
+    for label, poll in (("no", None), ("%gs" %interval, interval)):
+      results = [r for r in [bench_miner(s, poll, codes) for s in specs] if r is not None]
+      seconds = [r[0] for r in results]
+      errors = [r[1] for r in results]
+      print "| %5i | %-8s | %6i | %8.0f | %5.0f | %13i | %10i | %5i |" %(codes, label, len(results),
+        percentile(seconds, 0.5), percentile(seconds, 0.9), percentile(errors, 0.5), percentile(errors, 0.9),
+        len([s for s in seconds if s >= MAX_REACTION]))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# cgminer_api.py: lean client for the cgminer 'stats' API of L3+/L3++ miners
+# --------------------------------------------------------------------------
+#
+# The stats reply of the L3 firmwares is not valid JSON (the first STATS
+# object is not followed by a comma), so instead of patching the text with
+# replace() and decoding all of it we skip to the second STATS object that
+# holds the chain data and decode only that one. Replies that are broken
+# beyond that are parsed as flat "key":value pairs, unless they were cut off,
+# a cut off number would be taken as a smaller one.
+
+import socket, json, re
+
+_decoder = json.JSONDecoder()
+
+API_PORT = 4028
+# initial receive buffer size, grown on demand, a stats reply is ~3-4kB
+RECV_BUFSIZE = 16384
+# firmware markers are looked for in this many leading bytes of a reply
+DETECT_LEN = 1024
+# flat "key":value pairs, nesting and missing commas do not matter
+PAIR_RE = re.compile(r'"([^"]+)":("[^"]*"|[^,}"]+)')
+
+
+class ApiError(Exception):
+  """Miner did not answer or the reply could not be parsed"""
+  pass
+
+
+class FirmwareVariant(object):
+  """A miner firmware, recognized by a marker string in its stats reply.
+
+  Subclasses can override parse() for firmwares that name fields differently,
+  fixup() is only used when the full JSON document is needed."""
+
+  def __init__(self, name, marker, chains=4):
+    self.name = name
+    self.marker = marker
+    self.chains = chains
+
+  def matches(self, data):
+    return data.find(self.marker) > -1
+
+  def parse(self, data):
+    """Decode the chain data object of the raw reply, returns a dict"""
+    try:
+      start = data.index('"STATS":[')
+      # the first STATS object is flat, the chain data follows its closing brace
+      start = data.index('{', data.index('}', start))
+      return _decoder.raw_decode(data, start)[0]
+    except ValueError:
+      if not data.rstrip('\x00 \t\r\n').endswith('}'):
+        raise ApiError("Truncated stats reply")
+      return self.parse_pairs(data)
+
+  def parse_pairs(self, data):
+    """Tolerant fallback, later objects win so the chain data is used"""
+    values = {}
+    for k, v in PAIR_RE.findall(data):
+      try:
+        values[k] = json.loads(v)
+      except ValueError:
+        values[k] = v
+    return values
+
+  def fixup(self, text):
+    """Turn the raw reply into valid JSON"""
+    text = text.replace('\x00', '')
+    return text.replace(self.marker + '"}', self.marker + '"},').strip()
+
+
+# checked in order, the stock firmware marker also matches L3++ replies
+FIRMWARES = [
+  FirmwareVariant('blissz', 'Blissz v1.02'),
+  FirmwareVariant('l3++', 'Antminer L3++'),
+  FirmwareVariant('stock', 'L3+'),
+]
+
+
+def register_firmware(variant, first=True):
+  """Add support for another firmware variant"""
+  if first:
+    FIRMWARES.insert(0, variant)
+  else:
+    FIRMWARES.append(variant)
+
+
+def identify_firmware(data):
+  """Return the FirmwareVariant a reply came from, None if no marker matches"""
+  # the markers are part of the first STATS object
+  data = data[:DETECT_LEN]
+  for fw in FIRMWARES:
+    if fw.matches(data):
+      return fw
+  return None
+
+
+def detect_firmware(data):
+  """Return the FirmwareVariant a reply came from, the stock one if unsure"""
+  return identify_firmware(data) or FIRMWARES[-1]
+
+
+def _ints(values):
+  try:
+    return [int(v) for v in values]
+  except ValueError:
+    return [int(float(v)) for v in values]
+
+
+def _keys(chains):
+  """Field names of the per chain values, cached per chain count"""
+  if not _KEYS.has_key(chains):
+    r = range(1, chains+1)
+    _KEYS[chains] = tuple([tuple([f %i for i in r]) for f in ('chain_hw%i', 'chain_rate%i', 'temp%i', 'temp2_%i', 'chain_acs%i')])
+  return _KEYS[chains]
+_KEYS = {}
+
+
+class MinerStats(object):
+  """The part of a stats reply the tuner cares about"""
+  __slots__ = ['firmware', 'err', 'chainrate', 'temp_pcb', 'temp_chip', 'asic_status',
+               'speed', 'uptime', 'frequency', 'device_error']
+
+  def __init__(self, firmware, values, chains=4):
+    hw, rate, temp, temp2, acs = _keys(chains)
+    try:
+      self.firmware = firmware
+      self.err = _ints([values[k] for k in hw])
+      self.chainrate = [float(values[k]) for k in rate]
+      self.temp_pcb = _ints([values[k] for k in temp])
+      self.temp_chip = _ints([values[k] for k in temp2])
+      self.asic_status = [values[k] for k in acs]
+      self.speed = [float(values['GHS av']), float(values['GHS 5s'])]
+      self.uptime = _ints([values['Elapsed']])[0]
+      self.frequency = values['frequency']
+      self.device_error = float(values['Device Hardware%'])
+    except KeyError, e:
+      raise ApiError("Field %s missing in stats reply" %e)
+    except ValueError, e:
+      raise ApiError("Invalid value in stats reply: %s" %e)
+
+  def as_dict(self):
+    """Stats in the dict format used by the tuner history"""
+    return {'err': self.err, 'chainrate': self.chainrate, 'temp_pcb': self.temp_pcb,
+            'temp_chip': self.temp_chip, 'asic_status': self.asic_status, 'speed': self.speed,
+            'uptime': self.uptime, 'frequency': self.frequency, 'device_error': self.device_error,
+            'firmware': self.firmware}
+
+
+class CgminerClient(object):
+  """cgminer API client with a reusable receive buffer, not thread safe"""
+
+  def __init__(self, bufsize=RECV_BUFSIZE, timeout=10):
+    self.buf = bytearray(bufsize)
+    self.timeout = timeout
+
+  def request(self, ip, port=API_PORT, command='stats'):
+    """Send command, returns the raw reply"""
+    try:
+      s = socket.create_connection((ip, port), self.timeout)
+      try:
+        s.sendall(json.dumps({"command": command}))
+        n = 0
+        view = memoryview(self.buf)
+        while True:
+          if n == len(self.buf):
+            # a bytearray cannot be resized while a memoryview of it exists
+            del view
+            self.buf.extend(bytearray(len(self.buf)))
+            view = memoryview(self.buf)
+          got = s.recv_into(view[n:])
+          if not got:
+            break
+          n += got
+      finally:
+        s.close()
+    except socket.error, e:
+      raise ApiError("Failed to connect to host:\n%s" %e)
+    return view[:n].tobytes()
+
+  def stats(self, ip, port=API_PORT):
+    """Fetch and parse stats, returns a MinerStats record"""
+    data = self.request(ip, port)
+    fw = identify_firmware(data)
+    if fw is None:
+      raise ApiError("Unknown firmware, no L3+ stats reply")
+    return MinerStats(fw.name, fw.parse(data), fw.chains)
+
+  def stats_json(self, ip, port=API_PORT):
+    """Fetch stats and return the full reply as decoded JSON"""
+    data = self.request(ip, port)
+    fw = detect_firmware(data)
+    try:
+      return json.loads(fw.fixup(data))
+    except ValueError, e:
+      raise ApiError("Failed to decode json reply:\n%s\n%s" %(e, data))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# deploy.py: checksum based installation of the sv helper on miners
+# --------------------------------------------------------------------------
+#
+# The sv binary is kept as a hex dump (sv.txt) next to the scripts. It is
+# decoded locally and checked against its known md5 once, miners are then
+# only sent the binary if the md5sum of their copy differs. The binary is
+# written to a temporary name over sftp, or through cat on an exec channel
+# where the ssh server has no sftp subsystem (dropbear), verified there and
+# renamed over the old one, so a miner never runs a half written sv.
+#
+# deploy_fleet() does this for many miners on a bounded pool of threads and
+# returns one DeployResult per miner.
+
+import os, socket, binascii, hashlib, threading, time, Queue
+
+from sshpool import paramiko
+
+SV_TXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sv.txt')
+# miners deployed to in parallel
+DEPLOY_WORKERS = 16
+
+# outcomes of a deployment
+CURRENT = 'current'
+INSTALLED = 'installed'
+FAILED = 'failed'
+
+
+class DeployError(Exception):
+  """The binary could not be installed on a miner"""
+  pass
+
+
+def load_binary(path, md5):
+  """Decode the hex dump at path, returns the binary if its md5 is md5"""
+  fh = open(path, 'r')
+  try:
+    data = binascii.unhexlify(''.join(fh.read().split()))
+  finally:
+    fh.close()
+  if hashlib.md5(data).hexdigest() != md5:
+    raise DeployError("%s does not decode to a binary with md5 %s" %(path, md5))
+  return data
+
+
+class DeployResult(object):
+  """Outcome of deploying to one miner"""
+
+  def __init__(self, host, outcome, detail, seconds):
+    self.host = host
+    self.outcome = outcome
+    self.detail = detail
+    self.seconds = seconds
+
+
+class Deployer(object):
+  """Installs data as path on miners reached over an SSHPool"""
+
+  def __init__(self, ssh, password, data, path, mode=0750):
+    self.ssh = ssh
+    self.password = password
+    self.data = data
+    self.md5 = hashlib.md5(data).hexdigest()
+    self.path = path
+    self.mode = mode
+
+  def remote_md5(self, host, path=None):
+    """md5 of path on host, None if it does not exist"""
+    res, err = self.ssh.run(host, self.password, "md5sum %s" %(path or self.path))
+    if len(err) > 0 or not res.strip():
+      return None
+    return res.split()[0]
+
+  def upload(self, host, path):
+    try:
+      self.ssh.put(host, self.password, self.data, path, self.mode)
+      return
+    except paramiko.SSHException:
+      # no sftp subsystem, stream it through an exec channel instead
+      pass
+    res, err = self.ssh.run(host, self.password, "cat > %s && chmod %o %s" %(path, self.mode, path), self.data)
+    if len(err) > 0:
+      raise DeployError("writing %s failed: %s" %(path, err.strip()))
+
+  def deploy(self, host):
+    """Make sure host has the binary, returns CURRENT or INSTALLED, raises
+    DeployError if it could not be installed"""
+    if self.remote_md5(host) == self.md5:
+      return CURRENT
+    tmp = self.path + '.new'
+    self.upload(host, tmp)
+    md5 = self.remote_md5(host, tmp)
+    if md5 != self.md5:
+      self.ssh.run(host, self.password, "rm -f %s" %tmp)
+      raise DeployError("md5 of the uploaded binary is %s instead of %s" %(md5, self.md5))
+    res, err = self.ssh.run(host, self.password, "mv -f %s %s" %(tmp, self.path))
+    if len(err) > 0:
+      raise DeployError("installing %s failed: %s" %(self.path, err.strip()))
+    return INSTALLED
+
+  def result(self, host):
+    """Deploy to host, returns a DeployResult instead of raising"""
+    start = time.time()
+    try:
+      outcome, detail = self.deploy(host), self.md5
+    except DeployError, e:
+      outcome, detail = FAILED, str(e)
+    except paramiko.AuthenticationException, e:
+      outcome, detail = FAILED, "authentication failed: %s" %e
+    except (socket.error, paramiko.SSHException, EOFError), e:
+      outcome, detail = FAILED, "ssh failed: %s" %e
+    except IOError, e:
+      # sftp refused the write, e.g. permissions or a missing directory
+      outcome, detail = FAILED, "upload failed: %s" %e
+    return DeployResult(host, outcome, detail, time.time() - start)
+
+
+def deploy_fleet(deployer, hosts, workers=DEPLOY_WORKERS):
+  """Deploy to all hosts with at most workers at a time, returns their
+  DeployResults in the order of hosts"""
+  queue = Queue.Queue()
+  for i, host in enumerate(hosts):
+    queue.put((i, host))
+  results = [None] * len(hosts)
+
+  def worker():
+    while True:
+      try:
+        i, host = queue.get_nowait()
+      except Queue.Empty:
+        return
+      start = time.time()
+      try:
+        results[i] = deployer.result(host)
+      except Exception, e:
+        # a dead worker would leave the rest of its hosts undeployed
+        results[i] = DeployResult(host, FAILED, "unexpected error: %r" %e, time.time() - start)
+
+  threads = []
+  for i in range(max(1, min(workers, len(hosts)))):
+    t = threading.Thread(target=worker, name="deploy-%i" %i)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+  # join with timeout so signals still reach the main thread
+  for t in threads:
+    while t.isAlive():
+      t.join(1)
+  for i, host in enumerate(hosts):
+    if results[i] is None:
+      results[i] = DeployResult(host, FAILED, "not deployed", 0.0)
+  return results
+
+
+def deploy_summary(results):
+  """Table of the outcome per miner and a count per outcome"""
+  rep = "Deployment:\n"
+  for r in results:
+    rep += "| %s | %-9s | %5.1fs | %s |\n" %(r.host.ljust(15), r.outcome, r.seconds, r.detail.split("\n")[0])
+  counts = {}
+  for r in results:
+    counts[r.outcome] = counts.get(r.outcome, 0) + 1
+  rep += ", ".join(["%i %s" %(counts[o], o) for o in (CURRENT, INSTALLED, FAILED) if counts.has_key(o)])
+  return rep
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# efficiency.py: frequency sweep for the best hash rate per watt
+# --------------------------------------------------------------------------
+#
+# A FrequencySweep walks a ladder of frequencies from the lowest up. At each
+# one the tuner finds the lowest stable voltage of every chain as usual, the
+# sweep then records the operating point: the voltage codes, the measured
+# hash rate at them and the power a PowerModel estimates for them. Once the
+# ladder is done the operating point with the most MH/s per watt is picked.
+#
+# Whether a chain keeps the error limit is up to the schedule, which already
+# tests error rates with confidence bounds. A frequency is only ruled out if
+# a chain ended at the highest voltage allowed and still made too many
+# errors, the frequencies above it are not tried then since they would need
+# even more voltage.
+#
+# Miners do not report their power, so it is modelled: the dynamic power of
+# a chain goes with frequency and voltage squared, a static part of it and
+# the controller, fans and PSU losses do not depend on either. The voltage
+# of a PIC code is assumed to be linear in the code.
+
+# chain volts at code 0x00 and volts less per code
+VOLTS_AT_ZERO = 11.0
+VOLTS_PER_CODE = 1 / 128.0
+# watts of one chain at REF_FREQ (MHz) and REF_CODE, STATIC_WATTS of them
+# do not scale with frequency and voltage
+REF_FREQ = 384
+REF_CODE = 0x80
+CHAIN_WATTS = 180.0
+STATIC_WATTS = 15.0
+# watts of the rest of the miner
+BASE_WATTS = 80.0
+# frequencies (MHz) swept by default
+FREQ_LADDER = ('384', '400', '425', '450', '475', '500')
+# PowerModel arguments accepted by parse_power()
+POWER_PARAMS = ('chain_watts', 'static_watts', 'base_watts', 'ref_freq', 'ref_code', 'volts_at_zero', 'volts_per_code')
+# samples at the final voltages the hash rate of an operating point is averaged over
+RATE_SAMPLES = 10
+
+
+class PowerModel(object):
+  """Watts of a miner at a frequency and the voltage codes of its chains"""
+
+  def __init__(self, chain_watts=CHAIN_WATTS, static_watts=STATIC_WATTS, base_watts=BASE_WATTS,
+               ref_freq=REF_FREQ, ref_code=REF_CODE, volts_at_zero=VOLTS_AT_ZERO, volts_per_code=VOLTS_PER_CODE):
+    self.chain_watts = chain_watts
+    self.static_watts = static_watts
+    self.base_watts = base_watts
+    self.ref_freq = ref_freq
+    self.ref_code = ref_code
+    self.volts_at_zero = volts_at_zero
+    self.volts_per_code = volts_per_code
+
+  def volts(self, code):
+    return self.volts_at_zero - code * self.volts_per_code
+
+  def chain(self, freq, code):
+    """Watts of one chain"""
+    scale = float(freq) / self.ref_freq * (self.volts(code) / self.volts(self.ref_code)) ** 2
+    return self.static_watts + (self.chain_watts - self.static_watts) * scale
+
+  def watts(self, freq, codes):
+    return self.base_watts + sum([self.chain(freq, code) for code in codes])
+
+
+def parse_power(spec):
+  """PowerModel of the --power option, comma separated name=value pairs of
+  the PowerModel arguments, e.g. 'chain_watts=170,base_watts=100'"""
+  kwargs = {}
+  for item in spec.split(','):
+    name, sep, value = item.partition('=')
+    name = name.strip()
+    if not sep or name not in POWER_PARAMS:
+      raise ValueError("invalid power model parameter %s" %item)
+    if name == 'ref_code':
+      kwargs[name] = int(value, 0)
+    else:
+      kwargs[name] = float(value)
+  return PowerModel(**kwargs)
+
+
+class OperatingPoint(object):
+  """Voltage codes and measured hash rate of a miner tuned at a frequency"""
+
+  def __init__(self, freq, codes, rate, watts, feasible):
+    self.freq = freq
+    self.codes = codes
+    # MH/s
+    self.rate = rate
+    self.watts = watts
+    # no tuned chain ran out of voltage
+    self.feasible = feasible
+
+  def efficiency(self):
+    """MH/s per watt, i.e. MH per joule"""
+    return self.rate / self.watts
+
+  def voltages(self):
+    return [hex(c) for c in self.codes]
+
+  def __str__(self):
+    return "%s MHz, %s, %.1f MH/s, %.0f W, %.4f MH/J%s" %(self.freq, " ".join(self.voltages()), self.rate,
+      self.watts, self.efficiency(), not self.feasible and ", over error limit" or "")
+
+
+class FrequencySweep(object):
+  """Frequencies left to tune and the operating points found so far"""
+
+  def __init__(self, ladder=FREQ_LADDER, model=None, max_err_rate=0.2, max_voltage=0x50, samples=RATE_SAMPLES):
+    self.pending = sorted(ladder, key=float)
+    self.model = model or PowerModel()
+    self.max_err_rate = max_err_rate
+    # code of the highest voltage allowed
+    self.max_voltage = max_voltage
+    self.samples = samples
+    self.points = {}
+    # frequency cgminer is restarting at, None once stats show it
+    self.target = None
+    # operating point switched back to once the sweep is done
+    self.final = None
+
+  def record(self, hist, outcomes, chains):
+    """Operating point of the current voltages of hist, chains are the tuned ones"""
+    codes = hist.get('voltage')
+    rate, n = 0.0, 0
+    while n < min(self.samples, len(hist)) and hist.get('voltage', -1-n) == codes:
+      rate += sum(hist.get('chainrate', -1-n))
+      n += 1
+    feasible = True
+    for c in chains:
+      if codes[c] > self.max_voltage:
+        continue
+      outcome = outcomes.lookup(hist.frequency, c, codes[c])
+      if outcome is not None:
+        err = outcome.means()[2]
+      else:
+        err = hist.get('error_rate15')[c]
+      if err > self.max_err_rate:
+        feasible = False
+    point = OperatingPoint(hist.frequency, codes, rate / max(n, 1), self.model.watts(hist.frequency, codes), feasible)
+    self.points[hist.frequency] = point
+    if hist.frequency in self.pending:
+      self.pending.remove(hist.frequency)
+    if not feasible:
+      # higher frequencies need even more voltage
+      self.pending = [f for f in self.pending if float(f) < float(hist.frequency)]
+    return point
+
+  def next_frequency(self):
+    """Next frequency to tune at, None once the ladder is done"""
+    if not self.pending:
+      return None
+    return self.pending[0]
+
+  def best(self):
+    """Most efficient operating point within the error limit, or None"""
+    points = [p for p in self.points.values() if p.feasible]
+    if not points:
+      return None
+    return max(points, key=lambda p: p.efficiency())
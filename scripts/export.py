@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# export.py: streaming export of the sample history of l3plus_autotune.py
+# --------------------------------------------------------------------------
+#
+# Every sample pushed to a ChainHistory is appended to an export file right
+# away, so the history on disk is complete up to the last cycle and nothing
+# has to be written when tuning ends or the process is killed. The file is
+# opened for each write only, a fleet would need a file descriptor per miner
+# otherwise. Records hold
+# the numeric per sample and per chain fields of the history, ASIC status
+# strings are left out.
+#
+# Formats: JSON Lines (one object per sample), CSV (one column per chain
+# value) and a binary one of fixed size little endian records after a magic
+# header. read_export() reads any of them back as the same dicts.
+
+import os, json, struct, tempfile
+
+from history import ERROR_WINDOWS, rate_field
+
+EXPORT_MAGIC = 'L3HX\x01'
+CHAINS = 4
+# per sample and per chain fields with their struct types
+SAMPLE_FIELDS = (('timestamp', 'q'), ('frequency', '8s'), ('uptime', 'q'), ('device_error', 'f'), ('speed', '2f'))
+CHAIN_FIELDS = (('err', 'q'), ('temp_pcb', 'h'), ('temp_chip', 'h'), ('voltage', 'B'), ('chainrate', 'f')) + \
+  tuple([(rate_field(w), 'f') for w in ERROR_WINDOWS]) + (('error_rate', 'f'),)
+EXPORT_RECORD = struct.Struct('<' + ''.join([t for f, t in SAMPLE_FIELDS]) +
+                              ''.join(['%i%s' %(CHAINS, t) for f, t in CHAIN_FIELDS]))
+# speed is [GHS av, GHS 5s]
+SPEED_COLUMNS = ('speed_av', 'speed_5s')
+
+
+class ExportError(Exception):
+  """Export file is not in a known format"""
+  pass
+
+
+def history_record(hist, i=-1):
+  """Sample i of a ChainHistory as an export record, voltages are codes"""
+  rec = {'frequency': hist.frequency}
+  for f, t in SAMPLE_FIELDS:
+    if f != 'frequency':
+      rec[f] = hist.get(f, i)
+  for f, t in CHAIN_FIELDS:
+    rec[f] = hist.get(f, i)
+  return rec
+
+
+def csv_header():
+  cols = []
+  for f, t in SAMPLE_FIELDS:
+    if f == 'speed':
+      cols.extend(SPEED_COLUMNS)
+    else:
+      cols.append(f)
+  for f, t in CHAIN_FIELDS:
+    cols.extend(['%s_%i' %(f, c+1) for c in range(CHAINS)])
+  return cols
+
+
+class ExportWriter(object):
+  """Appends records to the file at path, which is only open while writing"""
+  ext = None
+
+  def __init__(self, path):
+    self.path = path
+    self.count = 0
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+      self._append(self.header())
+
+  def header(self):
+    return ''
+
+  def encode(self, rec):
+    raise NotImplementedError
+
+  def _append(self, data):
+    fh = open(self.path, 'ab')
+    try:
+      fh.write(data)
+    finally:
+      fh.close()
+
+  def write(self, *recs):
+    """Append records in one write"""
+    self._append(''.join([self.encode(rec) for rec in recs]))
+    self.count += len(recs)
+
+
+class JsonlWriter(ExportWriter):
+  ext = 'jsonl'
+
+  def encode(self, rec):
+    return json.dumps(rec, sort_keys=True, separators=(',', ':')) + "\n"
+
+
+class CsvWriter(ExportWriter):
+  ext = 'csv'
+
+  def header(self):
+    return ",".join(csv_header()) + "\n"
+
+  def encode(self, rec):
+    values = []
+    for f, t in SAMPLE_FIELDS:
+      if f == 'speed':
+        values.extend(rec[f])
+      else:
+        values.append(rec[f])
+    for f, t in CHAIN_FIELDS:
+      values.extend(rec[f])
+    return ",".join([isinstance(v, float) and '%.6g' %v or str(v) for v in values]) + "\n"
+
+
+class BinaryWriter(ExportWriter):
+  ext = 'bin'
+
+  def header(self):
+    return EXPORT_MAGIC
+
+  def encode(self, rec):
+    values = []
+    for f, t in SAMPLE_FIELDS:
+      if f == 'speed':
+        values.extend(rec[f])
+      elif f == 'frequency':
+        values.append(str(rec[f]))
+      else:
+        values.append(rec[f])
+    for f, t in CHAIN_FIELDS:
+      values.extend(rec[f])
+    return EXPORT_RECORD.pack(*values)
+
+
+EXPORT_FORMATS = dict([(w.ext, w) for w in (JsonlWriter, CsvWriter, BinaryWriter)])
+
+
+def open_export(fmt, prefix, directory=None):
+  """New export file of format fmt, named like the report files"""
+  writer = EXPORT_FORMATS[fmt]
+  fd, path = tempfile.mkstemp(suffix='.' + writer.ext, prefix=prefix, dir=directory)
+  os.close(fd)
+  return writer(path)
+
+
+def _binary_records(fh):
+  size = EXPORT_RECORD.size
+  while True:
+    data = fh.read(size)
+    # a partial record at the end is a write interrupted by a crash
+    if len(data) < size:
+      return
+    values = list(EXPORT_RECORD.unpack(data))
+    rec = {}
+    for f, t in SAMPLE_FIELDS:
+      if f == 'speed':
+        rec[f], values = values[:2], values[2:]
+      else:
+        rec[f] = values.pop(0)
+    rec['frequency'] = rec['frequency'].rstrip('\x00')
+    for f, t in CHAIN_FIELDS:
+      rec[f], values = values[:CHAINS], values[CHAINS:]
+    yield rec
+
+
+def _csv_records(fh):
+  cols = fh.readline().strip().split(',')
+  if cols != csv_header():
+    raise ExportError("unexpected csv columns")
+  for line in fh:
+    values = line.strip().split(',')
+    if len(values) != len(cols):
+      return
+    row = dict(zip(cols, values))
+    rec = {}
+    for f, t in SAMPLE_FIELDS:
+      if f == 'speed':
+        rec[f] = [float(row[c]) for c in SPEED_COLUMNS]
+      elif f == 'frequency':
+        rec[f] = row[f]
+      elif t == 'f':
+        rec[f] = float(row[f])
+      else:
+        rec[f] = int(row[f])
+    for f, t in CHAIN_FIELDS:
+      conv = int
+      if t == 'f':
+        conv = float
+      rec[f] = [conv(row['%s_%i' %(f, c+1)]) for c in range(CHAINS)]
+    yield rec
+
+
+def _jsonl_records(fh):
+  for line in fh:
+    if not line.endswith("\n"):
+      return
+    yield json.loads(line)
+
+
+def read_export(path):
+  """Iterate over the records of an export file of any format"""
+  fh = open(path, 'rb')
+  try:
+    head = fh.read(len(EXPORT_MAGIC))
+    if head == EXPORT_MAGIC:
+      reader = _binary_records
+    elif head.startswith('{'):
+      reader = _jsonl_records
+      fh.seek(0)
+    elif head.startswith(SAMPLE_FIELDS[0][0][:len(head)]):
+      reader = _csv_records
+      fh.seek(0)
+    else:
+      raise ExportError("%s is not an export file" %path)
+    for rec in reader(fh):
+      yield rec
+  finally:
+    fh.close()
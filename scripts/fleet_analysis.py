@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# fleet_analysis.py: error vs voltage curves of a whole farm from export files
+# --------------------------------------------------------------------------
+#
+# Loads the sample exports of l3plus_autotune.py (see export.py) of any
+# number of miners, turns consecutive samples at an unchanged voltage into
+# (hw errors, minutes) observations per board, frequency and voltage code
+# and fits a poisson model of the error rate of every board at once:
+#
+#   log(errors/min) = a + b * (code - top) + c * (temp - REF_TEMP)
+#
+# where top is the highest code tested on the board. Only codes within
+# FIT_RANGE of top are used, below them the rate is flat at its base level.
+# From the fits it reports the code each board reaches the max error rate at,
+# boards far off from the others at the same frequency, and a starting code
+# per frequency that most boards are fine at.
+#
+# Binary exports are memory mapped straight into numpy arrays, use -e bin on
+# the tuners for big farms, jsonl and csv go through export.read_export().
+#
+# Usage: ./fleet_analysis.py [-r <max err rate>] [-o <boards.csv>] <export files or dirs>
+
+import sys, os, getopt, time
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+import l3plus_autotune
+from export import SAMPLE_FIELDS, CHAIN_FIELDS, CHAINS, EXPORT_MAGIC, EXPORT_FORMATS, read_export
+
+# codes below the highest tested one of a board that are used for its fit
+FIT_RANGE = 24
+# chip temperature the error rates are normalized to
+REF_TEMP = 60
+IRLS_ITERATIONS = 25
+# ridge penalty of the temperature coefficient relative to the weight of a
+# board's samples, temperature mostly follows the voltage on a single board
+TEMP_RIDGE = 1.0
+# damping of the updates of a and b, keeps boards with hardly any errors
+# solvable
+DAMPING = 1e-3
+# max. change of a coefficient per iteration
+MAX_STEP = 1.0
+# boards need this many codes with samples, and errors at one of them
+MIN_CODES = 3
+# robust z score of the max code of a board above which it is an outlier
+OUTLIER_Z = 3.5
+# percentile of the max codes of the boards of a frequency to start tuning at
+START_PERCENTILE = 10
+# numpy types of the struct types used by export.py
+NP_TYPES = {'q': '<i8', 'h': '<i2', 'B': 'u1', 'f': '<f4', '8s': 'S8', '2f': '<f4'}
+
+
+def export_dtype():
+  """numpy dtype of a binary export record"""
+  fields = []
+  for f, t in SAMPLE_FIELDS:
+    if t == '2f':
+      fields.append((f, NP_TYPES[t], 2))
+    else:
+      fields.append((f, NP_TYPES[t]))
+  for f, t in CHAIN_FIELDS:
+    fields.append((f, NP_TYPES[t], CHAINS))
+  return np.dtype(fields)
+
+
+def export_files(paths):
+  """Export files in paths, directories are searched one level deep"""
+  exts = tuple(['.' + e for e in EXPORT_FORMATS.keys()])
+  files = []
+  for p in paths:
+    if os.path.isdir(p):
+      files.extend(sorted([os.path.join(p, f) for f in os.listdir(p) if f.endswith(exts)]))
+    else:
+      files.append(p)
+  return files
+
+
+def miner_of(path):
+  """Miner ip of an export file named <ip>-XXXXXX.<ext>"""
+  return os.path.basename(path).rsplit('-', 1)[0]
+
+
+def load_export(path, dtype):
+  """Records of an export file as a numpy record array"""
+  fh = open(path, 'rb')
+  try:
+    binary = fh.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC
+  finally:
+    fh.close()
+  if binary:
+    size = os.path.getsize(path) - len(EXPORT_MAGIC)
+    # a partial record at the end is a write interrupted by a crash
+    return np.memmap(path, dtype=dtype, mode='r', offset=len(EXPORT_MAGIC), shape=(size // dtype.itemsize,))
+  recs = list(read_export(path))
+  arr = np.zeros(len(recs), dtype=dtype)
+  for f in dtype.names:
+    arr[f] = [r[f] for r in recs]
+  return arr
+
+
+class Observations(object):
+  """Errors and minutes per board and code, boards are (miner, chain, frequency)"""
+
+  def __init__(self):
+    self.boards = {}
+    self.board_keys = []
+    self.parts = []
+
+  def board(self, miner, chain, freq):
+    key = (miner, chain, freq)
+    if not self.boards.has_key(key):
+      self.boards[key] = len(self.board_keys)
+      self.board_keys.append(key)
+    return self.boards[key]
+
+  def add(self, miner, arr):
+    """Add the samples of one export file, summed up per board and code right
+    away so memory does not grow with the number of samples"""
+    if len(arr) < 2:
+      return
+    ts = arr['timestamp']
+    if (ts[1:] < ts[:-1]).any():
+      arr = arr[np.argsort(ts, kind='mergesort')]
+      ts = arr['timestamp']
+    freqs, freq_idx = np.unique(arr['frequency'], return_inverse=True)
+    prev, cur = slice(None, -1), slice(1, None)
+    volt = arr['voltage'].astype(np.int64)
+    errors = arr['err'][cur] - arr['err'][prev]
+    seconds = (ts[cur] - ts[prev]).astype(np.float64)
+    # only intervals spent at one voltage and frequency, without a cgminer restart
+    ok = (volt[cur] == volt[prev]) & (errors >= 0) & ((freq_idx[cur] == freq_idx[prev]) & (seconds > 0))[:, None]
+    # dense index of frequency, chain and code within this file
+    local = (freq_idx[cur][:, None] * CHAINS + np.arange(CHAINS)) * 256 + volt[cur]
+    local = local.ravel()
+    size = len(freqs) * CHAINS * 256
+    secs = (ok * seconds[:, None]).ravel()
+    secs_sum = np.bincount(local, secs, size)
+    used = np.nonzero(secs_sum)[0]
+    ids = np.array([self.board(miner, c, f) for f in freqs for c in range(CHAINS)], dtype=np.int64)
+    self.parts.append((ids[used // 256], used % 256, np.bincount(local, (ok * errors).ravel(), size)[used],
+                       secs_sum[used], np.bincount(local, secs * arr['temp_chip'][cur].ravel(), size)[used]))
+
+  def grouped(self):
+    """(board, code, errors, minutes, mean temp) arrays, one entry per board and code"""
+    if not self.parts:
+      empty = np.zeros(0)
+      return empty.astype(np.int64), empty.astype(np.int64), empty, empty, empty
+    board, code, errors, secs, temp = [np.concatenate(p) for p in zip(*self.parts)]
+    keys, inv = np.unique(board * 256 + code, return_inverse=True)
+    secs_sum = np.bincount(inv, secs)
+    return keys // 256, keys % 256, np.bincount(inv, errors), secs_sum / 60.0, np.bincount(inv, temp) / secs_sum
+
+
+def fit_boards(nboards, board, code, errors, minutes, temp):
+  """Batched poisson regression of all boards, returns (beta, top, used)
+  with beta[board] = (a, b, c) and top the highest code of each board"""
+  top = np.full(nboards, -1, dtype=np.int64)
+  np.maximum.at(top, board, code)
+  use = code >= top[board] - FIT_RANGE
+  board, code, errors, minutes, temp = board[use], code[use], errors[use], minutes[use], temp[use]
+  X = np.column_stack([np.ones(len(board)), code - top[board], temp - REF_TEMP])
+  # start from the mean rate of each board and a growth of 1.5 per code
+  rate = (np.bincount(board, errors, nboards) + 0.5) / (np.bincount(board, minutes, nboards) + 1.0)
+  beta = np.column_stack([np.log(rate), np.full(nboards, np.log(1.5)), np.zeros(nboards)])
+  ridge = np.diag([DAMPING, DAMPING, DAMPING])
+  # a and b are damped towards their last estimate, c is pulled towards 0
+  pull = np.array([DAMPING, DAMPING, 0.0])
+  for it in range(IRLS_ITERATIONS):
+    eta = np.clip((X * beta[board]).sum(axis=1), -20, 10)
+    mu = minutes * np.exp(eta)
+    # working response and weights of the log link
+    z = eta + (errors - mu) / np.maximum(mu, 1e-12)
+    w = mu
+    A = np.empty((nboards, 3, 3))
+    for i in range(3):
+      for j in range(i, 3):
+        A[:, i, j] = A[:, j, i] = np.bincount(board, w * X[:, i] * X[:, j], nboards)
+    rhs = np.column_stack([np.bincount(board, w * X[:, i] * z, nboards) for i in range(3)])
+    A += ridge
+    A[:, 2, 2] += TEMP_RIDGE * A[:, 0, 0]
+    rhs += beta * pull
+    step = np.linalg.solve(A, rhs[:, :, None])[:, :, 0] - beta
+    # newton steps overshoot far from the optimum of boards with few codes
+    beta = beta + np.clip(step, -MAX_STEP, MAX_STEP)
+    if np.abs(step).max() < 1e-6:
+      break
+  codes = np.bincount(board, minlength=nboards)
+  has_errors = np.bincount(board, errors, nboards) > 0
+  return beta, top, (codes >= MIN_CODES) & has_errors
+
+
+def max_codes(beta, top, usable, mean_temp, max_err_rate, min_code, max_code):
+  """Code each board reaches max_err_rate at, -1 where the fit is unusable"""
+  a, b, c = beta[:, 0], beta[:, 1], beta[:, 2]
+  ok = usable & (b > 0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    x = (np.log(max_err_rate) - a - c * (mean_temp - REF_TEMP)) / b
+  res = np.where(ok, np.clip(np.floor(top + x), min_code, max_code), -1)
+  return res.astype(np.int64)
+
+
+def robust_z(values):
+  """(value - median) / scaled MAD, 0 if all values are alike"""
+  med = np.median(values)
+  mad = np.median(np.abs(values - med)) * 1.4826
+  if mad == 0:
+    return np.zeros(len(values))
+  return (values - med) / mad
+
+
+def analyze(paths, max_err_rate, out=None):
+  t = time.time()
+  dtype = export_dtype()
+  obs = Observations()
+  files = export_files(paths)
+  samples = 0
+  for path in files:
+    arr = load_export(path, dtype)
+    samples += len(arr)
+    obs.add(miner_of(path), arr)
+  board, code, errors, minutes, temp = obs.grouped()
+  nboards = len(obs.board_keys)
+  load_time = time.time() - t
+  t = time.time()
+  beta, top, usable = fit_boards(nboards, board, code, errors, minutes, temp)
+  mean_temp = np.bincount(board, temp * minutes, nboards) / np.maximum(np.bincount(board, minutes, nboards), 1e-9)
+  limit = max_codes(beta, top, usable, mean_temp, max_err_rate, int(l3plus_autotune.MAX_VOLTAGE, 16), 254)
+  fit_time = time.time() - t
+
+  print "%i files, %i samples, %i boards (%i fitted) in %.2fs load + %.2fs fit" %(len(files), samples, nboards,
+    (limit >= 0).sum(), load_time, fit_time)
+  freqs = np.array([k[2] for k in obs.board_keys])
+  outlier = np.zeros(nboards, dtype=bool)
+  zs = np.zeros(nboards)
+  print "| frequency | boards | start code | median max code | outliers |"
+  for f in sorted(set(freqs.tolist())):
+    sel = np.nonzero((freqs == f) & (limit >= 0))[0]
+    if not len(sel):
+      continue
+    zs[sel] = robust_z(limit[sel].astype(np.float64))
+    outlier[sel] = np.abs(zs[sel]) > OUTLIER_Z
+    start = int(np.percentile(limit[sel], START_PERCENTILE))
+    print "| %9s | %6i | %10s | %15s | %8i |" %(f, len(sel), hex(start), hex(int(np.median(limit[sel]))), outlier[sel].sum())
+  if outlier.any():
+    print "Outlier boards (max code, robust z):"
+    for i in np.nonzero(outlier)[0]:
+      miner, chain, f = obs.board_keys[i]
+      print "| %-15s | chain %i | %4s MHz | %s | %+.1f |" %(miner, chain+1, f, hex(int(limit[i])), zs[i])
+  if out:
+    fh = open(out, 'w')
+    try:
+      fh.write("miner,chain,frequency,top,max_code,a,b,c,mean_temp,outlier\n")
+      for i, (miner, chain, f) in enumerate(obs.board_keys):
+        fh.write("%s,%i,%s,%i,%i,%.4f,%.4f,%.4f,%.1f,%i\n" %(miner, chain+1, f, top[i], limit[i],
+          beta[i, 0], beta[i, 1], beta[i, 2], mean_temp[i], outlier[i]))
+    finally:
+      fh.close()
+    print "Board fits written to %s" %out
+
+
+def main():
+  if np is None:
+    print "numpy module missing, please install with:"
+    print " sudo apt-get install python-numpy"
+    sys.exit(1)
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "r:o:")
+  except getopt.GetoptError, e:
+    print e
+    args = []
+  if not args:
+    print "Usage: %s [-r <max err rate>] [-o <boards.csv>] <export files or dirs>" %sys.argv[0]
+    sys.exit(1)
+  max_err_rate, out = l3plus_autotune.MAX_ERR_RATE, None
+  for opt, arg in opts:
+    if opt == "-r":
+      max_err_rate = float(arg)
+    elif opt == "-o":
+      out = arg
+  analyze(args, max_err_rate, out)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# history.py: compact sample history of a miner for l3plus_autotune.py
+# --------------------------------------------------------------------------
+#
+# Samples are kept per frequency in a ring buffer of fixed width arrays, one
+# array per field with the values of all chains side by side. Arrays grow
+# until the ring is full, after that the oldest sample is overwritten. ASIC
+# status strings are only stored when they change.
+#
+# Error rates are computed incrementally on push over sliding windows of
+# real time, so late or missing samples do not skew them.
+
+from array import array
+from collections import deque
+
+# max. history records to retain in memory (2days default)
+HIST_MAX_LEN = 2880
+# error rate windows in seconds, stored as error_rate<minutes>, the tuner
+# relies on 5, 10 and 15 minutes being present
+ERROR_WINDOWS = (300, 600, 900)
+
+# array type of each per chain field, plus one error_rate<minutes> field
+# per window and error_rate over the whole history
+CHAIN_FIELDS = {
+  'err': 'l',
+  'temp_pcb': 'h',
+  'temp_chip': 'h',
+  'voltage': 'B',
+  'chainrate': 'f',
+}
+# array type of each per sample field, speed is [GHS av, GHS 5s]
+SAMPLE_FIELDS = {
+  'timestamp': 'l',
+  'uptime': 'l',
+  'device_error': 'f',
+}
+
+
+def rate_field(window):
+  """History field name of the error rate over window seconds"""
+  return 'error_rate%i' %(window / 60)
+
+
+class ErrorRates(object):
+  """Per chain error rates (errors/min) over sliding time windows.
+
+  Each window keeps a deque of the samples inside it, so a push costs O(1)
+  amortized per window. Error counters going backwards (cgminer restart) are
+  folded into a running offset, so counts stay monotonic."""
+
+  def __init__(self, windows=ERROR_WINDOWS, chains=4):
+    self.windows = windows
+    self.chains = chains
+    self.samples = [deque() for w in windows]
+    self.first = None
+    self.last_raw = None
+    self.offset = [0] * chains
+    # error counts of the last push per window, and since the first sample
+    self.counts = [[0] * chains for w in windows]
+    self.total = [0] * chains
+
+  def push(self, ts, err):
+    """Add the raw error counters at ts, returns a list of per chain rates for
+    each window followed by the rates since the first sample"""
+    if self.last_raw is not None:
+      for i in range(self.chains):
+        if err[i] < self.last_raw[i]:
+          self.offset[i] += self.last_raw[i]
+    self.last_raw = list(err)
+    sample = (ts, [err[i] + self.offset[i] for i in range(self.chains)])
+    if self.first is None:
+      self.first = sample
+    rates = []
+    for k, w in enumerate(self.windows):
+      d = self.samples[k]
+      d.append(sample)
+      while d[0][0] < ts - w:
+        d.popleft()
+      self.counts[k], rate = self._rate(d[0], sample)
+      rates.append(rate)
+    self.total, rate = self._rate(self.first, sample)
+    rates.append(rate)
+    return rates
+
+  def errors(self):
+    """Error counters of the last push, corrected for counter resets"""
+    if self.last_raw is None:
+      return [0] * self.chains
+    return [self.last_raw[i] + self.offset[i] for i in range(self.chains)]
+
+  def _rate(self, start, end):
+    counts = [end[1][i] - start[1][i] for i in range(self.chains)]
+    timediff = end[0] - start[0]
+    if timediff <= 0:
+      return counts, [0.0] * self.chains
+    return counts, [float(c) / timediff*60 for c in counts]
+
+
+class Outcome(object):
+  """Running aggregates of the samples taken at one voltage"""
+  __slots__ = ['count', 'sum5', 'sum10', 'sum15', 'sum_temp', 'max5', 'max10', 'max15', 'max_temp']
+
+  def __init__(self):
+    self.count = 0
+    self.sum5 = self.sum10 = self.sum15 = self.sum_temp = 0.0
+    self.max5 = self.max10 = self.max15 = self.max_temp = 0.0
+
+  def add(self, rate5, rate10, rate15, temp=0):
+    self.count += 1
+    self.sum5 += rate5
+    self.sum10 += rate10
+    self.sum15 += rate15
+    self.sum_temp += temp
+    self.max5 = max(self.max5, rate5)
+    self.max10 = max(self.max10, rate10)
+    self.max15 = max(self.max15, rate15)
+    self.max_temp = max(self.max_temp, temp)
+
+  def merge(self, other):
+    """Add the samples aggregated in another Outcome"""
+    self.count += other.count
+    self.sum5 += other.sum5
+    self.sum10 += other.sum10
+    self.sum15 += other.sum15
+    self.sum_temp += other.sum_temp
+    self.max5 = max(self.max5, other.max5)
+    self.max10 = max(self.max10, other.max10)
+    self.max15 = max(self.max15, other.max15)
+    self.max_temp = max(self.max_temp, other.max_temp)
+
+  def means(self):
+    """Mean 5/10/15min error rates"""
+    if not self.count:
+      return 0.0, 0.0, 0.0
+    return self.sum5 / self.count, self.sum10 / self.count, self.sum15 / self.count
+
+  def mean_temp(self):
+    """Mean chip temperature"""
+    if not self.count:
+      return 0.0
+    return self.sum_temp / self.count
+
+
+class OutcomeIndex(object):
+  """Outcome per (frequency, chain, voltage code), updated as samples settle"""
+
+  def __init__(self):
+    self.outcomes = {}
+
+  def add(self, freq, chain, code, rate5, rate10, rate15, temp=0):
+    self._outcome((freq, chain, code)).add(rate5, rate10, rate15, temp)
+
+  def merge(self, freq, chain, code, outcome):
+    """Add an aggregated Outcome, e.g. one loaded from disk"""
+    self._outcome((freq, chain, code)).merge(outcome)
+
+  def _outcome(self, key):
+    o = self.outcomes.get(key)
+    if o is None:
+      o = self.outcomes[key] = Outcome()
+    return o
+
+  def lookup(self, freq, chain, code):
+    """Outcome of a voltage or None if it was never tested"""
+    return self.outcomes.get((freq, chain, code))
+
+  def tested(self, freq, chain):
+    """Sorted (code, Outcome) pairs tested on a chain at freq"""
+    return sorted([(k[2], o) for k, o in self.outcomes.items() if k[0] == freq and k[1] == chain])
+
+
+class ChainHistory(object):
+  """Ring buffer of the samples of one miner at one frequency.
+
+  Samples are addressed like a list, 0 is the oldest and -1 the newest
+  sample. Voltages are stored as integer codes."""
+
+  def __init__(self, frequency, size=HIST_MAX_LEN, chains=4, windows=ERROR_WINDOWS, outcomes=None, settle=0):
+    self.frequency = frequency
+    self.size = size
+    self.chains = chains
+    # samples are added to the outcome index once they are settle seconds old
+    self.outcomes = outcomes
+    self.settle = settle
+    # seq of the oldest sample not in the outcome index yet
+    self.unsettled = 0
+    self.rates = ErrorRates(windows, chains)
+    self.fields = dict(CHAIN_FIELDS)
+    for w in windows:
+      self.fields[rate_field(w)] = 'd'
+    self.fields['error_rate'] = 'd'
+    # slot of the oldest sample once the ring is full
+    self.head = 0
+    self.count = 0
+    # samples pushed in total, used to index the asic status changes
+    self.seq = 0
+    self.cols = {}
+    for f, t in self.fields.items():
+      self.cols[f] = array(t)
+    for f, t in SAMPLE_FIELDS.items():
+      self.cols[f] = array(t)
+    self.cols['speed'] = array('f')
+    # (seq, statuses) whenever the asic status of any chain changed
+    self.asic_status = deque()
+
+  def __len__(self):
+    return self.count
+
+  def _slot(self, i):
+    if i < 0:
+      i += self.count
+    if i < 0 or i >= self.count:
+      raise IndexError("history index out of range")
+    return (self.head + i) % self.size
+
+  def push(self, stats, voltage, ts):
+    """Append a sample, evicting the oldest one if the ring is full.
+    voltage is the list of hex voltage strings read from the miner."""
+    n = self.chains
+    codes = [int(v, 16) for v in voltage]
+    values = {'err': stats['err'], 'temp_pcb': stats['temp_pcb'], 'temp_chip': stats['temp_chip'],
+              'voltage': codes, 'chainrate': [float(r) for r in stats['chainrate']]}
+    rates = self.rates.push(int(ts), stats['err'])
+    for k, w in enumerate(self.rates.windows):
+      values[rate_field(w)] = rates[k]
+    values['error_rate'] = rates[-1]
+    speed = [float(s) for s in stats['speed']]
+    if self.count < self.size:
+      for f in self.fields:
+        self.cols[f].extend(values[f])
+      self.cols['timestamp'].append(int(ts))
+      self.cols['uptime'].append(int(stats['uptime']))
+      self.cols['device_error'].append(float(stats['device_error']))
+      self.cols['speed'].extend(speed)
+      self.count += 1
+    else:
+      slot = self.head
+      self.head = (self.head + 1) % self.size
+      for f in self.fields:
+        self.cols[f][slot*n:(slot+1)*n] = array(self.fields[f], values[f])
+      self.cols['timestamp'][slot] = int(ts)
+      self.cols['uptime'][slot] = int(stats['uptime'])
+      self.cols['device_error'][slot] = float(stats['device_error'])
+      self.cols['speed'][slot*2:slot*2+2] = array('f', speed)
+      # forget status changes older than the one in effect for the oldest sample
+      oldest = self.seq - self.count + 1
+      while len(self.asic_status) > 1 and self.asic_status[1][0] <= oldest:
+        self.asic_status.popleft()
+    if not self.asic_status or self.asic_status[-1][1] != stats['asic_status']:
+      self.asic_status.append((self.seq, list(stats['asic_status'])))
+    self.seq += 1
+    if self.outcomes is not None:
+      while self.unsettled < self.seq:
+        i = self.unsettled - (self.seq - self.count)
+        if i >= 0:
+          if self.get('timestamp', i) > int(ts) - self.settle:
+            break
+          self._settled(i)
+        self.unsettled += 1
+
+  def _settled(self, i):
+    codes = self.get('voltage', i)
+    rate5, rate10, rate15 = self.get('error_rate5', i), self.get('error_rate10', i), self.get('error_rate15', i)
+    temp = self.get('temp_chip', i)
+    for c in range(self.chains):
+      self.outcomes.add(self.frequency, c, codes[c], rate5[c], rate10[c], rate15[c], temp[c])
+
+  def get(self, field, i=-1):
+    """Value of field for sample i, a list for per chain fields"""
+    slot = self._slot(i)
+    if field in self.fields:
+      n = self.chains
+      return self.cols[field][slot*n:(slot+1)*n].tolist()
+    if field == 'speed':
+      return self.cols['speed'][slot*2:slot*2+2].tolist()
+    if field == 'asic_status':
+      seq = self.seq - self.count + self._index(i)
+      if seq >= self.asic_status[-1][0]:
+        return self.asic_status[-1][1]
+      return self.status_at(seq)
+    return self.cols[field][slot]
+
+  def set(self, field, values, i=-1):
+    """Store the per chain values of field for sample i"""
+    slot = self._slot(i)
+    n = self.chains
+    self.cols[field][slot*n:(slot+1)*n] = array(self.fields[field], values)
+
+  def _index(self, i):
+    if i < 0:
+      i += self.count
+    return i
+
+  def status_at(self, seq):
+    """asic status strings in effect at sample seq"""
+    status = None
+    for s, st in self.asic_status:
+      if s > seq:
+        break
+      status = st
+    return status
+
+  def voltages(self, i=-1):
+    """Voltages of sample i as hex strings"""
+    return [hex(v) for v in self.get('voltage', i)]
+
+  def record(self, i=-1):
+    """Sample i as a dict in the chain_hist format"""
+    rec = {'frequency': self.frequency}
+    for f in self.fields:
+      rec[f] = self.get(f, i)
+    for f in SAMPLE_FIELDS:
+      rec[f] = self.get(f, i)
+    rec['voltage'] = [hex(v) for v in rec['voltage']]
+    rec['speed'] = self.get('speed', i)
+    rec['asic_status'] = self.get('asic_status', i)
+    return rec
+
+  def records(self):
+    """Iterate over all samples from oldest to newest as dicts"""
+    for i in xrange(self.count):
+      yield self.record(i)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# hosts.py: fleet specs of l3plus_autotune.py and scan.py
+# --------------------------------------------------------------------------
+#
+# A fleet is a file with one ip/hostname/CIDR range per line or a comma
+# separated list of them. Kept apart from the tuner so tools that only talk
+# to the cgminer API do not pull in paramiko.
+
+import os, socket, struct
+
+
+def parse_fleet(spec):
+  """Expand a fleet spec (file, comma separated ips/hostnames or CIDR ranges) into a list of hosts"""
+  if os.path.isfile(spec):
+    fh = open(spec, 'r')
+    items = []
+    for line in fh:
+      line = line.split('#')[0].strip()
+      if line:
+        items.extend(line.split())
+    fh.close()
+  else:
+    items = [i.strip() for i in spec.split(',') if i.strip()]
+  hosts = []
+  for item in items:
+    if item.find('/') > -1:
+      net, bits = item.split('/')
+      bits = int(bits)
+      if bits < 16 or bits > 32:
+        raise ValueError("CIDR range %s too large or invalid, use /16 to /32" %item)
+      base = struct.unpack('!I', socket.inet_aton(net))[0]
+      mask = (0xffffffff << (32 - bits)) & 0xffffffff
+      first = base & mask
+      count = 1 << (32 - bits)
+      # skip network and broadcast address on real subnets
+      if bits < 31:
+        addrs = range(first + 1, first + count - 1)
+      else:
+        addrs = range(first, first + count)
+      for a in addrs:
+        hosts.append(socket.inet_ntoa(struct.pack('!I', a)))
+    else:
+      hosts.append(item)
+  # preserve order, drop duplicates
+  seen = set()
+  return [h for h in hosts if not (h in seen or seen.add(h))]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# knowledge.py: on-disk store of tuning outcomes for l3plus_autotune.py
+# --------------------------------------------------------------------------
+#
+# Every miner gets one file with fixed size binary records, each holding the
+# aggregated outcome (sample count, summed and max error rates and chip
+# temperature) of one frequency/chain/voltage combination. New samples are
+# only ever appended as delta records, so a crash loses at most the last
+# unflushed cycle. Loading sums up all records of a key, once the file holds
+# many more records than keys it is compacted to one record per key and
+# atomically renamed into place.
+
+import os, re, struct
+
+from history import Outcome, OutcomeIndex
+
+# default directory of the knowledge files
+KB_DIR = os.path.expanduser('~/.l3plus_autotune')
+KB_MAGIC = 'L3KB\x01'
+# frequency, chain, voltage code, sample count, sums of 5/10/15min error rate
+# and chip temp, max of 5/10/15min error rate and chip temp
+KB_RECORD = struct.Struct('<8sBBI8d')
+# compact once the file holds this many records per distinct key
+KB_COMPACT_FACTOR = 4
+
+
+class KnowledgeError(Exception):
+  """Knowledge file exists but is not ours"""
+  pass
+
+
+def kb_path(directory, host):
+  """Knowledge file of a miner"""
+  return os.path.join(directory, re.sub(r'[^A-Za-z0-9._-]', '_', host) + '.kb')
+
+
+class KnowledgeBase(OutcomeIndex):
+  """OutcomeIndex backed by an append-only file.
+
+  Outcomes added since the last flush() are kept as deltas and appended as
+  one record per key on flush."""
+
+  def __init__(self, path, compact_factor=KB_COMPACT_FACTOR):
+    OutcomeIndex.__init__(self)
+    self.path = path
+    self.compact_factor = compact_factor
+    self.pending = {}
+    # records currently in the file
+    self.records = 0
+    self.load()
+
+  def load(self):
+    """Merge the outcomes stored on disk, returns the number of records read"""
+    if not os.path.exists(self.path):
+      return 0
+    fh = open(self.path, 'rb')
+    try:
+      data = fh.read()
+    finally:
+      fh.close()
+    if not data.startswith(KB_MAGIC):
+      raise KnowledgeError("%s is not a knowledge file" %self.path)
+    size = KB_RECORD.size
+    # a partial record at the end is a write interrupted by a crash, ignore it
+    end = len(data) - (len(data) - len(KB_MAGIC)) % size
+    unpack = KB_RECORD.unpack_from
+    for pos in xrange(len(KB_MAGIC), end, size):
+      freq, chain, code, count, s5, s10, s15, st, m5, m10, m15, mt = unpack(data, pos)
+      o = Outcome()
+      o.count, o.sum5, o.sum10, o.sum15, o.sum_temp = count, s5, s10, s15, st
+      o.max5, o.max10, o.max15, o.max_temp = m5, m10, m15, mt
+      OutcomeIndex.merge(self, freq.rstrip('\x00'), chain, code, o)
+      self.records += 1
+    if end != len(data) or self.records > self.compact_factor * len(self.outcomes):
+      self.compact()
+    return self.records
+
+  def add(self, freq, chain, code, rate5, rate10, rate15, temp=0):
+    OutcomeIndex.add(self, freq, chain, code, rate5, rate10, rate15, temp)
+    key = (freq, chain, code)
+    o = self.pending.get(key)
+    if o is None:
+      o = self.pending[key] = Outcome()
+    o.add(rate5, rate10, rate15, temp)
+
+  def _pack(self, key, o):
+    return KB_RECORD.pack(str(key[0]), key[1], key[2], o.count, o.sum5, o.sum10, o.sum15, o.sum_temp,
+                          o.max5, o.max10, o.max15, o.max_temp)
+
+  def flush(self):
+    """Append the outcomes added since the last flush"""
+    if not self.pending:
+      return
+    new = not os.path.exists(self.path)
+    if new:
+      directory = os.path.dirname(self.path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fh = open(self.path, 'ab')
+    try:
+      if new:
+        fh.write(KB_MAGIC)
+      fh.write(''.join([self._pack(k, o) for k, o in self.pending.items()]))
+    finally:
+      fh.close()
+    self.records += len(self.pending)
+    self.pending = {}
+    if self.records > self.compact_factor * len(self.outcomes):
+      self.compact()
+
+  def compact(self):
+    """Rewrite the file with one record per key"""
+    tmp = self.path + '.tmp'
+    fh = open(tmp, 'wb')
+    try:
+      fh.write(KB_MAGIC)
+      fh.write(''.join([self._pack(k, o) for k, o in sorted(self.outcomes.items())]))
+      fh.flush()
+      os.fsync(fh.fileno())
+    finally:
+      fh.close()
+    os.rename(tmp, self.path)
+    self.records = len(self.outcomes)
+    # everything is on disk now
+    self.pending = {}
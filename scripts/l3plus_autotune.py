@@ -38,21 +38,51 @@
 # TODO:
 
 # DONE:
+# - fleet mode, tune many miners from one process
+# - keep-alive ssh connections instead of a new login per command
+# - set all chains of a tuning step in one sv call
+# - talk to a resident sv agent instead of running sv for every command
+# - parse only the chain data object of the stats reply
+# - keep history in per frequency ring buffers
+# - error rates over sliding windows of real time
+# - indexed outcomes per frequency/chain/voltage
+# - keep tuning outcomes on disk across restarts
+# - adaptive sampling and decisions based on error rate confidence
+# - pluggable voltage search strategies (bisection, bandit)
+# - independent tuning timelines per chain
+# - metrics of the tuning cycle phases and chains over http
+# - stream samples to jsonl/csv/binary export files, report only a summary
+# - cache voltages instead of reading them over ssh every cycle
+# - sweep frequencies for the best hash rate per watt
+# - install sv over sftp on all miners that do not have the current one
+# - spread big fleets over processes, move the miners of dead ones
+# - start tunes from the final voltages of finished sibling boards
+# - watch the cgminer API between cycles, raise chains losing chips or spiking errors
 # - skip selected chains that have to be tuned manually
 # - cmd line options
 
 #########
 # IMPORTS
 #########
-import socket, json, sys, time, signal, tempfile, os, getopt
+import socket, sys, time, signal, tempfile, os, getopt, threading, heapq, random, multiprocessing, zlib, Queue
 from datetime import datetime
 
-try:
-  import paramiko
-except:
-  print "paramiko module missing, please install with:"
-  print " sudo apt-get install python-paramiko"
-  sys.exit(1)
+from sshpool import SSHPool, paramiko
+from svagent import SvAgent, AgentError, AgentUnsupported
+from cgminer_api import CgminerClient, ApiError
+from history import ChainHistory, OutcomeIndex, rate_field, HIST_MAX_LEN
+from scheduler import FixedSchedule, AdaptiveSchedule, rate_interval, RAISE, SETTLING, PROBING, LOCKED, STABLE, \
+  REPEAT, TUNE_REPEAT
+from search import SEARCHES, Observation
+from knowledge import KnowledgeBase, KnowledgeError, kb_path, KB_DIR
+from metrics import Metrics, MetricsServer, parse_listen, METRICS_PORT
+from export import EXPORT_FORMATS, open_export, history_record
+from voltcache import VoltageCache, VERIFY_INTERVAL
+from efficiency import FrequencySweep, parse_power, FREQ_LADDER
+from hosts import parse_fleet
+from priors import PriorStore, priors_path
+from watchdog import Watchdog, WATCHDOG_INTERVAL, HOT
+from deploy import Deployer, DeployError, load_binary, deploy_fleet, deploy_summary, SV_TXT, FAILED
 
 ###########
 # CONSTANTS
@@ -61,448 +91,1231 @@ API_PORT = 4028
 # setvoltage binary
 SETV_BIN = '/config/sv'
 SETV_BIN_MD5 = '113ad2c06daac293386e28807ea35671'
-REPEAT = 60
-# array length based on above REPEAT rate
-LEN5MIN = 5*60 / REPEAT
-LEN10MIN = 10*60 / REPEAT
-LEN15MIN = 15*60 / REPEAT
-# max. history records to retain in memory (2days default)
-HIST_MAX_LEN = 2880
+# REPEAT and TUNE_REPEAT (seconds between samples and voltage decisions of
+# the fixed schedule) come from scheduler.py, HIST_MAX_LEN from history.py
 # max acceptable errors/min
 MAX_ERR_RATE = 0.2 # 0.25 / 15 errors per hour, 0.2 / 12/h, 0.1 / 6/h
 MAX_VOLTAGE = '0x50'
-#TUNE_REPEAT = 300 # retry tuning voltage every TUNE_REPEAT seconds
-#for testing
-TUNE_REPEAT = 300
 # absolutr maximum cycles
 MAX_CYCLE = 1200
+# voltage search strategy, see search.py
+DEFAULT_SEARCH = 'bisect'
+# format samples are exported in, see export.py
+DEFAULT_EXPORT = 'jsonl'
+# failed writes of the export file in a row after which exporting is given up
+EXPORT_MAX_FAILURES = 10
+# frequency is changed by rewriting the cgminer config and restarting it
+CGMINER_CONF = '/config/cgminer.conf'
+SET_FREQ_CMD = "sed -i 's/\"bitmain-freq\" *: *\"[0-9]*\"/\"bitmain-freq\" : \"%s\"/' " + CGMINER_CONF + \
+  " && /etc/init.d/cgminer.sh restart > /dev/null 2>&1"
+# seconds between polls while cgminer restarts and max. seconds it may take
+RESTART_POLL = 30
+RESTART_TIMEOUT = 600
+# seconds a chain started from the priors is rolled back to its old voltage
+# right away if it makes too many errors
+PRIOR_WATCH = 900
+# default number of miners worked on in parallel in fleet mode, per process
+FLEET_WORKERS = 16
+# seconds between the metrics snapshots shard processes send to the coordinator
+SHARD_METRICS_INTERVAL = 10
+# times the miners of a dead shard process are moved to another one before
+# they are given up on
+SHARD_MOVES = 2
+# seconds between progress lines of the coordinator
+SHARD_PROGRESS = 300
 # socket timeout
 socket.setdefaulttimeout(10)
 
+# serializes output of concurrently tuned miners
+print_lock = threading.Lock()
+
+
+class TuneError(Exception):
+  """Unrecoverable error while tuning a single miner"""
+  pass
+
 
 ###############
-# NET FUNCTIONS
+# MINER TUNER
 ###############
-def get_minerstats(ip, port=API_PORT):
-  """Get all stats from miner API"""
-  try:
-    json_resp = ""
-    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-    s.connect((ip, port))
-    s.send(json.dumps({"command":'stats'}))
-    while True:
-      data = s.recv(1024)
-      if not data:
-        break
-      json_resp += data
-    s.close()
-  except socket.error, e:
-    print "Failed to connect to host:\n%s" %e
-    sys.exit(1)
-  if json_resp.find('Blissz v1.02"}') > -1:
-    json_resp = json_resp.replace('\x00','')
-    json_resp = json_resp.replace('Blissz v1.02"}', 'Blissz v1.02"},').strip()
-    #print "Blissz fw detected, fixing json output accordingly"
-  elif json_resp.find('Antminer L3++') > -1:
-    json_resp = json_resp.replace('\x00','')
-    json_resp = json_resp.replace('Antminer L3++"}', 'Antminer L3++"},').strip()
-    #print "L3++ fw detected, fixing json output accordingly"
-  else:
-    json_resp = json_resp.replace('\x00','')
-    json_resp = json_resp.replace("L3+\"}", "L3+\"},").strip()
-    #print "Bitmain fw detected, fixing json output accordingly"
-  try:
-    resp = json.loads(json_resp)
-  except ValueError, e:
-    print "Failed to decode json reply:\n%s\n" %e
-    print json_resp
-    sys.exit(1)
-    ""
-  
-  miner_stats = {}
-  miner_stats['err'] = []
-  miner_stats['speed'] = []
-  miner_stats['chainrate'] = []
-  miner_stats['temp_pcb'] = []
-  miner_stats['temp_chip'] = []
-  miner_stats['asic_status'] = []
-  for i in range (1,5):
-    #print resp['STATS'][1]['chain_hw'+str(i)]
-    miner_stats['err'].append( resp['STATS'][1]['chain_hw'+str(i)] )
-    miner_stats['chainrate'].append( resp['STATS'][1]['chain_rate'+str(i)] ) 
-    miner_stats['temp_pcb'].append( resp['STATS'][1]['temp'+str(i)] ) 
-    miner_stats['temp_chip'].append( resp['STATS'][1]['temp2_'+str(i)] ) 
-    miner_stats['asic_status'].append( resp['STATS'][1]['chain_acs'+str(i)] ) 
+class MinerTuner(object):
+  """Tuning state of a single miner, one tuning cycle per step()"""
+
+  def __init__(self, ip, admin_pw='admin', skip_chain=None, tag=False, ssh=None, kb_dir=None, fixed=False, search=DEFAULT_SEARCH,
+               metrics=None, export=DEFAULT_EXPORT, verify_interval=VERIFY_INTERVAL, ladder=None, power=None, priors=None,
+               clock=time, api_port=API_PORT):
+    self.ip = ip
+    # port of the cgminer API, simulated miners answer on another one
+    self.api_port = api_port
+    # the time module, or a simulated clock with time() and sleep()
+    self.clock = clock
+    self.admin_pw = admin_pw
+    self.api = CgminerClient()
+    # ssh connections may be shared between the tuners of a fleet
+    self.ssh = ssh or SSHPool()
+    self.last_ssh_timing = None
+    # assume batch and agent support until the sv binary on the miner proves otherwise
+    self.sv_batch = True
+    self.sv_agent = True
+    self.agent = None
+    self.skip_chain = skip_chain or []
+    # prefix output with the miner ip, used when several miners share stdout
+    self.tag = tag
+    self.install_flag = False
+    self.chain_hist = {}
+    # error rates seen per (frequency, chain, voltage), kept on disk if kb_dir is set
+    self.outcomes = None
+    if kb_dir:
+      self.outcomes = self.load_knowledge(kb_path(kb_dir, ip))
+    if self.outcomes is None:
+      self.outcomes = OutcomeIndex()
+    self.current_voltage = []
+    # voltages as last set or read, only read from the miner when in doubt
+    self.vcache = VoltageCache(verify_interval)
+    self.current_stats = None
+    # decides when to sample and which chains to change, the classic fixed
+    # schedule if fixed is set
+    chains = [i for i in range(4) if str(i+1) not in self.skip_chain]
+    if fixed:
+      self.schedule = FixedSchedule(chains, MAX_ERR_RATE, REPEAT, TUNE_REPEAT)
+    else:
+      self.schedule = AdaptiveSchedule(chains, MAX_ERR_RATE, TUNE_REPEAT)
+    self.schedule_freq = None
+    self.start_time = 0
+    # picks the voltage to try next once the schedule decided to change a chain
+    self.search = SEARCHES[search](MAX_ERR_RATE, int(MAX_VOLTAGE,16), 254, self.outcomes)
+    # tunes each frequency of ladder in turn and ends at the most efficient one
+    self.sweep = None
+    if ladder:
+      self.sweep = FrequencySweep(ladder, power, MAX_ERR_RATE, int(MAX_VOLTAGE,16))
+    self.switched = 0
+    # final voltages of the finished tunes of the fleet, chains start from them
+    self.priors = priors
+    # chain -> (prior code, code before it, timestamp) while a chain started
+    # from the priors can still be rolled back
+    self.prior_watch = {}
+    self.rollbacks = 0
+    # held for a tuning cycle or the reaction to a fault the watchdog saw
+    self.lock = threading.Lock()
+    # phase timings and chain values, shared by the tuners of a fleet
+    self.metrics = metrics or Metrics()
+    # samples are appended to an export file as they come in, unless export is None
+    self.export_format = export
+    self.export = None
+    self.export_path = None
+    self.export_failures = 0
+    self.cycle_count = 0
+    self.now = 0
+    self.started = False
+    self.finished = False
+    self.failed = None
+
+  def log(self, msg):
+    """Print a message, prefixed with our ip in fleet mode"""
+    if self.tag:
+      msg = "\n".join(["[%s] %s" %(self.ip, l) for l in str(msg).split("\n")])
+    print_lock.acquire()
+    try:
+      # one write, so lines of shard processes sharing stdout do not interleave
+      sys.stdout.write("%s\n" %msg)
+      sys.stdout.flush()
+    finally:
+      print_lock.release()
+
+  def get_minerstats(self):
+    """Get all stats from miner API"""
+    try:
+      return self.api.stats(self.ip, self.api_port).as_dict()
+    except ApiError, e:
+      raise TuneError(str(e))
+
+  def load_knowledge(self, path):
+    """Open the knowledge file of this miner, returns None if it is unusable"""
+    try:
+      kb = KnowledgeBase(path)
+    except (KnowledgeError, IOError, OSError), e:
+      self.log("Not using knowledge file: %s" %e)
+      return None
+    if kb.outcomes:
+      self.log("Loaded %i known voltage outcomes from %s" %(len(kb.outcomes), path))
+    return kb
+
+  def save_knowledge(self):
+    """Write new outcomes to the knowledge file, if there is one"""
+    if not isinstance(self.outcomes, KnowledgeBase):
+      return
+    try:
+      self.outcomes.flush()
+    except (IOError, OSError), e:
+      self.log("Failed writing knowledge file: %s" %e)
+
+  ###############
+  # SSH FUNCTIONS
+  ###############
+  def ssh_exec(self, cmd, data=None):
+    """Run cmd on the miner over the pooled ssh connection, returns (stdout, stderr)"""
+    try:
+      return self.ssh.run(self.ip, self.admin_pw, cmd, data)
+    except paramiko.AuthenticationException, e:
+      raise TuneError("Authentication to %s failed:\n%s" %(self.ip, e))
+    except (socket.error, paramiko.SSHException, EOFError), e:
+      raise TuneError("Failed to connect to %s via ssh:\n%s" %(self.ip, e))
+
+  def ssh_timing(self):
+    """Summarize ssh handshakes and commands since the last call"""
+    t = self.ssh.timings(self.ip)
+    last = self.last_ssh_timing or dict.fromkeys(t.keys(), 0)
+    self.last_ssh_timing = t
+    handshakes = t['handshakes'] - last['handshakes']
+    commands = t['commands'] - last['commands']
+    rep = "SSH: %i cmds in %.2fs" %(commands, t['command_total'] - last['command_total'])
+    if handshakes:
+      rep += ", %i handshake(s) in %.2fs" %(handshakes, t['handshake_total'] - last['handshake_total'])
+    return rep
+
+  def set_frequency(self, freq):
+    """Rewrite the frequency in the cgminer config and restart cgminer"""
+    self.log("Switching to %s MHz, restarting cgminer" %freq)
+    res, err = self.ssh_exec(SET_FREQ_CMD %freq)
+    if len(err) > 0:
+      raise TuneError("Failed to set frequency %s MHz:\n%s" %(freq, err))
+    self.sweep.target = freq
+    self.switched = self.clock.time()
+    # the PICs may come up at their default voltages
+    self.vcache.invalidate("frequency changed")
+    # the cycle limit applies per frequency
+    self.cycle_count = 0
+    self.start_time = int(self.clock.time())
+
+  def agent_request(self, cmd):
+    """Run cmd on the resident sv agent, returns (ok, reply lines) or None if
+    the agent can not be used and the caller has to exec the sv binary"""
+    if not self.sv_agent:
+      return None
+    if self.agent is None:
+      self.agent = SvAgent(self.ssh, self.ip, self.admin_pw, SETV_BIN)
+    try:
+      return self.agent.request(cmd)
+    except AgentUnsupported, e:
+      self.log("%s, running the binary for every command" %e)
+      self.sv_agent = False
+    except AgentError, e:
+      self.log("sv agent failed, running the binary instead: %s" %e)
+    except paramiko.AuthenticationException, e:
+      raise TuneError("Authentication to %s failed:\n%s" %(self.ip, e))
+    except (socket.error, paramiko.SSHException, EOFError), e:
+      raise TuneError("Failed to connect to %s via ssh:\n%s" %(self.ip, e))
+    return None
+
+  def get_voltage(self, chain=False):
+    """Get voltage remotely, returns a list with errors of each of the 4 chains"""
+    cur_voltage = []
+    reply = self.agent_request("get")
+    if reply is not None:
+      ok, lines = reply
+      if not ok:
+        raise TuneError("Failed reading voltages from sv agent:\n%s" %"\n".join(lines))
+      for line in lines:
+        if line.startswith("chain"):
+          cur_voltage.append(line.split('=')[1].strip())
+      return cur_voltage
+    res, err = self.ssh_exec(SETV_BIN)
+    # a shell error ocurred on the miner:
+    if len(err) > 0:
+      if err.endswith(": not found\n"):
+        self.log("%s binary not found on target miner, installing it first:" %SETV_BIN)
+        return self.install_sv_bin()
+      else:
+        raise TuneError("Undefined errors occured fetching voltage settings from miner:\n%s\nAborting." %err)
+    for line in res.split('\n'):
+      if line.strip().find("chain", 0) > -1:
+        cur_voltage.append(line.split('=')[1].strip())
+    return cur_voltage
+
+  def cached_voltage(self, stats, ts):
+    """Voltages of all chains from the cache, read from the miner if the
+    cache is due for a check or the stats look like it could be wrong"""
+    reason = self.vcache.check(stats, ts)
+    if reason is None:
+      return list(self.vcache.voltages)
+    voltages = self.get_voltage()
+    self.metrics.inc('voltage_reads_total', miner=self.ip)
+    cached = self.vcache.voltages
+    if cached is not None and [int(v, 16) for v in voltages] != [int(v, 16) for v in cached]:
+      self.log("Voltages changed to %s, expected %s (%s)" %(" ".join(voltages), " ".join(cached), reason))
+    self.vcache.fill(voltages, ts)
+    return voltages
+
+  def limit_voltage(self, voltage):
+    """Clamp voltage to the MAX_VOLTAGE..0xfe range"""
+    if int(voltage,16) <= int(MAX_VOLTAGE,16):
+      self.log("Limiting voltage to MAX_VOLTAGE (%s)" %MAX_VOLTAGE)
+      voltage = MAX_VOLTAGE    
+    elif int(voltage,16) > 254:
+      self.log("Limiting undervolt to max 254 (0xfe)")
+      voltage = '0xfe'
+    return voltage
+
+  def set_voltage(self, chain, voltage):
+    """Set voltages remotely"""
+    #print voltage, type(voltage), int(voltage,16)
+    voltage = self.limit_voltage(voltage)
+    this_voltage = []
+    v_cmd = SETV_BIN + " " + str(chain) + " " + str(voltage)
+    res, err = self.ssh_exec(v_cmd)
+    for line in res.split('\n'):
+      if line.strip().find("voltage =", 0) > -1:
+        this_voltage.append(line.split('=')[1].strip())
+    return this_voltage
+
+  def set_voltages(self, voltages):
+    """Set voltages of several chains in one remote call, voltages maps chain (1-4) to
+    hex voltage. Returns a dict of chain to [old voltage, new voltage]"""
+    results = {}
+    pairs = " ".join(["%i:%s" %(c, self.limit_voltage(v)) for c, v in sorted(voltages.items())])
+    reply = self.agent_request("set " + pairs)
+    if reply is not None:
+      ok, lines = reply
+      results = self.parse_set_reply(lines)
+      if not ok:
+        if not results:
+          raise TuneError("Failed setting voltages with sv agent:\n%s" %"\n".join(lines))
+        self.log("sv agent failed to set some chains: %s" %lines[-1])
+      return results
+    if self.sv_batch:
+      res, err = self.ssh_exec(SETV_BIN + " batch " + pairs)
+      if res.find("Invalid chain #") > -1:
+        # binary on the miner predates batch mode
+        self.log("%s does not support batch mode, setting chains one by one" %SETV_BIN)
+        self.sv_batch = False
+      else:
+        return self.parse_set_reply(res.split('\n'))
+    for c, v in sorted(voltages.items()):
+      results[c] = self.set_voltage(c, v)
+    return results
     
-  miner_stats['speed'] = [resp['STATS'][1]['GHS av'], resp['STATS'][1]['GHS 5s']]
-  miner_stats['uptime'] = resp['STATS'][1]['Elapsed']
-  miner_stats['frequency'] = resp['STATS'][1]['frequency']
-  miner_stats['device_error'] = resp['STATS'][1]['Device Hardware%']
-  return miner_stats
-
-def get_voltage(ip, chain=False):
-  """Get voltage remotely, returns a list with errors of each of the 4 chains"""
-  cur_voltage = []
-  try:
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy( paramiko.AutoAddPolicy() )
-    client.load_system_host_keys()
-    client.connect(ip, port=22, username='root', password=admin_pw)
-    stdin, stdout, stderr = client.exec_command(SETV_BIN)
-    res = stdout.read()
-    err = stderr.read()
-  except socket.error, e:
-    print "Failed to connect to %s via ssh:\n%s" %(ip, e)
-    sys.exit(1)
-  except paramiko.AuthenticationException, e:
-    print "Authentication to %s failed:\n%s" %(ip, e)
-    sys.exit(1)
-  # a shell error ocurred on the miner:
-  if len(err) > 0:
-    if err.endswith(": not found\n"):
-      print "%s binary not found on target miner, installing it first:" %SETV_BIN
-      install_sv_bin(ip, admin_pw, os.path.split(__file__)[0] + '/sv.txt')
+  def parse_set_reply(self, lines):
+    """Parse batch/agent set results into a dict of chain to [old voltage, new voltage]"""
+    results = {}
+    for line in lines:
+      # chain <n>: voltage = 0x<before> -> 0x<after> OK|ERROR
+      if line.startswith("chain") and line.find("->") > -1:
+        chain = int(line.split(':')[0].split()[1])
+        before, after = line.split('=')[1].split('->')
+        results[chain] = [before.strip(), after.split()[0]]
+        if not line.strip().endswith("OK"):
+          self.log("Failed to set voltage on chain %i: %s" %(chain, line))
+      elif line.startswith("chain") and line.find("ERROR") > -1:
+        self.log("Failed to set voltage: %s" %line)
+    return results
+
+  def install_sv_bin(self):
+    if self.install_flag:
+      raise TuneError("We have already tried (and failed) to install %s binary on the miner.\nPlease investigate before procedding!\nExiting.." %SETV_BIN)
+    self.install_flag = True
+    try:
+      deployer = Deployer(self.ssh, self.admin_pw, load_binary(SV_TXT, SETV_BIN_MD5), SETV_BIN)
+      deployer.deploy(self.ip)
+    except (DeployError, IOError), e:
+      raise TuneError("Something went wrong installing the %s binary, please check!\n%s" %(SETV_BIN, e))
+    except paramiko.AuthenticationException, e:
+      raise TuneError("Authentication to %s failed:\n%s" %(self.ip, e))
+    except (socket.error, paramiko.SSHException, EOFError), e:
+      raise TuneError("Failed to connect to %s via ssh:\n%s" %(self.ip, e))
+    self.log("MD5sum [%s] matches, good." %SETV_BIN_MD5)
+    self.log("Binary %s successfully installed." %SETV_BIN)
+    # Retry getting voltage 
+    return self.get_voltage()
+    
+  ###################
+  # HISTORY FUNCTIONS
+  ###################
+  def add_history(self, stats, voltage, ts):
+    """Add records to history structure"""
+    if len(stats['chainrate']) != 4 or len(voltage) != 4:
+      raise TuneError("Invalid boards read, aborted!\n%i %i" %(len(stats), len(voltage)))
+    if not self.chain_hist.has_key(stats['frequency']):
+      # samples of the last tuning round are still settling, keep them out of the outcomes
+      self.chain_hist[stats['frequency']] = ChainHistory(stats['frequency'], HIST_MAX_LEN,
+                                                         outcomes=self.outcomes, settle=TUNE_REPEAT)
+    self.chain_hist[stats['frequency']].push(stats, voltage, ts)
+    self.export_sample(self.chain_hist[stats['frequency']])
+
+  def export_sample(self, hist):
+    """Append the latest sample of hist to the export file"""
+    if not self.export_format:
+      return
+    try:
+      if self.export is None:
+        self.export = open_export(self.export_format, "%s-" %self.ip)
+        self.export_path = self.export.path
+        self.log("Exporting samples to %s" %self.export_path)
+      self.export.write(history_record(hist))
+      self.export_failures = 0
+    except (IOError, OSError), e:
+      self.metrics.inc('export_failures_total', miner=self.ip)
+      self.export_failures += 1
+      if self.export_failures < EXPORT_MAX_FAILURES:
+        self.log("Failed writing export file, sample not exported: %s" %e)
+      else:
+        self.log("Failed writing export file %i times in a row, not exporting samples anymore: %s"
+                 %(self.export_failures, e))
+        self.export_format = None
+    
+  def process_history(self, freq):
+    """Print the error rates computed by the history over each window"""
+    hist = self.chain_hist[freq]
+    if len(hist) < 2:
+      return
+    rates = hist.rates
+    rows = [("Errors/min (%imin)" %(w / 60), hist.get(rate_field(w)), rates.counts[k]) for k, w in enumerate(rates.windows)]
+    rows.append(("Errors/min (all)", hist.get('error_rate'), rates.total))
+    temp_chip = hist.get('temp_chip')
+    current_voltage = self.current_voltage
+    rep = "| %s [%s] |  %i  |  %i  |  %i  |  %i  |\n" %(self.ip.ljust(12)[:12], freq, temp_chip[0], temp_chip[1], temp_chip[2], temp_chip[3]) + \
+      "+ Current voltages   + %s + %s + %s + %s +" %(current_voltage[0], current_voltage[1], current_voltage[2], current_voltage[3])
+    for label, avg, err in rows:
+      rep += "\n|%-20s| %.2f | %.2f | %.2f | %.2f | %i %i %i %i |" \
+        %(label, avg[0], avg[1], avg[2], avg[3], err[0], err[1], err[2], err[3])
+    self.log(rep)
+    
+  def voltage_history(self, freq, chain, voltage):
+    """lookup if a result exists with same freq/voltage combination and return the error rate"""
+    outcome = self.outcomes.lookup(freq, chain, int(voltage, 16))
+    tested = outcome is not None
+    e5avg, e10avg, e15avg = tested and outcome.means() or (0, 0, 0)
+    if tested: self.log("We have tried voltage %s already, errors: %s %s %s" %(voltage, e5avg, e10avg, e15avg))
+    if (e5avg+e10avg)/2 > MAX_ERR_RATE:
+      self.log("Voltage setting of %s not recommended, past error avg (5/10/15min avg): %02.f %02.f %02.f" %(voltage, e5avg, e10avg, e15avg))
+      return False
+    self.log("Voltage setting of %s good to test." %(voltage, ))
+    return True
+
+  ###################
+  # TUNING FUNCTIONS
+  ###################
+  def adjust_voltage(self, freq, actions):
+    """apply the RAISE/LOWER decisions of the schedule, actions maps chain index to decision"""
+    chain_hist = self.chain_hist
+    changes = {}
+    for i in sorted(actions.keys()):
+      # Voltage needs to go up
+      if actions[i] == RAISE:
+        if chain_hist[freq].get('voltage')[i] > int(MAX_VOLTAGE,16):
+          self.log("Chain %i needs more voltage (%.2f err/m)" %(i+1, chain_hist[freq].get('error_rate5')[i]))
+          new_voltage = self.inc_voltage(freq, i)
+          if new_voltage:
+            changes[i+1] = ("Overvolted", new_voltage)
+        else:
+          self.log("Skipped chain %i, max overvolt reached, tune manually if you dare!!" %(i+1,))
+      # Voltage can be tuned down more
+      else:
+        if chain_hist[freq].get('voltage')[i] < 254:
+          self.log("Chain %i can be undervolted more (%.2f err/m)" %(i+1, chain_hist[freq].get('error_rate10')[i]))
+          new_voltage = self.dec_voltage(freq, i)
+          if new_voltage:
+            changes[i+1] = ("Undervolted", new_voltage)
+        else:
+          self.log("Skipped chain %i, max undervolt reached." %(i+1,))
+      if not changes.has_key(i+1):
+        self.schedule.unchanged(i, int(self.now), chain_hist[freq].rates.errors())
+    if not changes:
+      return
+    # apply all chain changes in one go
+    results = self.set_voltages(dict([(c, v[1]) for c, v in changes.items()]))
+    for c in sorted(changes.keys()):
+      self.schedule.changed(c-1, int(self.clock.time()), chain_hist[freq].rates.errors())
+      if results.has_key(c) and len(results[c]) == 2:
+        self.vcache.update(c, results[c][1])
+      else:
+        self.vcache.invalidate("no result of setting chain %i" %c)
+      result = results.get(c, ['?', '?'])
+      self.log("%s chain %i from %s to %s" %(changes[c][0], c, result[0], result[1]))
+    
+  def observe(self, freq, chain):
+    """Observation of the current voltage of chain for the search strategy"""
+    hist = self.chain_hist[freq]
+    count, seconds = self.schedule.exposure(chain, int(self.now), hist.rates.errors())
+    return Observation(hist.get('error_rate5')[chain], hist.get('error_rate10')[chain], hist.get('error_rate15')[chain],
+                       count, seconds, self.schedule.since[chain][0])
+
+  def dec_voltage(self, freq, chain):
+    """decrease voltage on chain, returns the new voltage to set or None"""
+    chain_hist = self.chain_hist
+    current_voltage = self.current_voltage
+    current = int(current_voltage[chain], 16)
+    new_voltage = self.search.lower_voltage(freq, chain, current, self.observe(freq, chain),
+                                            lambda v: self.voltage_history(freq, chain, hex(v)))
+    if current < 254 and new_voltage is not None and new_voltage != current:
+      result = hex(new_voltage)
+      current_voltage[chain] = result
     else:
-      print "Undefined errors occured fetching voltage settings from miner:\n%s" %err
-      print "Aborting."
-      sys.exit(1)
-  for line in res.split('\n'):
-    if line.strip().find("chain", 0) > -1:
-      cur_voltage.append(line.split('=')[1].strip())
-  client.close()  
-  return cur_voltage
-
-
-def set_voltage(ip, chain, voltage):
-  """Set voltages remotely"""
-  #print voltage, type(voltage), int(voltage,16)
-  if int(voltage,16) <= int(MAX_VOLTAGE,16):
-    print "Limiting voltage to MAX_VOLTAGE (%s)" %MAX_VOLTAGE
-    voltage = MAX_VOLTAGE    
-  elif int(voltage,16) > 254:
-    print "Limiting undervolt to max 254 (0xfe)"
-    voltage = '0xfe'
-  this_voltage = []
-  v_cmd = SETV_BIN + " " + str(chain) + " " + str(voltage)
-  client = paramiko.SSHClient()
-  client.set_missing_host_key_policy( paramiko.AutoAddPolicy() )
-  client.load_system_host_keys()
-  client.connect(ip, port=22, username='root', password=admin_pw)
-  stdin, stdout, stderr = client.exec_command(v_cmd)
-  res = stdout.read()
-  for line in res.split('\n'):
-    if line.strip().find("voltage =", 0) > -1:
-      this_voltage.append(line.split('=')[1].strip())
-  client.close()  
-  return this_voltage
-  
-def install_sv_bin(ip, pw, ascii_file):
-  global install_flag
-  if install_flag:
-    print "We have already tried (and failed) to install %s binary on the miner.\nPlease investigate before procedding!"
-    print "Exiting.."
-    sys.exit(1)
+      self.log("Aborted further decrease of voltage, chain %i is already at %s" %(chain+1, hex(chain_hist[freq].get('voltage')[chain])))
+      result = None
+    return result
+    
+  def inc_voltage(self, freq, chain):
+    """increase voltage on chain, returns the new voltage to set or None"""
+    chain_hist = self.chain_hist
+    current_voltage = self.current_voltage
+    current = int(current_voltage[chain], 16)
+    new_voltage = self.search.raise_voltage(freq, chain, current, self.observe(freq, chain),
+                                            lambda v: self.voltage_history(freq, chain, hex(v)))
+    if current > int(MAX_VOLTAGE,16) and new_voltage is not None and new_voltage != current:
+      result = hex(new_voltage)
+      current_voltage[chain] = result
+    else:
+      self.log("Aborted further increase of voltage, chain %i is already at %s" %(chain+1, hex(chain_hist[freq].get('voltage')[chain])))
+      result = None
+    return result
 
-  client = paramiko.SSHClient()
-  client.set_missing_host_key_policy( paramiko.AutoAddPolicy() )
-  client.load_system_host_keys()
-  client.connect(ip, port=22, username='root', password=admin_pw)
-  #i_cmd = "echo '%s' > /config/sv.asc" %txt
-  i_cmd = "cat > /config/sv.asc"
-  fh = open(ascii_file, 'r')
-  txt = fh.read()
-  fh.close()
-  stdin, stdout, stderr = client.exec_command(i_cmd)
-  stdin.write(txt)
-  i_cmd = "perl -ape '$_=pack \"(H2)*\", @F' /config/sv.asc > %s" %SETV_BIN
-  stdin, stdout, stderr = client.exec_command(i_cmd)
-  res = stdout.read()
-  err = stderr.read()
-  if len(err) > 0:
-    print "Something went wrong installing the %s binary, please check!" %SETV_BIN
-    sys.exit(1)
-  i_cmd = "rm /config/sv.asc && chmod 750 %s && md5sum %s" %(SETV_BIN, SETV_BIN)
-  stdin, stdout, stderr = client.exec_command(i_cmd)
-  res = stdout.read()
-  err = stderr.read()
-  if len(err) > 0:
-    print "Something went wrong installing the %s binary, please check!" %SETV_BIN
-    sys.exit(1)
-  if res.split(" ")[0].strip() != SETV_BIN_MD5:
-    print "MD5sum does not match:\n%s\nAborting" %res.split(" ")[0].strip()
-    sys.exit(1)
-  else:
-    print "MD5sum [%s] matches, good." %res.split(" ")[0].strip()
-  print "Binary %s successfully installed." %SETV_BIN
-  install_flag = True
-  client.close() 
-  # Retry getting voltage 
-  get_voltage(ip)
-  
-  
-###################
-# HISTORY FUNCTIONS
-###################
-def add_history(stats, voltage, ts):
-  """Add records to history structure"""
-  if len(stats['chainrate']) != 4 or len(voltage) != 4:
-    print "Invalid boards read, aborted!"
-    print len(stats), len(voltage)
-    sys.exit(1)
-  stats['voltage'] = voltage
-  stats['timestamp'] = ts
-  if not chain_hist.has_key(stats['frequency']):
-    chain_hist[stats['frequency']] = []  
-  chain_hist[stats['frequency']].append(stats)
-  
-def process_history(freq):
-  """Process history structure"""
-  global chain_hist
-  min5_err = []
-  min10_err = []
-  min15_err = []
-  min_err = []
-  if len(chain_hist[freq]) < 2:
-    chain_hist[freq][-1]['error_rate5'] = [0, 0, 0, 0]
-    chain_hist[freq][-1]['error_rate10'] = [0, 0, 0, 0]
-    chain_hist[freq][-1]['error_rate15'] = [0, 0, 0, 0]
-    chain_hist[freq][-1]['error_rate'] = [0, 0, 0, 0]
-    return
-  else:
-    arr_end = len(chain_hist[freq]) - 1
-
-  for i in range(0,4):
-    min5_errors = chain_hist[freq][arr_end]['err'][i] - chain_hist[freq][max( 0, (arr_end - LEN5MIN) )]['err'][i]
-    min5_err.append(min5_errors)
-    min10_errors = chain_hist[freq][arr_end]['err'][i] - chain_hist[freq][max(0, (arr_end - LEN10MIN))]['err'][i]
-    min10_err.append(min10_errors)
-    min15_errors = chain_hist[freq][arr_end]['err'][i] - chain_hist[freq][max(0, (arr_end - LEN15MIN))]['err'][i]
-    min15_err.append(min15_errors)
-    min_err.append(chain_hist[freq][-1]['err'][i] - chain_hist[freq][0]['err'][i])    
-
-  arr_start5 = max(0, arr_end - LEN5MIN)
-  arr_start10 = max(0, arr_end - LEN10MIN)
-  arr_start15 = max(0, arr_end - LEN15MIN)
-  timediff5 = chain_hist[freq][arr_end]['timestamp'] - chain_hist[freq][arr_start5]['timestamp']
-  timediff10 = chain_hist[freq][arr_end]['timestamp'] - chain_hist[freq][arr_start10]['timestamp']
-  timediff15 = chain_hist[freq][arr_end]['timestamp'] - chain_hist[freq][arr_start15]['timestamp']
-  timediff = chain_hist[freq][-1]['timestamp'] - chain_hist[freq][0]['timestamp']
-
-  #print "Arr_start, Arr_end:", arr_start5, arr_end, arr_start10, arr_end, arr_start15, arr_end
-  #print "Arr_start (raw):", arr_end - (5*60)/REPEAT, arr_end - (10*60)/REPEAT, arr_end - (15*60)/REPEAT
-  #print "Error time1, time2, time3, time:", timediff5, timediff10, timediff15, timediff
-  
-  f1 = lambda err: float(err) / timediff5*60
-  f2 = lambda err: float(err) / timediff10*60
-  f3 = lambda err: float(err) / timediff15*60
-  f4 = lambda err: float(err) / timediff*60
-  min5_avg = map(f1, min5_err)
-  min10_avg = map(f2, min10_err)
-  min15_avg = map(f3, min15_err)
-  all_avg = map(f4, min_err)
-  chain_hist[freq][-1]['error_rate5'] = min5_avg
-  chain_hist[freq][-1]['error_rate10'] = min10_avg
-  chain_hist[freq][-1]['error_rate15'] = min15_avg
-  chain_hist[freq][-1]['error_rate'] = all_avg
-  #print "Errors:", min5_err, min10_err, min15_err, min_err  
-  temp_chip = chain_hist[freq][-1]['temp_chip']
-  print "| %s [%s] |  %i  |  %i  |  %i  |  %i  |" %(miner_ip.ljust(12)[:12], freq, temp_chip[0], temp_chip[1], temp_chip[2], temp_chip[3])
-  print "+ Current voltages   + %s + %s + %s + %s +" %(current_voltage[0], current_voltage[1], current_voltage[2], current_voltage[3])
-  print "|Errors/min (5min)   | %.2f | %.2f | %.2f | %.2f | %i %i %i %i |" \
-	%(min5_avg[0], min5_avg[1], min5_avg[2], min5_avg[3], min5_err[0], min5_err[1], min5_err[2], min5_err[3])
-  print "|Errors/min (10min)  | %.2f | %.2f | %.2f | %.2f | %i %i %i %i |" \
-	%(min10_avg[0], min10_avg[1], min10_avg[2], min10_avg[3], min10_err[0], min10_err[1], min10_err[2], min10_err[3])
-  print "|Errors/min (15min)  | %.2f | %.2f | %.2f | %.2f | %i %i %i %i |" \
-	%(min15_avg[0], min15_avg[1], min15_avg[2], min15_avg[3], min15_err[0], min15_err[1], min15_err[2], min15_err[3])
-  print "|Errors/min (all)    | %.2f | %.2f | %.2f | %.2f | %i %i %i %i |" \
-	%(all_avg[0], all_avg[1], all_avg[2], all_avg[3], min_err[0], min_err[1], min_err[2], min_err[3])
-  
-
-def voltage_history(freq, chain, voltage):
-  """lookup if a result exists with same freq/voltage combination and return the error rate"""
-  errors5 = []
-  errors10 = []
-  errors15 = []
-  tested = False;
-  for r in chain_hist[freq][:-(TUNE_REPEAT/REPEAT)]:
-    if r['voltage'][chain] == voltage:
-      errors5.append(r['error_rate5'][chain])
-      errors10.append(r['error_rate10'][chain])
-      errors15.append(r['error_rate15'][chain])
-      tested = True
-  if sum(errors5) > 0: 
-    e5avg = sum(errors5) / len(errors5)
-  else:
-    e5avg = 0
-  if sum(errors10) > 0:
-    e10avg = sum(errors10) / len(errors10)
-  else:
-    e10avg = 0
-  if sum(errors15) > 0:
-    e15avg = sum(errors15) / len(errors15)
-  else:
-    e15avg = 0
-  if tested: print "We have tried voltage %s already, errors:" %voltage, e5avg, e10avg, e15avg
-  if (e5avg+e10avg)/2 > MAX_ERR_RATE:
-    print "Voltage setting of %s not recommended, past error avg (5/10/15min avg): %02.f %02.f %02.f" %(voltage, e5avg, e10avg, e15avg)
-    return False
-  print "Voltage setting of %s good to test." %(voltage, )
-  return True
-
-
-###################
-# TUNING FUNCTIONS
-###################
-def adjust_voltage(freq):
-  """decide on what to adjust"""
-  for i in range(0,4):
-    if str(i+1) in skip_chain:
-      print "Chain %i has been excluded by commandline option %s" %(i+1, sys.argv[3])
-      continue
-    # Voltage needs to go up
-    if chain_hist[freq][-1]['error_rate5'][i] > MAX_ERR_RATE:
-      if int(chain_hist[freq][-1]['voltage'][i],16) > int(MAX_VOLTAGE,16):
-        print "Chain %i needs more voltage (%.2f err/m)" %(i+1, chain_hist[freq][-1]['error_rate5'][i])
-        result = inc_voltage(freq, i)
-        print "Overvolted chain %i from %s to %s" %(i+1, result[0], result[1])
+  def check_minerstatus(self, freq):
+    """check for errors on chain or overtemp"""
+    for i in range(0,4):
+      #print chain_hist[freq].get('asic_status')[i]
+      if self.chain_hist[freq].get('asic_status')[i].find('x') > -1:
+        self.log("Chain %i has disconnected chips, please check:\n %s" %(i+1, self.chain_hist[freq].get('asic_status')[i]))
+
+  ###################
+  # MAIN LOOP
+  ###################
+  def start(self):
+    """Read initial voltages and reset the tuning clocks"""
+    self.started = True
+    self.current_voltage = self.get_voltage()
+    self.vcache.fill(self.current_voltage, int(self.clock.time()))
+    self.start_time = int(self.clock.time())
+    self.schedule_freq = None
+    self.cycle_count = 0
+    if self.sweep is not None:
+      first = self.sweep.next_frequency()
+      if self.get_minerstats()['frequency'] != first:
+        self.set_frequency(first)
+    elif self.priors is not None:
+      self.apply_priors(self.get_minerstats())
+    for c in self.skip_chain:
+      self.log("Chain %s has been excluded by commandline option --skip" %c)
+
+  def apply_priors(self, stats):
+    """Start chains at the voltage finished siblings suggest, if that is lower
+    than the current one and not known to be bad for this miner"""
+    freq = stats['frequency']
+    current = dict([(c, int(self.current_voltage[c], 16)) for c in self.schedule.chains])
+    changes = {}
+    for c in self.schedule.chains:
+      prior = self.priors.start_code(stats.get('firmware'), freq, c)
+      if prior is None:
+        continue
+      code, tunes = max(int(MAX_VOLTAGE,16), min(254, prior[0])), prior[1]
+      if code <= current[c] or not self.voltage_history(freq, c, hex(code)):
+        continue
+      self.log("Starting chain %i at %s instead of %s, from %i finished tunes" %(c+1, hex(code), hex(current[c]), tunes))
+      changes[c+1] = hex(code)
+    if not changes:
+      return
+    results = self.set_voltages(changes)
+    for c in sorted(changes.keys()):
+      if results.has_key(c) and len(results[c]) == 2:
+        self.vcache.update(c, results[c][1])
+        self.current_voltage[c-1] = results[c][1]
+        self.prior_watch[c-1] = (int(results[c][1], 16), current[c-1], int(self.clock.time()))
       else:
-        print "Skipped chain %i, max overvolt reached, tune manually if you dare!!" %(i+1,)
-    # Voltage can be tuned down more
-    elif chain_hist[freq][-1]['error_rate10'][i] == 0 and chain_hist[freq][-1]['error_rate15'][i] < MAX_ERR_RATE * 0.75 \
-        and (int(now) - chain_hist[current_stats['frequency']][0]['timestamp']) > 600:
-      if int(chain_hist[freq][-1]['voltage'][i],16) < 254:
-        print "Chain %i can be undervolted more (%.2f err/m)" %(i+1, chain_hist[freq][-1]['error_rate10'][i])
-        result = dec_voltage(freq, i)
-        print "Undervolted chain %i from %s to %s" %(i+1, result[0], result[1])
+        self.vcache.invalidate("no result of setting chain %i" %c)
+
+  def check_priors(self, freq, ts):
+    """Roll chains started from the priors straight back to their old voltage
+    once they are confidently over the error limit, instead of raising them
+    step by step"""
+    errors = self.chain_hist[freq].rates.errors()
+    rollback = {}
+    for c in sorted(self.prior_watch.keys()):
+      code, old, since = self.prior_watch[c]
+      if int(self.current_voltage[c], 16) != code or ts - since > PRIOR_WATCH:
+        # changed by the schedule since, or fine
+        del self.prior_watch[c]
+        continue
+      count, seconds = self.schedule.exposure(c, ts, errors)
+      if rate_interval(count, seconds)[0] > MAX_ERR_RATE:
+        rollback[c+1] = hex(old)
+    if not rollback:
+      return
+    results = self.set_voltages(rollback)
+    for c in sorted(rollback.keys()):
+      self.schedule.changed(c-1, ts, errors)
+      if results.has_key(c) and len(results[c]) == 2:
+        self.vcache.update(c, results[c][1])
+        self.current_voltage[c-1] = results[c][1]
       else:
-        print "Skipped chain %i, max undervolt reached." %(i+1,)
-  
-
-def dec_voltage(freq, chain):
-  """decrease voltage on chain"""
-  global current_voltage, last_change
-  voltage_step =  min( int(0.35 / ( chain_hist[freq][-1]['error_rate15'][chain] + 0.01 ) ), 7)
-  new_voltage = int(current_voltage[chain], 16) + voltage_step
-  new_voltage = min(new_voltage, 254)
-  while not voltage_history(freq, chain, hex(new_voltage)) and new_voltage > int(current_voltage[chain], 16):
-    print "DEBUG:", voltage_history(freq, chain, hex(new_voltage)), new_voltage, int(current_voltage[chain], 16)
-    new_voltage = new_voltage - 1
-  #print "Voltage history for this voltage/freq/chain:", voltage_history(freq, chain, hex(new_voltage))
-  #print "Current/new voltage on chain %i: %s / %s" %(chain+1, chain_hist[freq][-1]['voltage'][chain], hex(new_voltage))
-  if int(current_voltage[chain], 16) < 254 and current_voltage != new_voltage:
-    voltage_result = set_voltage(miner_ip, chain+1, hex(new_voltage))
-    last_change = int(time.time())
-  else:
-    print "Aborted further decrease of voltage, chain %i is already at %s" %(chain+1, chain_hist[freq][-1]['voltage'][chain])
-    #new_voltage = int(chain_hist[freq][-1]['voltage'][chain],16)
-    voltage_result = [chain_hist[freq][-1]['voltage'][chain], chain_hist[freq][-1]['voltage'][chain]]
-  current_voltage[chain] = hex(new_voltage)
-  return voltage_result
-  
-
-def inc_voltage(freq, chain):
-  """increase voltage on chain"""
-  global current_voltage, last_change
-  voltage_step = max( int( chain_hist[freq][-1]['error_rate5'][chain] * (TUNE_REPEAT / 60) ), 2 )
-  # limit to voltage_step 7
-  voltage_step = min(voltage_step, 7)
-  new_voltage = int( current_voltage[chain], 16 ) - voltage_step
-  new_voltage = max( new_voltage, int(MAX_VOLTAGE,16) )
-  while not voltage_history(freq, chain, hex(new_voltage)) and new_voltage < int(current_voltage[chain], 16):
-    print "DEBUG:", voltage_history(freq, chain, hex(new_voltage)), new_voltage, int(current_voltage[chain], 16)
-    new_voltage = new_voltage + 1
-  #print "Voltage history for this voltage/freq/chain:", voltage_history(freq, chain, hex(new_voltage))  
-  #print "Current/new voltage on chain %i: %s / %s" %(chain+1, chain_hist[freq][-1]['voltage'][chain], hex(new_voltage))
-  if int(current_voltage[chain],16) == int(MAX_VOLTAGE,16) and current_voltage != new_voltage:
-    print "Aborted further increase of voltage, chain %i is already at %s" %(chain+1, chain_hist[freq][-1]['voltage'][chain])
-    #new_voltage = int(chain_hist[freq][-1]['voltage'][chain], 16)
-    voltage_result = [chain_hist[freq][-1]['voltage'][chain], chain_hist[freq][-1]['voltage'][chain]]
-  elif new_voltage >= int(MAX_VOLTAGE,16):
-    voltage_result = set_voltage(miner_ip, chain+1, hex(new_voltage))
-    last_change = int(time.time())
-  else: 
-    print "Aborted further increase of voltage, chain %i is already at %s" %(chain+1, chain_hist[freq][-1]['voltage'][chain])
-    #new_voltage = int(chain_hist[freq][-1]['voltage'][chain], 16)
-    voltage_result = [chain_hist[freq][-1]['voltage'][chain], chain_hist[freq][-1]['voltage'][chain]]
-  current_voltage[chain] = hex(new_voltage)
-  return voltage_result
-
-
-def check_minerstatus(freq):
-  """check for errors on chain or overtemp"""
-  for i in range(0,4):
-    #print chain_hist[freq][-1]['asic_status'][i]
-    if chain_hist[freq][-1]['asic_status'][i].find('x') > -1:
-      print "Chain %i has disconnected chips, please check:\n %s" %(i+1, chain_hist[freq][-1]['asic_status'][i])
+        self.vcache.invalidate("no result of setting chain %i" %c)
+      self.log("Rolled chain %i back from %s to %s, too many errors" %(c, hex(self.prior_watch[c-1][0]), rollback[c]))
+      self.metrics.inc('prior_rollbacks_total', miner=self.ip)
+      self.rollbacks += 1
+      del self.prior_watch[c-1]
+
+  def record_prior(self, freq):
+    """Add the voltages tuning ended at to the priors of the fleet"""
+    if self.priors is None:
+      return
+    codes = []
+    for c in range(4):
+      if c in self.schedule.chains:
+        codes.append(int(self.current_voltage[c], 16))
+      else:
+        codes.append(None)
+    try:
+      self.priors.add(self.ip, self.current_stats.get('firmware'), freq, codes)
+    except (IOError, OSError), e:
+      self.log("Failed writing priors: %s" %e)
+
+  def protect(self, stats, faults):
+    """React to the faults the watchdog saw in stats between two tuning
+    cycles, faults is a list of (chain index, fault, message). Chains that
+    lost chips or make errors fast get more voltage right away, hot ones are
+    only warned about as more voltage only makes them hotter. Returns the
+    chains that got more voltage."""
+    self.lock.acquire()
+    try:
+      freq = stats['frequency']
+      if self.finished or self.failed or freq != self.schedule_freq or \
+         (self.sweep is not None and self.sweep.target is not None):
+        # not tuning at this frequency (yet)
+        return []
+      actions = {}
+      for c, fault, msg in faults:
+        self.log("Watchdog: chain %i %s" %(c+1, msg))
+        self.metrics.inc('watchdog_faults_total', miner=self.ip, chain=str(c+1), fault=fault)
+        if fault != HOT and c in self.schedule.chains:
+          actions[c] = RAISE
+      if not actions:
+        return []
+      before = list(self.current_voltage)
+      try:
+        self.now = self.clock.time()
+        self.current_stats = stats
+        # the errors of the fault count against the voltage that made them
+        self.add_history(stats, self.current_voltage, int(self.now))
+        self.adjust_voltage(freq, actions)
+      except TuneError, e:
+        self.log("Watchdog failed to protect the chains: %s" %e)
+      return [c for c in sorted(actions.keys()) if self.current_voltage[c] != before[c]]
+    finally:
+      self.lock.release()
+
+  def step(self):
+    """Run one tuning cycle, returns seconds until the next cycle or None once finished"""
+    self.lock.acquire()
+    try:
+      return self.cycle()
+    finally:
+      self.lock.release()
+
+  def cycle(self):
+    if not self.started:
+      self.start()
+    now = self.now = self.clock.time()
+    timed = self.metrics.timed
+    # get error stats
+    if self.sweep is not None and self.sweep.target is not None:
+      current_stats = timed('minerstats', self.restarted_stats, now, miner=self.ip)
+      if current_stats is None:
+        return RESTART_POLL
+      if self.sweep.final is not None:
+        return self.apply_point(self.sweep.final)
+    else:
+      current_stats = timed('minerstats', self.get_minerstats, miner=self.ip)
+    self.current_stats = current_stats
+    freq = current_stats['frequency']
+    # get current voltage levels
+    self.current_voltage = timed('voltage', self.cached_voltage, current_stats, int(now), miner=self.ip)
+    # add to history
+    timed('add_history', self.add_history, current_stats, self.current_voltage, int(now), miner=self.ip)
+    # process history and calculate error/min for 5,10,15 and all
+    timed('process_history', self.process_history, freq, miner=self.ip)
+    # check miner status for errors
+    self.check_minerstatus(freq)
+    hist = self.chain_hist[freq]
+    if self.schedule_freq != freq:
+      # (re)start the schedule on the error counters of this frequency
+      self.schedule.start(int(now), hist.rates.errors())
+      self.schedule_freq = freq
+    if self.prior_watch:
+      self.check_priors(freq, int(now))
+    # let the schedule decide which chains to adjust
+    states = dict(self.schedule.state)
+    actions = self.schedule.decide(hist, int(now))
+    if actions:
+      timed('adjust_voltage', self.adjust_voltage, freq, actions, miner=self.ip)
+    for c in sorted(states.keys()):
+      state = self.schedule.state[c]
+      if state != states[c] and state in (LOCKED, STABLE):
+        self.log("Chain %i is %s at %s" %(c+1, state, self.current_voltage[c]))
+    self.publish(freq)
+    self.save_knowledge()
+    delay = self.schedule.next_sample(hist, int(now))
+    time_running = (int(self.clock.time()) - hist.get('timestamp', 0))
+    self.log(self.ssh_timing())
+    self.log("= Running since: %02i:%02i.%02i, now sleeping for %.1fs =" \
+      %(divmod(time_running,60*60)[0], divmod( divmod(time_running, 60*60)[1], 60 )[0], divmod( divmod(time_running, 60*60)[1], 60 )[1], delay - (self.clock.time()-now)))
+      
+    self.metrics.inc('cycles_total', miner=self.ip)
+    # if we are stable, exit
+    if self.schedule.stable(hist, int(now)):
+      if self.sweep is not None and self.next_frequency(hist):
+        return RESTART_POLL
+      self.record_prior(freq)
+      return self.finish("Finished tuning, miner stable AFAICS")
+    if self.cycle_count > MAX_CYCLE or now - self.start_time > MAX_CYCLE * REPEAT:
+      return self.finish("Reached maximum cycle limit of %i without getting stable enough results, aborting tuning." %self.cycle_count)
+    else:
+      self.cycle_count += 1
+    # sleep a while..
+    sleep_time = delay - (self.clock.time()-now)
+    if sleep_time < 0:
+      self.metrics.inc('cycle_overruns_total', miner=self.ip)
+      sleep_time = 5
+    self.metrics.observe('phase_seconds', sleep_time, phase='sleep', miner=self.ip)
+    return sleep_time
+
+  def finish(self, msg):
+    """Stop tuning with a final report, returns None like step() does then"""
+    self.close()
+    self.report_stats()
+    self.log(msg)
+    self.finished = True
+    self.metrics.set('finished', 1, miner=self.ip)
+    return None
+
+  def restarted_stats(self, now):
+    """Stats once cgminer runs at the frequency of the sweep again, None
+    while it is still restarting"""
+    try:
+      stats = self.get_minerstats()
+    except TuneError:
+      stats = None
+    if stats is not None and stats['frequency'] == self.sweep.target:
+      self.sweep.target = None
+      return stats
+    if now - self.switched > RESTART_TIMEOUT:
+      raise TuneError("Miner did not come back at %s MHz within %is" %(self.sweep.target, RESTART_TIMEOUT))
+    return None
+
+  def next_frequency(self, hist):
+    """Record the operating point reached at the frequency of hist and switch
+    to the next frequency of the sweep, or to the most efficient one once the
+    sweep is done. Returns False if there is nothing left to switch to."""
+    sweep = self.sweep
+    point = sweep.record(hist, self.outcomes, self.schedule.chains)
+    self.log("Operating point %s" %point)
+    self.metrics.set('efficiency_mh_per_joule', point.efficiency(), miner=self.ip, frequency=point.freq)
+    target = sweep.next_frequency()
+    if target is None:
+      best = sweep.best()
+      if best is None:
+        self.log("No frequency kept the error limit of %.2f errors/min" %MAX_ERR_RATE)
+        return False
+      self.log("Most efficient operating point %s" %best)
+      if best.freq == hist.frequency:
+        return False
+      sweep.final = best
+      target = best.freq
+    self.set_frequency(target)
+    return True
+
+  def apply_point(self, point):
+    """Set the voltages of the operating point the sweep ended at and finish"""
+    voltages = dict([(c+1, point.voltages()[c]) for c in self.schedule.chains])
+    results = self.set_voltages(voltages)
+    for c in sorted(voltages.keys()):
+      result = results.get(c, ['?', '?'])
+      self.log("Set chain %i from %s to %s" %(c, result[0], result[1]))
+    self.current_voltage = self.get_voltage()
+    self.vcache.fill(self.current_voltage, int(self.clock.time()))
+    self.record_prior(point.freq)
+    return self.finish("Finished tuning at %s MHz" %point.freq)
+
+  def publish(self, freq):
+    """Export the current per chain values to the metrics"""
+    hist = self.chain_hist[freq]
+    metrics = self.metrics
+    for c in range(4):
+      chain = str(c+1)
+      for w in hist.rates.windows:
+        metrics.set('chain_error_rate', hist.get(rate_field(w))[c], miner=self.ip, chain=chain, window='%im' %(w / 60))
+      metrics.set('chain_temperature_celsius', hist.get('temp_chip')[c], miner=self.ip, chain=chain)
+      metrics.set('chain_voltage_code', int(self.current_voltage[c], 16), miner=self.ip, chain=chain)
+      metrics.set('chain_rate_mhs', self.current_stats['chainrate'][c], miner=self.ip, chain=chain)
+      if self.schedule.state.has_key(c):
+        for state in (SETTLING, PROBING, LOCKED, STABLE):
+          metrics.set('chain_state', int(self.schedule.state[c] == state), miner=self.ip, chain=chain, state=state)
+
+  def close(self):
+    """Stop the sv agent on the miner and save what we learned"""
+    self.save_knowledge()
+    if self.agent is not None:
+      self.agent.close()
+      self.agent = None
+
+  def run(self):
+    """Tune this miner until it is stable, blocking"""
+    while True:
+      sleep_time = self.step()
+      if sleep_time is None:
+        break
+      self.clock.sleep(sleep_time)
+
+  def report_lines(self):
+    """The human readable summary of the history, one line at a time. Single
+    samples are only in the export file, so its size does not depend on how
+    long tuning took."""
+    yield "Stats report:"
+    yield "*************"
+    for f in self.chain_hist.keys():
+      hist = self.chain_hist[f]
+      sd = datetime.fromtimestamp(hist.get('timestamp', 0))
+      ed = datetime.fromtimestamp(hist.get('timestamp'))
+      yield "Freq: %s:" %f
+      yield "========="
+      if self.export_path:
+        yield "%i samples, exported to %s" %(len(hist), self.export_path)
+      else:
+        yield "%i samples" %len(hist)
+      yield "*"*50
+      yield "| Start %2i:%02i.%02i | %s | %s | %s | %s |" %((sd.hour, sd.minute, sd.second) + tuple(hist.voltages(0)))
+      yield "| Start %2i:%02i.%02i | %i C | %i C | %i C | %i C |" %((sd.hour, sd.minute, sd.second) + tuple(hist.get('temp_chip', 0)))
+      yield "| End   %2i:%02i.%02i | %s | %s | %s | %s |" %((ed.hour, ed.minute, ed.second) + tuple(hist.voltages()))
+      yield "| End   %2i:%02i.%02i | %i C | %i C | %i C | %i C |" %((ed.hour, ed.minute, ed.second) + tuple(hist.get('temp_chip')))
+      yield "| Err 15min       | %.2f | %.2f | %.2f | %.2f |" %tuple(hist.get('error_rate15'))
+      yield "| Err All         | %.2f | %.2f | %.2f | %.2f |" %tuple(hist.get('error_rate'))
+      yield "Tested voltages (samples, mean/max err 15min):"
+      for c in range(0,4):
+        yield "| Chain %i | %s |" %(c+1, ", ".join(["%s: %i %.2f/%.2f" %(hex(code), o.count, o.means()[2], o.max15) \
+          for code, o in self.outcomes.tested(f, c)]))
+    if self.sweep is not None and self.sweep.points:
+      best = self.sweep.best()
+      yield "Operating points:"
+      for f in sorted(self.sweep.points.keys(), key=float):
+        point = self.sweep.points[f]
+        yield "%s %s" %(point is best and "*" or " ", point)
+
+  def report_stats(self):
+    """report final stats"""
+    rep = "\n".join(self.report_lines())
+    self.log(rep)
+    self.log("*"*50)
+    fd,fname = tempfile.mkstemp(suffix='.rep', prefix="%s-" %self.ip)
+    fobj = os.fdopen(fd, 'w')
+    try:
+      fobj.write(rep + "\n")
+    finally:
+      fobj.close()
+    self.log("Report written to %s" %fname)
+
+
+###############
+# FLEET RUNNER
+###############
+class FleetRunner(object):
+  """Run the tuning cycles of many miners on a bounded pool of worker threads.
+
+  Each miner keeps its own schedule: after a cycle it is requeued at the time
+  its own step() asked for, so miners drift independently of each other."""
+
+  def __init__(self, tuners, workers=FLEET_WORKERS, listener=None, persistent=False, stagger=REPEAT):
+    self.tuners = tuners
+    self.workers = max(1, min(workers, len(tuners)))
+    self.queue = []
+    self.cond = threading.Condition()
+    self.active = len(tuners)
+    # called with (tuner, delay) after every cycle, delay is None once the
+    # tuner is done
+    self.listener = listener
+    # wait for more miners once all are done, until close() is called
+    self.persistent = persistent
+    self.closed = False
+    # spread the initial cycles over stagger seconds so we do not hit all miners at once
+    seq = 0
+    for t in tuners:
+      heapq.heappush(self.queue, (time.time() + random.uniform(0, stagger), seq, t))
+      seq += 1
+    self.seq = seq
+
+  def _next(self):
+    """Block until a miner is due, returns None when all miners are done"""
+    self.cond.acquire()
+    try:
+      while True:
+        if self.active == 0 and (self.closed or not self.persistent):
+          return None
+        if self.queue:
+          due = self.queue[0][0] - time.time()
+          if due <= 0:
+            tuner = heapq.heappop(self.queue)[2]
+            tuner.metrics.observe('cycle_lateness_seconds', -due, miner=tuner.ip)
+            return tuner
+          self.cond.wait(due)
+        else:
+          self.cond.wait(1)
+    finally:
+      self.cond.release()
+
+  def _done(self, tuner, delay):
+    self.cond.acquire()
+    try:
+      if delay is None:
+        self.active -= 1
+      else:
+        heapq.heappush(self.queue, (time.time() + delay, self.seq, tuner))
+        self.seq += 1
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+
+  def add(self, tuner):
+    """Start tuning another miner right away"""
+    self.cond.acquire()
+    try:
+      self.tuners.append(tuner)
+      self.active += 1
+      heapq.heappush(self.queue, (time.time(), self.seq, tuner))
+      self.seq += 1
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+
+  def close(self):
+    """No more miners will be added, run() returns once all are done"""
+    self.cond.acquire()
+    try:
+      self.closed = True
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+
+  def _worker(self):
+    while True:
+      tuner = self._next()
+      if tuner is None:
+        return
+      try:
+        delay = tuner.step()
+      except TuneError, e:
+        tuner.log("%s\nGiving up on this miner." %e)
+        tuner.failed = str(e)
+        delay = None
+      except Exception, e:
+        tuner.log("Unexpected error, giving up on this miner: %r" %e)
+        tuner.failed = repr(e)
+        delay = None
+      if delay is None:
+        tuner.close()
+      if self.listener is not None:
+        self.listener(tuner, delay)
+      self._done(tuner, delay)
+
+  def run(self):
+    threads = []
+    for i in range(self.workers):
+      t = threading.Thread(target=self._worker, name="tuner-%i" %i)
+      t.daemon = True
+      t.start()
+      threads.append(t)
+    # join with timeout so signals still reach the main thread
+    for t in threads:
+      while t.isAlive():
+        t.join(1)
+
+  def summary(self):
+    return fleet_summary([(t.ip, t.current_voltage, tuner_state(t)) for t in self.tuners])
+
+
+def tuner_state(tuner):
+  if tuner.failed:
+    return "FAILED: %s" %tuner.failed.split("\n")[0]
+  if tuner.finished:
+    return "finished"
+  return "unfinished"
+
+
+def fleet_summary(rows):
+  """Table of (ip, voltages, state) rows"""
+  rep = "Fleet summary:\n"
+  for ip, voltages, state in rows:
+    rep += "| %s | %s | %s |\n" %(ip.ljust(15), " ".join(voltages or ['-']*4), state)
+  return rep
+
+
+###############
+# SHARDED FLEET
+###############
+def shard_of(host, shards):
+  """Shard a host is tuned by, the same one in every run"""
+  return (zlib.crc32(host) & 0xffffffff) % shards
+
+
+def shard_worker(shard, hosts, factory, workers, commands, status, stagger=REPEAT):
+  """Body of a shard process: tunes hosts on a FleetRunner, reports every
+  cycle over the status queue and takes more hosts from the commands queue
+  until told to stop. factory(host, ssh, metrics) returns a MinerTuner."""
+  global tuners
+  # the stagger of the first cycles would be the same in every shard
+  random.seed()
+  ssh = SSHPool()
+  metrics = Metrics()
+  tuners = [factory(h, ssh, metrics) for h in hosts]
+  pushed = [0]
+
+  def listener(tuner, delay):
+    status.put((delay is None and 'done' or 'cycle', shard, tuner.ip, tuner.current_voltage, tuner_state(tuner)))
+    if delay is None or time.time() - pushed[0] >= SHARD_METRICS_INTERVAL:
+      pushed[0] = time.time()
+      status.put(('metrics', shard, metrics.snapshot()))
+
+  runner = FleetRunner(tuners, workers, listener, persistent=True, stagger=stagger)
+
+  def receive():
+    while True:
+      cmd = commands.get()
+      if cmd[0] != 'add':
+        runner.close()
+        return
+      for host in cmd[1]:
+        tuner = factory(host, ssh, metrics)
+        tuners.append(tuner)
+        runner.add(tuner)
+
+  t = threading.Thread(target=receive, name="shard-commands")
+  t.daemon = True
+  t.start()
+  runner.run()
+  ssh.close()
+
+
+class ShardCoordinator(object):
+  """Tune a fleet on a pool of processes, each running a FleetRunner on a
+  shard of the miners, so JSON parsing, history and decisions of thousands
+  of miners are not all held up by one GIL.
+
+  Miners are assigned to shards by a hash of their address. Shards send a
+  status message after every cycle and metrics snapshots over one queue, the
+  coordinator collects the results of all miners. Knowledge files are
+  flushed every cycle, so if a shard process dies its unfinished miners are
+  moved to the live shards (or a new one if none is left) and carry on from
+  what was learned so far."""
+
+  def __init__(self, hosts, factory, processes, workers=FLEET_WORKERS, metrics=None, moves=SHARD_MOVES,
+               stagger=REPEAT):
+    self.hosts = hosts
+    self.factory = factory
+    self.workers = workers
+    # seconds the first cycles of the miners of a shard are spread over
+    self.stagger = stagger
+    self.metrics = metrics
+    self.moves = moves
+    self.status = multiprocessing.Queue()
+    # shard -> (process, command queue) of the live shards
+    self.shards = {}
+    self.next_shard = 0
+    # host -> shard tuning it
+    self.owner = {}
+    # host -> (voltages, state) as last reported
+    self.results = dict([(h, (None, "unfinished")) for h in hosts])
+    self.done = set()
+    self.moved = {}
+    # (shard, exit code) of the shard processes that died
+    self.died = []
+    self.cycles = 0
+    self.started = False
+    self.assignment = [[] for i in range(max(1, min(processes, len(hosts))))]
+    for h in hosts:
+      self.assignment[shard_of(h, len(self.assignment))].append(h)
+
+  def log(self, msg):
+    print_lock.acquire()
+    try:
+      sys.stdout.write("%s\n" %msg)
+      sys.stdout.flush()
+    finally:
+      print_lock.release()
+
+  def spawn(self, hosts):
+    """Start a shard process tuning hosts"""
+    shard = self.next_shard
+    self.next_shard += 1
+    commands = multiprocessing.Queue()
+    p = multiprocessing.Process(target=shard_worker, name="shard-%i" %shard,
+                                args=(shard, hosts, self.factory, self.workers, commands, self.status, self.stagger))
+    p.daemon = True
+    p.start()
+    self.shards[shard] = (p, commands)
+    for h in hosts:
+      self.owner[h] = shard
+    return shard
+
+  def handle(self, msg):
+    kind, shard = msg[0], msg[1]
+    if kind == 'metrics':
+      if self.metrics is not None:
+        self.metrics.update(msg[2])
+      return
+    ip, voltages, state = msg[2:]
+    # left in the queue by a shard the miner was moved away from
+    if self.owner.get(ip) != shard or ip in self.done:
+      return
+    self.results[ip] = (voltages, state)
+    self.cycles += 1
+    if kind == 'done':
+      self.done.add(ip)
+
+  def drain(self):
+    while True:
+      try:
+        self.handle(self.status.get_nowait())
+      except Queue.Empty:
+        return
+
+  def rebalance(self, shard):
+    """Move the unfinished miners of a dead shard to the live ones, the ones
+    with the fewest unfinished miners first"""
+    process, commands = self.shards.pop(shard)
+    self.died.append((shard, process.exitcode))
+    moving = []
+    for h in [h for h, s in self.owner.items() if s == shard and h not in self.done]:
+      self.moved[h] = self.moved.get(h, 0) + 1
+      if self.moved[h] > self.moves:
+        self.results[h] = (self.results[h][0], "FAILED: %i shard processes died while tuning it" %self.moved[h])
+        self.done.add(h)
+      else:
+        moving.append(h)
+    self.log("Shard %i (pid %i) died with exit code %s, moving %i unfinished miners" %(shard, process.pid,
+      process.exitcode, len(moving)))
+    if not moving:
+      return
+    if not self.shards:
+      self.spawn(moving)
+      return
+    load = dict([(s, 0) for s in self.shards.keys()])
+    for h, s in self.owner.items():
+      if h not in self.done and load.has_key(s):
+        load[s] += 1
+    batches = {}
+    for h in moving:
+      s = min(load.keys(), key=lambda s: load[s])
+      load[s] += 1
+      self.owner[h] = s
+      batches.setdefault(s, []).append(h)
+    for s, hosts in batches.items():
+      self.shards[s][1].put(('add', hosts))
+
+  def start(self):
+    self.started = True
+    for hosts in self.assignment:
+      if hosts:
+        self.spawn(hosts)
+
+  def run(self, deadline=None):
+    """Tune all hosts, or until deadline (a timestamp) if given and call
+    run() again to go on"""
+    if not self.started:
+      self.start()
+    progress = checked = time.time()
+    cycles = 0
+    while len(self.done) < len(self.hosts):
+      if deadline is not None and time.time() >= deadline:
+        return
+      try:
+        self.handle(self.status.get(True, 1))
+      except Queue.Empty:
+        pass
+      now = time.time()
+      if now - checked >= 1:
+        checked = now
+        for shard in self.shards.keys():
+          if not self.shards[shard][0].is_alive():
+            # results it sent before dying
+            self.drain()
+            self.rebalance(shard)
+      if now - progress >= SHARD_PROGRESS:
+        self.log("%i of %i miners done, %.1f cycles/s on %i shard processes" %(len(self.done), len(self.hosts),
+          (self.cycles - cycles) / (now - progress), len(self.shards)))
+        progress, cycles = now, self.cycles
+    self.stop()
+
+  def stop(self):
+    """Let the shards finish, their queues have to be drained until they exit"""
+    for p, commands in self.shards.values():
+      commands.put(('stop',))
+    for p, commands in self.shards.values():
+      while p.is_alive():
+        self.drain()
+        p.join(0.1)
+    self.drain()
+
+  def terminate(self):
+    """Stop all shards right away, they write their reports like on a signal"""
+    for p, commands in self.shards.values():
+      if p.is_alive():
+        p.terminate()
+    for p, commands in self.shards.values():
+      while p.is_alive():
+        self.drain()
+        p.join(0.1)
+
+  def summary(self):
+    return fleet_summary([(h, self.results[h][0], self.results[h][1]) for h in self.hosts])
 
 
 def sig_handler(signum, frm):
-  report_stats()
+  for t in tuners:
+    if t.chain_hist:
+      t.report_stats()
   print "\nSignal %i caught" %signum
-  sys.exit(2)      
-
-
-def report_stats():
-  """report final stats"""
-  rep = ""
-  rep += "Stats report:\n"
-  rep += "*************\n"
-  for f in chain_hist.keys():
-    sd = datetime.fromtimestamp(chain_hist[f][0]['timestamp'])
-    ed = datetime.fromtimestamp(chain_hist[f][-1]['timestamp'])
-    rep += "Freq: %s:\n" %f
-    rep += "=========\n"
-    for stats in chain_hist[f]:
-      d = datetime.fromtimestamp(stats['timestamp'])
-      rep += "| %2i:%02i.%02i   | %s | %s | %s | %s |\n" \
-        %(d.hour, d.minute, d.second, stats['voltage'][0], stats['voltage'][1], stats['voltage'][2], stats['voltage'][3])
-      rep += "| Temp Chips | %i C | %i C | %i C | %i C |\n" \
-        %(stats['temp_chip'][0], stats['temp_chip'][1], stats['temp_chip'][2], stats['temp_chip'][3])
-      rep += "| Err 5min   | %.2f | %.2f | %.2f | %.2f |\n" \
-        %(stats['error_rate5'][0], stats['error_rate5'][1], stats['error_rate5'][2], stats['error_rate5'][3])
-      rep += "| Err 10min  | %.2f | %.2f | %.2f | %.2f |\n" \
-        %(stats['error_rate10'][0], stats['error_rate10'][1], stats['error_rate10'][2], stats['error_rate10'][3])
-      rep += "| Err 15min  | %.2f | %.2f | %.2f | %.2f |\n" \
-        %(stats['error_rate15'][0], stats['error_rate15'][1], stats['error_rate15'][2], stats['error_rate15'][3])
-      rep += "| Err All    | %.2f | %.2f | %.2f | %.2f |\n" \
-        %(stats['error_rate'][0], stats['error_rate'][1], stats['error_rate'][2], stats['error_rate'][3])
-    rep += "*"*50 + "\n"
-    rep += "| Start %2i:%02i.%02i | %s | %s | %s | %s |\n" \
-      %(sd.hour, sd.minute, sd.second, chain_hist[f][0]['voltage'][0], chain_hist[f][0]['voltage'][1], chain_hist[f][0]['voltage'][2], chain_hist[f][0]['voltage'][3])
-    rep += "| Start %2i:%02i.%02i | %i C | %i C | %i C | %i C |\n" \
-      %(sd.hour, sd.minute, sd.second, chain_hist[f][0]['temp_chip'][0], chain_hist[f][0]['temp_chip'][1], chain_hist[f][0]['temp_chip'][2], chain_hist[f][0]['temp_chip'][3])
-    rep += "| End   %2i:%02i.%02i | %s | %s | %s | %s |\n" \
-      %(ed.hour, ed.minute, ed.second, chain_hist[f][-1]['voltage'][0], chain_hist[f][-1]['voltage'][1], chain_hist[f][-1]['voltage'][2], chain_hist[f][-1]['voltage'][3])
-    rep += "| End   %2i:%02i.%02i | %i C | %i C | %i C | %i C |\n" \
-      %(ed.hour, ed.minute, ed.second, chain_hist[f][-1]['temp_chip'][0], chain_hist[f][-1]['temp_chip'][1], chain_hist[f][-1]['temp_chip'][2], chain_hist[f][-1]['temp_chip'][3])
-    
-  print rep
-  print "*"*50
-  fd,fname = tempfile.mkstemp(suffix='.rep', prefix="%s-" %miner_ip)
-  fobj = open(fname, 'w')
-  fobj.write(rep)
-  fobj.close()
-  os.close(fd)
-  print "Report written to %s" %fname
-  try:
-    nobegging
-  except:
-    shameless_begging()
+  sys.exit(2)
 
 
 def show_usage():
   print "Usage:"
   print "%s -i <ip>|--minerip=<ip> [OPTIONS]" %__file__
+  print "%s -f <fleet>|--fleet=<fleet> [OPTIONS]" %__file__
   print "\nOptions:"
   print " -p <adminpass>\t\t\tadmin password if not set to 'admin'"
   print " --password=<adminpass>"
   print " -s <chain1[,chain2]>\t\tskip one or more chains"
   print " --skip <chain1[,chain2]>" 
+  print " -f <fleet>\t\t\ttune many miners at once, <fleet> is a file with one"
+  print " --fleet=<fleet>\t\tip/hostname/CIDR per line or a comma separated list"
+  print " -w <workers>\t\t\tminers worked on in parallel in fleet mode (default %i)," %FLEET_WORKERS
+  print " --workers=<workers>\t\tper process with -P"
+  print " -P <processes>\t\t\tspread the fleet over <processes> processes (default 1)"
+  print " --processes=<processes>"
+  print " -k <dir>\t\t\tkeep tuning results in <dir> (default %s)" %KB_DIR
+  print " --knowledge=<dir>"
+  print " --noknowledge\t\t\tstart from scratch and do not keep results"
+  print " --nopriors\t\t\tdo not start chains from the results of other miners"
+  print " --fixed\t\t\tsample every %is and decide every %is instead of adaptively" %(REPEAT, TUNE_REPEAT)
+  print " --search=<strategy>\t\thow to pick the next voltage: %s (default %s)" %('|'.join(sorted(SEARCHES.keys())), DEFAULT_SEARCH)
+  print " -e <format>\t\t\texport samples as %s (default %s)" %('|'.join(sorted(EXPORT_FORMATS.keys())), DEFAULT_EXPORT)
+  print " --export=<format>"
+  print " --noexport\t\t\tdo not export samples"
+  print " --verify=<seconds>\t\tread voltages from the miner every <seconds> to check the"
+  print " \t\t\t\tcached ones (default %i, 0 every cycle)" %VERIFY_INTERVAL
+  print " --watchdog=<seconds>\t\tcheck the miners for faults every <seconds> between cycles"
+  print " \t\t\t\t(default %i)" %WATCHDOG_INTERVAL
+  print " --nowatchdog\t\t\tonly check the miners in the tuning cycles"
+  print " --optimize=<MHz,MHz,..>\ttune at each frequency and end at the one with the most"
+  print " \t\t\t\thash rate per watt, 'default' for %s" %",".join(FREQ_LADDER)
+  print " --power=<name=value,..>\tpower model of the miner, see efficiency.py"
+  print " --deploy\t\t\treplace %s on all miners that differ from the bundled sv.txt" %SETV_BIN
+  print " \t\t\t\tbefore tuning, otherwise it is only installed where missing"
+  print " --deployonly\t\t\tlike --deploy, but stop after deploying"
+  print " -m <[addr:]port>\t\tserve metrics for Prometheus on http://<addr>:<port>/metrics"
+  print " --metrics=<[addr:]port>\t(default port %i)" %METRICS_PORT
   print " --nobegging\t\t\tSuppress the begging message"
   print ""
   print "Examples:"
   print "Tune miner on 10.10.10.33, use '1234' as admin password and skip tuning chain 2 and 3:"
   print "%s -i 10.10.10.33 -p 1234 --skip 2,3" %__file__
+  print "Tune all miners in 10.10.10.0/24 and 10.10.11.5, 32 at a time:"
+  print "%s -f 10.10.10.0/24,10.10.11.5 -w 32" %__file__
   print "Default usage :"
   print "%s -i 10.10.10.33" %__file__
   print ""
@@ -519,107 +1332,218 @@ def shameless_begging():
 ##################
 # MAIN
 ##################
+tuners = []
+
 if __name__ == '__main__':
+  if paramiko is None:
+    print "paramiko module missing, please install with:"
+    print " sudo apt-get install python-paramiko"
+    sys.exit(1)
   if len(sys.argv) < 2:
     print "Incomplete parameters."
     show_usage()
     sys.exit(1)  
 
   try:                                
-    opts, args = getopt.getopt(sys.argv[1:], "hi:p:s:", ["help", "minerip=", "password=", "skip=", "nobegging"])
+    opts, args = getopt.getopt(sys.argv[1:], "hi:p:s:f:w:P:k:m:e:", ["help", "minerip=", "password=", "skip=", "fleet=", "workers=", "processes=", "knowledge=", "noknowledge", "nopriors", "fixed", "search=", "metrics=", "export=", "noexport", "verify=", "watchdog=", "nowatchdog", "optimize=", "power=", "deploy", "deployonly", "nobegging"])
   except getopt.GetoptError:
     print "Error getting cmdline params."
     show_usage()
     sys.exit(1)
+  miner_ip = None
+  fleet = None
+  workers = FLEET_WORKERS
+  processes = 1
+  kb_dir = KB_DIR
+  use_priors = True
+  fixed = False
+  search = DEFAULT_SEARCH
+  listen = None
+  export = DEFAULT_EXPORT
+  verify_interval = VERIFY_INTERVAL
+  watchdog_interval = WATCHDOG_INTERVAL
+  ladder = None
+  power = None
+  deploy = False
+  deploy_only = False
+  admin_pw = 'admin'
+  skip_chain = []
+  nobegging = False
   for opt, arg in opts:
     if opt in ("-h", "--help"):
       show_usage()   
       sys.exit(1)
     if opt in ("-i", "--minerip"):
       miner_ip = arg
+    elif opt in ("-f", "--fleet"):
+      fleet = arg
+    elif opt in ("-w", "--workers"):
+      workers = int(arg)
+    elif opt in ("-P", "--processes"):
+      processes = int(arg)
+    elif opt in ("-k", "--knowledge"):
+      kb_dir = arg
+    elif opt == "--noknowledge":
+      kb_dir = None
+    elif opt == "--nopriors":
+      use_priors = False
     elif opt in ("-p", "--password"):
       admin_pw = arg
     elif opt in ("-s", "--skip"):
       skip_chain = arg.split(",")
       print "Skipping these chains:", skip_chain
+    elif opt == "--fixed":
+      fixed = True
+    elif opt == "--search":
+      if not SEARCHES.has_key(arg):
+        print "Unknown search strategy %s" %arg
+        show_usage()
+        sys.exit(1)
+      search = arg
+    elif opt in ("-e", "--export"):
+      if not EXPORT_FORMATS.has_key(arg):
+        print "Unknown export format %s" %arg
+        show_usage()
+        sys.exit(1)
+      export = arg
+    elif opt == "--noexport":
+      export = None
+    elif opt == "--verify":
+      verify_interval = int(arg)
+    elif opt == "--watchdog":
+      watchdog_interval = float(arg)
+    elif opt == "--nowatchdog":
+      watchdog_interval = None
+    elif opt == "--optimize":
+      if arg == "default":
+        ladder = FREQ_LADDER
+      else:
+        ladder = [f.strip() for f in arg.split(',') if f.strip()]
+    elif opt == "--deploy":
+      deploy = True
+    elif opt == "--deployonly":
+      deploy_only = True
+    elif opt == "--power":
+      try:
+        power = parse_power(arg)
+      except ValueError, e:
+        print "Invalid power model: %s" %e
+        show_usage()
+        sys.exit(1)
+    elif opt in ("-m", "--metrics"):
+      try:
+        listen = parse_listen(arg)
+      except ValueError, e:
+        print "Invalid metrics address: %s" %e
+        show_usage()
+        sys.exit(1)
     elif opt in ("--nobegging"):
       nobegging = True
 
-  try:
-    socket.gethostbyname(miner_ip)
-  except:
-    print "No or invalid miner ip given, aborting"
-    show_usage()
-    sys.exit(1)
-  try:
-    admin_pw = admin_pw 
-  except:
-    admin_pw = 'admin'
-  try:
-    skip_chain = skip_chain
-  except:
-    skip_chain = []
+  if fleet:
+    try:
+      hosts = parse_fleet(fleet)
+    except (ValueError, socket.error), e:
+      print "Invalid fleet given: %s" %e
+      show_usage()
+      sys.exit(1)
+    if not hosts:
+      print "Fleet %s contains no miners, aborting" %fleet
+      sys.exit(1)
+  else:
+    try:
+      socket.gethostbyname(miner_ip)
+    except:
+      print "No or invalid miner ip given, aborting"
+      show_usage()
+      sys.exit(1)
+    hosts = [miner_ip]
 
   # catch signals
   signal.signal(signal.SIGINT, sig_handler)
   signal.signal(signal.SIGTERM, sig_handler)
 
-  install_flag = False
-  chain_hist = {}
-  current_voltage = get_voltage(miner_ip)
-  last_vset = {int(time.time()): current_voltage}
-  last_change = int(time.time())
-  cycle_count = 0
-  
-  
-  # main tuning loop    
-  while True:
-    #print "last_vset:", last_vset
-    now = time.time()
-    # get error stats
-    current_stats = get_minerstats(miner_ip, port=4028)
-    # get current voltage levels
-    current_voltage = get_voltage(miner_ip)
-    # add to history
-    add_history(current_stats, current_voltage, int(now))
-    # process history and calculate error/min for 5,10,15 and all
-    process_history(current_stats['frequency'])
-    # check miner status for errors
-    check_minerstatus(current_stats['frequency'])
-    # see if we have to adjust voltage every 5min only
-    if int(now) - last_vset.keys()[-1] > TUNE_REPEAT -5:
-      adjust_voltage(current_stats['frequency'])    
-      last_vset = {int(time.time()): current_voltage}
-    # limit length of history
-    if len(chain_hist[current_stats['frequency']]) > HIST_MAX_LEN:
-      chain_hist[current_stats['frequency']].pop(0)
-    time_running = (int(time.time()) - chain_hist[current_stats['frequency']][0]['timestamp'])
-    print "= Running since: %02i:%02i.%02i, now sleeping for %.1fs =" \
-      %(divmod(time_running,60*60)[0], divmod( divmod(time_running, 60*60)[1], 60 )[0], divmod( divmod(time_running, 60*60)[1], 60 )[1], REPEAT - (time.time()-now))
-      
-    # if we are stable, exit
-    if now - last_change > 900:
-      report_stats()
-      print "Finished tuning, miner stable AFAICS"
-      break
-    if cycle_count > MAX_CYCLE:
-      report_stats()
-      print "Reached maximum cycle limit of %i without getting stable enough results, aborting tuning." %cycle_count
-      break
-    else:
-      cycle_count += 1
-    # sleep a while..
-    sleep_time = REPEAT - (time.time()-now) 
-    if sleep_time < 0:
-      time.sleep(5)
-    else:
-      time.sleep(sleep_time)
+  ssh_pool = SSHPool()
+  metrics = Metrics()
+  if listen:
+    try:
+      server = MetricsServer(metrics, listen[1], listen[0])
+    except socket.error, e:
+      print "Unable to serve metrics on %s:%i: %s" %(listen[0], listen[1], e)
+      sys.exit(1)
+    server.start()
+    print "Serving metrics on http://%s:%i/metrics" %(listen[0] or socket.gethostname(), server.port)
+  if deploy or deploy_only:
+    try:
+      deployer = Deployer(ssh_pool, admin_pw, load_binary(SV_TXT, SETV_BIN_MD5), SETV_BIN)
+    except (DeployError, IOError), e:
+      print "Unable to load the %s binary: %s" %(SETV_BIN, e)
+      sys.exit(1)
+    results = deploy_fleet(deployer, hosts, workers)
+    print deploy_summary(results)
+    if deploy_only:
+      ssh_pool.close()
+      sys.exit(len([r for r in results if r.outcome == FAILED]) and 1 or 0)
+    failed = [r.host for r in results if r.outcome == FAILED]
+    if failed:
+      print "Not tuning %i miner(s) without %s" %(len(failed), SETV_BIN)
+      hosts = [h for h in hosts if h not in failed]
+    if not hosts:
+      sys.exit(1)
+  # shared by all tuners, shard processes read what the others append
+  priors = None
+  if kb_dir and use_priors:
+    priors = PriorStore(priors_path(kb_dir))
+
+  # starts its threads in the process the tuners run in
+  watchdog = None
+  if watchdog_interval:
+    watchdog = Watchdog(watchdog_interval, port=API_PORT)
+
+  def make_tuner(host, ssh, metrics):
+    tuner = MinerTuner(host, admin_pw, skip_chain, tag=bool(fleet), ssh=ssh, kb_dir=kb_dir, fixed=fixed, search=search,
+                       metrics=metrics, export=export, verify_interval=verify_interval, ladder=ladder, power=power,
+                       priors=priors)
+    if watchdog is not None:
+      watchdog.add(tuner)
+    return tuner
+
+  if fleet and processes > 1:
+    # the shards open their own ssh connections
+    ssh_pool.close()
+    coordinator = ShardCoordinator(hosts, make_tuner, processes, workers, metrics)
+    print "Tuning %i miners on %i processes with %i workers each" %(len(hosts), len(coordinator.assignment), workers)
+    try:
+      coordinator.run()
+    finally:
+      coordinator.terminate()
+    print coordinator.summary()
+    if not nobegging:
+      shameless_begging()
+    sys.exit(0)
+  tuners = [make_tuner(h, ssh_pool, metrics) for h in hosts]
+  if fleet:
+    print "Tuning %i miners with %i workers" %(len(tuners), min(workers, len(tuners)))
+    runner = FleetRunner(tuners, workers)
+    runner.run()
+    print runner.summary()
+  else:
+    try:
+      tuners[0].run()
+    except TuneError, e:
+      print e
+      sys.exit(1)
+  if watchdog is not None:
+    watchdog.stop()
+  ssh_pool.close()
+  if not nobegging:
+    shameless_begging()
       
 
 
 
 
-# chain_hist format:
+# chain_hist format, as returned by ChainHistory.record()/records():
 """
 {u'400': [
   {'chainrate': [u'131.20', u'130.93', u'130.97', u'130.80'], 
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# metrics.py: tuning loop instrumentation and a Prometheus text exporter
+# --------------------------------------------------------------------------
+#
+# A Metrics registry is shared by all tuners of a process. Tuners time each
+# phase of their cycle and publish per chain values into it, MetricsServer
+# serves the whole registry in the Prometheus text format on /metrics, so
+# one scrape covers a whole fleet. Fleets spread over processes send
+# snapshots of their registries to the one of the coordinator.
+#
+# Phase durations are kept as summaries (count, sum and the max since the
+# start) measured on the wall clock, also when the tuner runs on a simulated
+# one.
+
+import threading, time
+import BaseHTTPServer, SocketServer
+
+METRICS_PORT = 9464
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'l3plus_'
+
+# name: (type, help)
+DESCRIPTIONS = {
+  'phase_seconds': ('summary', 'Wall clock seconds spent per phase of the tuning cycle'),
+  'phase_seconds_max': ('gauge', 'Longest phase of the tuning cycle so far'),
+  'cycles_total': ('counter', 'Tuning cycles run'),
+  'cycle_overruns_total': ('counter', 'Tuning cycles that took longer than the time until the next one'),
+  'cycle_lateness_seconds': ('summary', 'Seconds tuning cycles started after they were due'),
+  'cycle_lateness_seconds_max': ('gauge', 'Latest start of a tuning cycle so far'),
+  'finished': ('gauge', '1 once tuning of the miner is done'),
+  'efficiency_mh_per_joule': ('gauge', 'Hash rate per modelled watt of the operating point tuned at a frequency'),
+  'export_failures_total': ('counter', 'Samples that could not be written to the export file'),
+  'voltage_reads_total': ('counter', 'Reads of all voltages from the miner to fill or check the voltage cache'),
+  'prior_rollbacks_total': ('counter', 'Chains started from the fleet priors and rolled back for making too many errors'),
+  'watchdog_faults_total': ('counter', 'Dropped chips, hw error spikes and hot chips seen by the watchdog between tuning cycles'),
+  'chain_error_rate': ('gauge', 'hw errors per minute of a chain over a window'),
+  'chain_temperature_celsius': ('gauge', 'Chip temperature of a chain'),
+  'chain_voltage_code': ('gauge', 'PIC voltage code of a chain, higher is lower voltage'),
+  'chain_rate_mhs': ('gauge', 'Hash rate of a chain in MH/s'),
+  'chain_state': ('gauge', '1 for the current tuning state of a chain'),
+}
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+  """Sorted label pairs, hashable"""
+  return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+  """Thread safe registry of labelled counters, gauges and summaries"""
+
+  def __init__(self, prefix=PREFIX):
+    self.prefix = prefix
+    self.lock = threading.Lock()
+    # name -> {labels: value}, summaries are kept as [count, sum]
+    self.values = {}
+
+  def _series(self, name):
+    if not self.values.has_key(name):
+      self.values[name] = {}
+    return self.values[name]
+
+  def set(self, name, value, **labels):
+    self.lock.acquire()
+    try:
+      self._series(name)[_labels(labels)] = value
+    finally:
+      self.lock.release()
+
+  def inc(self, name, value=1, **labels):
+    self.lock.acquire()
+    try:
+      series = self._series(name)
+      key = _labels(labels)
+      series[key] = series.get(key, 0) + value
+    finally:
+      self.lock.release()
+
+  def observe(self, name, value, **labels):
+    """Add a value to a summary, its max is kept as a gauge <name>_max"""
+    self.lock.acquire()
+    try:
+      key = _labels(labels)
+      series = self._series(name)
+      summary = series.setdefault(key, [0, 0.0])
+      summary[0] += 1
+      summary[1] += value
+      peak = self._series(name + '_max')
+      peak[key] = max(peak.get(key, 0.0), value)
+    finally:
+      self.lock.release()
+
+  def snapshot(self):
+    """Copy of all series, e.g. to send them to another process"""
+    self.lock.acquire()
+    try:
+      return dict([(name, dict([(k, isinstance(v, list) and list(v) or v) for k, v in series.items()]))
+                   for name, series in self.values.items()])
+    finally:
+      self.lock.release()
+
+  def update(self, values):
+    """Take over the series of a snapshot, replacing the ones with the same labels"""
+    self.lock.acquire()
+    try:
+      for name, series in values.items():
+        self._series(name).update(series)
+    finally:
+      self.lock.release()
+
+  def timed(self, phase, func, *args, **labels):
+    """Call func(*args), timing it as phase"""
+    start = time.time()
+    try:
+      return func(*args)
+    finally:
+      self.observe('phase_seconds', time.time() - start, phase=phase, **labels)
+
+  def render(self):
+    """All series in the Prometheus text exposition format"""
+    out = []
+    self.lock.acquire()
+    try:
+      for name in sorted(self.values.keys()):
+        series = self.values[name]
+        if not series:
+          continue
+        kind, help = DESCRIPTIONS.get(name, ('untyped', name))
+        full = self.prefix + name
+        out.append("# HELP %s %s" %(full, help))
+        out.append("# TYPE %s %s" %(full, kind))
+        for key in sorted(series.keys()):
+          labels = ",".join(['%s="%s"' %(k, _escape(v)) for k, v in key])
+          labels = labels and "{%s}" %labels or ""
+          value = series[key]
+          if kind == 'summary':
+            out.append("%s_count%s %i" %(full, labels, value[0]))
+            out.append("%s_sum%s %r" %(full, labels, float(value[1])))
+          else:
+            out.append("%s%s %r" %(full, labels, float(value)))
+    finally:
+      self.lock.release()
+    return "\n".join(out) + "\n"
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.server.metrics.render()
+    self.send_response(200)
+    self.send_header('Content-Type', CONTENT_TYPE)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # scrapes would flood the tuner output
+    pass
+
+
+class MetricsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class MetricsServer(object):
+  """Serves a Metrics registry on http://<addr>:<port>/metrics in a thread"""
+
+  def __init__(self, metrics, port=METRICS_PORT, addr=''):
+    self.metrics = metrics
+    self.server = MetricsHTTPServer((addr, port), MetricsHandler)
+    self.server.metrics = metrics
+    self.port = self.server.server_address[1]
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever, name="metrics")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def parse_listen(spec):
+  """[addr:]port of the --metrics option, returns (addr, port)"""
+  addr, sep, port = spec.rpartition(':')
+  try:
+    return addr, int(port)
+  except ValueError:
+    raise ValueError("invalid port in %s" %spec)
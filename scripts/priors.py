@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# priors.py: starting voltages of new tunes from the results of finished ones
+# --------------------------------------------------------------------------
+#
+# Boards of one model at one frequency end up in a narrow band of voltage
+# codes, yet every tune starts wherever the miner happens to be, mostly the
+# 0x80 default, and walks from there. A PriorStore keeps the final voltages
+# of every tune that finished stable, per firmware, frequency and chain
+# position, and hands out a conservative quantile of them (a code most
+# siblings were fine at, minus a margin) as the starting point of new tunes.
+#
+# The store is a JSON Lines file next to the knowledge files, one line per
+# finished tune, appended with a single write. The latest line of a miner
+# and frequency wins. Lines appended by other processes (shards of a big
+# fleet, other runs) are picked up on the next lookup.
+
+import os, json, time, threading
+
+# quantile of the final codes of the siblings a chain starts at, low is
+# conservative since lower codes are higher voltages
+PRIOR_QUANTILE = 0.1
+# codes of extra voltage on top of the quantile
+PRIOR_MARGIN = 2
+# finished tunes needed before their codes are used
+PRIOR_MIN_BOARDS = 5
+PRIORS_FILE = 'priors.jsonl'
+
+
+def priors_path(directory):
+  return os.path.join(directory, PRIORS_FILE)
+
+
+class PriorStore(object):
+  """Final voltage codes of finished tunes, thread safe"""
+
+  def __init__(self, path, quantile=PRIOR_QUANTILE, margin=PRIOR_MARGIN, min_boards=PRIOR_MIN_BOARDS):
+    self.path = path
+    self.quantile = quantile
+    self.margin = margin
+    self.min_boards = min_boards
+    self.lock = threading.Lock()
+    # (host, frequency) -> record
+    self.tunes = {}
+    # bytes of the file read so far
+    self.offset = 0
+
+  def _refresh(self):
+    """Read the lines appended since the last call"""
+    try:
+      if os.path.getsize(self.path) <= self.offset:
+        return
+      fh = open(self.path, 'rb')
+    except (IOError, OSError):
+      return
+    try:
+      fh.seek(self.offset)
+      data = fh.read()
+    finally:
+      fh.close()
+    # a line without its newline is still being written
+    end = data.rfind("\n") + 1
+    for line in data[:end].split("\n"):
+      try:
+        rec = json.loads(line)
+        self.tunes[(rec['host'], rec['frequency'])] = rec
+      except (ValueError, KeyError, TypeError):
+        continue
+    self.offset += end
+
+  def add(self, host, firmware, frequency, codes):
+    """A tune of host ended stable at codes, one per chain with None for
+    chains that were not tuned"""
+    rec = {'host': host, 'firmware': firmware, 'frequency': frequency, 'codes': codes, 'timestamp': int(time.time())}
+    self.lock.acquire()
+    try:
+      self._refresh()
+      directory = os.path.dirname(self.path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      fh = open(self.path, 'ab')
+      try:
+        fh.write(json.dumps(rec, sort_keys=True) + "\n")
+      finally:
+        fh.close()
+      # the next refresh reads the line again, to the same effect
+      self.tunes[(host, frequency)] = rec
+    finally:
+      self.lock.release()
+
+  def codes(self, firmware, frequency, chain):
+    """Final codes of chain position chain of all tunes at firmware and frequency"""
+    self.lock.acquire()
+    try:
+      self._refresh()
+      return [r['codes'][chain] for r in self.tunes.values() if r['firmware'] == firmware and
+              r['frequency'] == frequency and len(r['codes']) > chain and r['codes'][chain] is not None]
+    finally:
+      self.lock.release()
+
+  def start_code(self, firmware, frequency, chain):
+    """(code to start chain at, tunes it is based on), None while there are
+    too few finished tunes"""
+    codes = sorted(self.codes(firmware, frequency, chain))
+    if len(codes) < self.min_boards:
+      return None
+    return codes[int((len(codes) - 1) * self.quantile)] - self.margin, len(codes)
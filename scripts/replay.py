@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# replay.py: backtest tuning policies on recorded and synthetic miners
+# --------------------------------------------------------------------------
+#
+# Runs the decision logic of MinerTuner (schedule, search strategy,
+# adjust_voltage, dec_voltage, inc_voltage, voltage_history) unmodified
+# against miner models on a simulated clock. Console output, metrics and
+# the per cycle report are switched off and stats are taken from the model
+# without going through a cgminer reply, so a day of tuning one miner takes
+# milliseconds instead of a day.
+#
+# Miners are either synthetic simminer ones with random sweet spots (-n) or
+# replayed from the export files of real tuning runs: every board of an
+# export becomes a RecordedChain answering each voltage code with the error
+# rate and chip temperature measured at it. Codes the board did not spend
+# MIN_MINUTES at are filled in by a poisson fit of the error rate over the
+# codes near the highest one tested, like fleet_analysis.py does for a farm.
+#
+# A policy is a name and tuner parameters overriding the defaults, e.g.
+#
+#   strict:max_err_rate=0.1,search=bisect
+#
+# Every policy tunes every miner with the same seed, so policies are
+# compared on the same error draws. Runs are spread over processes (-j).
+# Once tuned, miners are held at their final voltages for -H hours to see
+# the error rates a policy leaves them at. One line of summary metrics per
+# policy is printed, -o also writes them as CSV.
+#
+# Usage: ./replay.py [-n <miners>] [-p <policy>].. [-j <processes>] [-H <hours>] [-s <seed>] [-o <csv>] [exports]
+
+import sys, os, math, time, random, getopt, multiprocessing
+
+import l3plus_autotune
+from metrics import Metrics
+from search import SEARCHES
+from export import CHAINS, read_export
+from efficiency import PowerModel
+from fleet_analysis import export_files, miner_of, FIT_RANGE, IRLS_ITERATIONS, MAX_STEP, MIN_CODES
+from simminer import ChainModel, SimMiner, SimClock, SimSSH
+from simminer.model import GROWTH, CHAIN_RATE, REF_FREQ, COLLAPSE_RATE, poisson
+
+# give up on a miner after this many simulated seconds
+MAX_SIM_TIME = 24 * 3600
+# hours a tuned miner is held at its final voltages
+HOLD_HOURS = 24
+# minutes a board has to have spent at a code for its measured rate to be used
+MIN_MINUTES = 30
+# lowest error rate (errors/min) a recorded board is assumed to make
+MIN_RATE = 0.005
+# minutes a board has to be recorded at a frequency to be replayed
+MIN_RECORDED_MINUTES = 120
+ASIC_OK = ' ' + ' '.join(['oooooooo'] * 9)
+# tuner parameters a policy can set: name -> (module global, parser)
+POLICY_PARAMS = {
+  'max_err_rate': ('MAX_ERR_RATE', float),
+  'max_voltage': ('MAX_VOLTAGE', lambda v: hex(int(v, 16))),
+  'tune_repeat': ('TUNE_REPEAT', int),
+  'repeat': ('REPEAT', int),
+}
+# schedule and search are MinerTuner arguments instead
+SCHEDULES = ('adaptive', 'fixed')
+DEFAULT_POLICIES = ('fixed-step:schedule=fixed,search=step', 'step:search=step', 'bisect:search=bisect',
+                    'bandit:search=bandit')
+CSV_COLUMNS = ('policy', 'miners', 'converged', 'median_h', 'p90_h', 'samples', 'rounds', 'chains_over_limit',
+               'codes_below_limit', 'lost_pct', 'held_err_rate', 'held_over_limit', 'watts')
+
+
+class Policy(object):
+  """Tuner parameters to replay with, the defaults of l3plus_autotune.py
+  where not set"""
+
+  def __init__(self, name, schedule='adaptive', search=l3plus_autotune.DEFAULT_SEARCH, **params):
+    self.name = name
+    self.schedule = schedule
+    self.search = search
+    self.params = params
+
+  def apply(self):
+    """Set the module globals of the tuner, done before every run since the
+    worker processes replay different policies in turn"""
+    for name, (var, parse) in POLICY_PARAMS.items():
+      setattr(l3plus_autotune, var, self.params.get(name, DEFAULTS[var]))
+
+  def max_err_rate(self):
+    return self.params.get('max_err_rate', DEFAULTS['MAX_ERR_RATE'])
+
+
+# the values of the globals before any policy was applied
+DEFAULTS = dict([(var, getattr(l3plus_autotune, var)) for var, parse in POLICY_PARAMS.values()])
+
+
+def parse_policy(spec):
+  """Policy of the -p option, [<name>:]<param>=<value>,.. with the params of
+  POLICY_PARAMS, schedule=fixed|adaptive and search=<strategy>"""
+  name, sep, items = spec.rpartition(':')
+  kwargs = {}
+  for item in items.split(','):
+    key, sep, value = item.partition('=')
+    key, value = key.strip(), value.strip()
+    if not sep:
+      raise ValueError("invalid policy parameter %s" %item)
+    if key == 'schedule':
+      if value not in SCHEDULES:
+        raise ValueError("unknown schedule %s" %value)
+      kwargs[key] = value
+    elif key == 'search':
+      if not SEARCHES.has_key(value):
+        raise ValueError("unknown search strategy %s" %value)
+      kwargs[key] = value
+    elif POLICY_PARAMS.has_key(key):
+      kwargs[key] = POLICY_PARAMS[key][1](value)
+    else:
+      raise ValueError("unknown policy parameter %s" %key)
+  return Policy(name or spec, **kwargs)
+
+
+def fit_rate(observations, top):
+  """Poisson fit of log(errors/min) = a + b * (code - top) over the
+  (code, errors, minutes) observations, returns (a, b). The growth per code
+  of simminer is assumed if there are too few codes or errors to fit it."""
+  obs = [(code - top, e, m) for code, e, m in observations if code >= top - FIT_RANGE and m > 0]
+  errors = sum([e for x, e, m in obs])
+  b = math.log(GROWTH)
+  fixed = math.log((errors + 0.5) / sum([m * math.exp(b * x) for x, e, m in obs])), b
+  if len(obs) < MIN_CODES or errors == 0:
+    return fixed
+  a = math.log((errors + 0.5) / (sum([m for x, e, m in obs]) + 1.0))
+  for i in range(IRLS_ITERATIONS):
+    ga = gb = haa = hab = hbb = 0.0
+    for x, e, m in obs:
+      mu = m * math.exp(max(-20, min(10, a + b * x)))
+      ga += e - mu
+      gb += x * (e - mu)
+      haa += mu
+      hab += x * mu
+      hbb += x * x * mu
+    det = haa * hbb - hab * hab
+    if det <= 1e-12:
+      break
+    da = max(-MAX_STEP, min(MAX_STEP, (hbb * ga - hab * gb) / det))
+    db = max(-MAX_STEP, min(MAX_STEP, (haa * gb - hab * ga) / det))
+    a, b = a + da, b + db
+    if abs(da) < 1e-6 and abs(db) < 1e-6:
+      break
+  # a rate not growing with less voltage is noise of a board that hardly
+  # erred, it would make every code look safe
+  if b <= 0:
+    return fixed
+  return a, b
+
+
+class RecordedChain(object):
+  """Error rate and chip temperature of one board at one frequency as
+  recorded in an export, a ChainModel look-alike for SimMiner"""
+
+  def __init__(self, codes):
+    # code -> [errors, minutes, temp * minutes]
+    self.codes = codes
+    self.top = max(codes.keys())
+    self.a, self.b = fit_rate([(c, v[0], v[1]) for c, v in codes.items()], self.top)
+    # looked up for every sample, so computed once per code
+    self.rates = [self._rate(c) for c in range(256)]
+    tested = sorted(codes.keys())
+    self.temps = [self._temp(min(tested, key=lambda t: abs(t - c))) for c in range(256)]
+
+  def _rate(self, code):
+    if self.codes.has_key(code) and self.codes[code][1] >= MIN_MINUTES:
+      errors, minutes, temp = self.codes[code]
+      return max(MIN_RATE, errors / minutes)
+    return max(MIN_RATE, math.exp(min(10, self.a + self.b * (code - self.top))))
+
+  def _temp(self, code):
+    errors, minutes, temp = self.codes[code]
+    return temp / minutes
+
+  def temp(self, code, freq, ambient=None):
+    """Mean chip temperature at the nearest code recorded"""
+    return self.temps[code]
+
+  def rate(self, code, freq, temp):
+    """hw errors/min, the recorded temperature is part of the measurement"""
+    return self.rates[code]
+
+  def best(self, freq, max_rate, ambient=None):
+    """Highest code with an error rate below max_rate"""
+    code = 0xfe
+    while code > 0 and self.rates[code] > max_rate:
+      code -= 1
+    return code
+
+
+def record_codes(records):
+  """Errors, minutes and temperature * minutes per frequency, chain and
+  code of consecutive export records at an unchanged voltage"""
+  boards = {}
+  last = None
+  for rec in records:
+    if last is not None and rec['frequency'] == last['frequency'] and rec['timestamp'] > last['timestamp']:
+      minutes = (rec['timestamp'] - last['timestamp']) / 60.0
+      for c in range(CHAINS):
+        errors = rec['err'][c] - last['err'][c]
+        # a changed voltage or a reset of the counters by a cgminer restart
+        if rec['voltage'][c] != last['voltage'][c] or errors < 0:
+          continue
+        obs = boards.setdefault((rec['frequency'], c), {}).setdefault(rec['voltage'][c], [0, 0.0, 0.0])
+        obs[0] += errors
+        obs[1] += minutes
+        obs[2] += rec['temp_chip'][c] * minutes
+    last = rec
+  return boards
+
+
+class MinerSpec(object):
+  """What a miner to replay is made of, picklable for the worker processes"""
+
+  def __init__(self, name, chains, frequency, seed):
+    self.name = name
+    self.chains = chains
+    self.frequency = frequency
+    self.seed = seed
+
+
+def recorded_miners(paths, seed):
+  """A MinerSpec per export file and frequency all boards were recorded
+  long enough at"""
+  rnd = random.Random(seed)
+  miners = []
+  for path in export_files(paths):
+    boards = record_codes(read_export(path))
+    for freq in sorted(set([f for f, c in boards.keys()])):
+      codes = [boards.get((freq, c), {}) for c in range(CHAINS)]
+      if min([sum([v[1] for v in cc.values()]) for cc in codes]) < MIN_RECORDED_MINUTES:
+        continue
+      miners.append(MinerSpec("%s@%s" %(miner_of(path), freq), [RecordedChain(cc) for cc in codes],
+                              int(freq), rnd.randint(0, 1 << 30)))
+  return miners
+
+
+def synthetic_miners(count, seed):
+  """count MinerSpecs of simminer chains with random sweet spots"""
+  rnd = random.Random(seed)
+  return [MinerSpec("sim-%i" %i, [ChainModel(rnd.randint(0xa0, 0xe8)) for c in range(CHAINS)],
+                    384, rnd.randint(0, 1 << 30)) for i in range(count)]
+
+
+class ReplayMiner(SimMiner):
+  """SimMiner handing out its stats the way the tuner keeps them. Error
+  rates and temperatures of the chains only change with their voltage or the
+  frequency, they are kept until one of them does."""
+
+  def __init__(self, *args, **kwargs):
+    SimMiner.__init__(self, *args, **kwargs)
+    self.cached = None
+
+  def _chains(self):
+    """(error rate, temperature) per chain"""
+    key = (self.frequency, tuple(self.voltage))
+    if self.cached is None or self.cached[0] != key:
+      values = []
+      for c, chain in enumerate(self.chains):
+        temp = chain.temp(self.voltage[c], self.frequency, self.ambient)
+        values.append((chain.rate(self.voltage[c], self.frequency, temp), temp))
+      self.cached = (key, values)
+    return self.cached[1]
+
+  def _advance(self):
+    now = self.clock()
+    minutes = (now - self.last) / 60.0
+    self.last = now
+    if minutes <= 0:
+      return
+    nominal = CHAIN_RATE * self.frequency / REF_FREQ
+    for c, (rate, temp) in enumerate(self._chains()):
+      self.errors[c] += poisson(rate * minutes, self.rnd)
+      self.ideal += nominal * minutes * 60
+      self.work += nominal * max(0.0, 1 - rate / COLLAPSE_RATE) * minutes * 60
+
+  def temp(self, chain):
+    return self._chains()[chain][1]
+
+  def chain_rates(self):
+    nominal = CHAIN_RATE * self.frequency / REF_FREQ
+    return [nominal * max(0.0, 1 - rate / COLLAPSE_RATE) for rate, temp in self._chains()]
+
+  def sample(self):
+    """stats() as MinerStats.as_dict() would return them"""
+    self.lock.acquire()
+    try:
+      self._advance()
+      rates = [round(r, 2) for r in self.chain_rates()]
+      temps = [temp for rate, temp in self._chains()]
+      return {'err': list(self.errors), 'chainrate': rates, 'temp_pcb': [int(t - 6) for t in temps],
+              'temp_chip': [int(t) for t in temps], 'asic_status': [ASIC_OK] * len(self.chains),
+              'speed': [round((self.work - self.restart_work) / max(self.last - self.started, 1), 2), round(sum(rates), 3)],
+              'uptime': int(self.last - self.started), 'frequency': str(self.frequency), 'device_error': 0.0,
+              'firmware': self.firmware}
+    finally:
+      self.lock.release()
+
+
+class NullMetrics(Metrics):
+  """Metrics registry that keeps nothing"""
+
+  def set(self, name, value, **labels):
+    pass
+
+  def inc(self, name, value=1, **labels):
+    pass
+
+  def observe(self, name, value, **labels):
+    pass
+
+  def timed(self, phase, func, *args, **labels):
+    return func(*args)
+
+
+class ReplayTuner(l3plus_autotune.MinerTuner):
+  """Tuner reading a ReplayMiner in process, without any output"""
+
+  def __init__(self, miner, fixed, search, priors=None, clock=time):
+    l3plus_autotune.MinerTuner.__init__(self, miner.ip, ssh=SimSSH([miner]), fixed=fixed, search=search,
+                                        metrics=NullMetrics(), export=None, priors=priors, clock=clock)
+    self.miner = miner
+    self.samples = 0
+    self.rounds = 0
+
+  def log(self, msg):
+    pass
+
+  def report_stats(self):
+    pass
+
+  def process_history(self, freq):
+    pass
+
+  def publish(self, freq):
+    pass
+
+  def ssh_timing(self):
+    return ''
+
+  def check_minerstatus(self, freq):
+    pass
+
+  def get_minerstats(self):
+    self.samples += 1
+    return self.miner.sample()
+
+  def set_voltages(self, voltages):
+    self.rounds += 1
+    return l3plus_autotune.MinerTuner.set_voltages(self, voltages)
+
+
+def tune(miner, clock, fixed, search, max_time=MAX_SIM_TIME, priors=None):
+  """Tune miner on clock, returns (seconds, tuner, finished)"""
+  tuner = ReplayTuner(miner, fixed, search, priors, clock)
+  start = clock.time()
+  finished = False
+  while clock.time() - start < max_time:
+    delay = tuner.step()
+    if delay is None:
+      finished = True
+      break
+    clock.sleep(delay)
+  return clock.time() - start, tuner, finished
+
+
+def replay(job):
+  """Tune one miner with one policy and hold it, job is (policy index,
+  policy, miner index, MinerSpec, hold hours). Returns the indexes and a
+  dict of the outcome."""
+  pi, policy, mi, spec, hold = job
+  policy.apply()
+  clock = SimClock()
+  miner = ReplayMiner(spec.name, spec.chains, frequency=spec.frequency, seed=spec.seed, clock=clock.time)
+  took, tuner, finished = tune(miner, clock, policy.schedule == 'fixed', policy.search)
+  limit = policy.max_err_rate()
+  codes = list(miner.voltage)
+  over, margin = 0, []
+  for c, chain in enumerate(miner.chains):
+    if chain.rate(codes[c], miner.frequency, miner.temp(c)) > limit:
+      over += 1
+    # codes below the highest voltage code that keeps the limit
+    margin.append(chain.best(miner.frequency, limit, miner.ambient) - codes[c])
+  res = {'seconds': took, 'finished': finished, 'samples': tuner.samples, 'rounds': tuner.rounds,
+         'over': over, 'margin': margin, 'lost': miner.lost(), 'watts': PowerModel().watts(miner.frequency, codes),
+         'held': [], 'hold_seconds': 0}
+  if hold > 0:
+    errors = list(miner.errors)
+    clock.sleep(hold * 3600)
+    miner.get_voltage(0)
+    res['held'] = [(miner.errors[c] - errors[c]) / (hold * 60.0) for c in range(len(errors))]
+    res['hold_seconds'] = hold * 3600
+  return pi, mi, res
+
+
+def percentile(values, p):
+  """Value below which a fraction p of values is, 0 for no values"""
+  if not values:
+    return 0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(policy, results):
+  """Summary metrics of the results of one policy, keyed like CSV_COLUMNS"""
+  n = len(results)
+  limit = policy.max_err_rate()
+  hours = [r['seconds'] / 3600.0 for r in results]
+  margin = sum([r['margin'] for r in results], [])
+  held = sum([r['held'] for r in results], [])
+  return {'policy': policy.name, 'miners': n, 'converged': sum([r['finished'] for r in results]),
+          'median_h': percentile(hours, 0.5), 'p90_h': percentile(hours, 0.9),
+          'samples': sum([r['samples'] for r in results]) / float(n), 'rounds': sum([r['rounds'] for r in results]) / float(n),
+          'chains_over_limit': sum([r['over'] for r in results]), 'codes_below_limit': sum(margin) / float(len(margin)),
+          'lost_pct': 100.0 * sum([r['lost'] for r in results]) / n,
+          'held_err_rate': held and sum(held) / len(held) or 0.0, 'held_over_limit': len([e for e in held if e > limit]),
+          'watts': sum([r['watts'] for r in results]) / n}
+
+
+def summary_table(rows):
+  rep = "| policy          | converged | median h | p90 h | samples | rounds | chains over limit | codes below limit | lost %  | held err/min | held over | W    |\n"
+  for s in rows:
+    rep += "| %-15s | %4i/%-4i | %8.2f | %5.2f | %7.0f | %6.1f | %17i | %17.1f | %7.3f | %12.3f | %9i | %4.0f |\n" %(
+      s['policy'][:15], s['converged'], s['miners'], s['median_h'], s['p90_h'], s['samples'], s['rounds'],
+      s['chains_over_limit'], s['codes_below_limit'], s['lost_pct'], s['held_err_rate'], s['held_over_limit'], s['watts'])
+  return rep
+
+
+def write_csv(path, rows):
+  fh = open(path, 'w')
+  try:
+    fh.write(",".join(CSV_COLUMNS) + "\n")
+    for s in rows:
+      fh.write(",".join([isinstance(s[c], float) and "%.4f" %s[c] or str(s[c]) for c in CSV_COLUMNS]) + "\n")
+  finally:
+    fh.close()
+
+
+def run(policies, miners, processes, hold):
+  """Replay every miner with every policy, returns the results per policy"""
+  jobs = [(pi, p, mi, m, hold) for pi, p in enumerate(policies) for mi, m in enumerate(miners)]
+  if processes > 1:
+    pool = multiprocessing.Pool(processes)
+    try:
+      # a timeout lets ^C through to the parent
+      done = pool.map_async(replay, jobs, chunksize=max(1, len(jobs) // (processes * 8))).get(1 << 30)
+    finally:
+      pool.terminate()
+  else:
+    done = map(replay, jobs)
+  results = [[None] * len(miners) for p in policies]
+  for pi, mi, res in done:
+    results[pi][mi] = res
+  return results
+
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "hn:p:j:H:s:o:", ["help", "miners=", "policy=", "processes=", "hold=",
+                                                              "seed=", "output="])
+  except getopt.GetoptError, e:
+    print e
+    opts, args = [('-h', '')], []
+  count, specs, processes, hold, seed, out = 0, [], multiprocessing.cpu_count(), HOLD_HOURS, 1, None
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      print "Usage: %s [-n <miners>] [-p <policy>].. [-j <processes>] [-H <hours>] [-s <seed>] [-o <csv>] [exports]" %sys.argv[0]
+      print "Replays synthetic miners (-n) and/or the export files or directories given with every policy,"
+      print "a policy is [<name>:]<param>=<value>,.. of %s, schedule=%s and search=%s" %(
+        ", ".join(sorted(POLICY_PARAMS.keys())), "|".join(SCHEDULES), "|".join(sorted(SEARCHES.keys())))
+      print "-H holds tuned miners at their final voltages for <hours> (default %i)" %HOLD_HOURS
+      sys.exit(1)
+    elif opt in ("-n", "--miners"):
+      count = int(arg)
+    elif opt in ("-p", "--policy"):
+      try:
+        specs.append(parse_policy(arg))
+      except ValueError, e:
+        print "Invalid policy %s: %s" %(arg, e)
+        sys.exit(1)
+    elif opt in ("-j", "--processes"):
+      processes = int(arg)
+    elif opt in ("-H", "--hold"):
+      hold = float(arg)
+    elif opt in ("-s", "--seed"):
+      seed = int(arg)
+    elif opt in ("-o", "--output"):
+      out = arg
+  policies = specs or [parse_policy(s) for s in DEFAULT_POLICIES]
+  miners = recorded_miners(args, seed)
+  if args:
+    print "%i recorded miners in %s" %(len(miners), ", ".join(args))
+  if not args and not count:
+    count = 100
+  miners += synthetic_miners(count, seed)
+  if not miners:
+    print "No miners to replay"
+    sys.exit(1)
+  start = time.time()
+  results = run(policies, miners, processes, hold)
+  took = time.time() - start
+  rows = [summarize(p, r) for p, r in zip(policies, results)]
+  sys.stdout.write(summary_table(rows))
+  tuned = sum([r['seconds'] for rr in results for r in rr]) / 86400.0
+  held = sum([r['hold_seconds'] for rr in results for r in rr]) / 86400.0
+  print "%i runs on %i process(es) in %.1fs: %.0f miner-days (%.0f tuning, %.0f held), %.0f miner-days/min, %.0f/min of tuning" %(
+    len(policies) * len(miners), processes, took, tuned + held, tuned, held, (tuned + held) / took * 60, tuned / took * 60)
+  if out:
+    write_csv(out, rows)
+    print "Summary written to %s" %out
+
+
+if __name__ == '__main__':
+  main()
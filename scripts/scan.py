@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# scan.py: read-only inventory of the L3+/L3++ miners in a fleet
+# --------------------------------------------------------------------------
+#
+# Asks every host of a fleet spec (ips, hostnames, CIDR ranges or a file of
+# them, like l3plus_autotune.py -f) for its cgminer stats, many hosts at a
+# time with short timeouts. Firmwares are told apart by the same markers the
+# tuner uses, L3 units are listed with their frequency, uptime, hash rate,
+# hw errors, chip temperatures and bad chips per chain. Nothing is changed
+# on the miners and no ssh is used, paramiko is not needed.
+#
+# Usage: ./scan.py [-j] [-a] [-w <workers>] [-t <timeout>] <fleet>
+
+import sys, re, json, time, getopt, socket, threading, Queue
+
+from cgminer_api import CgminerClient, MinerStats, ApiError, identify_firmware, API_PORT, DETECT_LEN
+from hosts import parse_fleet
+
+# hosts probed in parallel
+SCAN_WORKERS = 256
+# seconds to connect to a host and for each receive of its reply
+SCAN_TIMEOUT = 2.0
+# receive buffer of each worker, grown on demand
+SCAN_BUFSIZE = 8192
+# model string of the first STATS object
+TYPE_RE = re.compile(r'"Type":"([^"]*)"')
+
+# what a host turned out to be
+L3 = 'l3'
+# the cgminer API of some other miner
+OTHER = 'other'
+# an L3 firmware marker but stats that could not be parsed
+BROKEN = 'broken'
+# no API reply at all
+DOWN = 'down'
+STATES = (L3, OTHER, BROKEN, DOWN)
+
+
+def probe(client, host, port=API_PORT):
+  """Inventory record of host, a dict with at least host and state"""
+  rec = {'host': host}
+  try:
+    data = client.request(host, port)
+  except ApiError, e:
+    rec['state'], rec['error'] = DOWN, str(e).split("\n")[-1]
+    return rec
+  if not data.strip('\x00'):
+    rec['state'], rec['error'] = DOWN, "empty reply"
+    return rec
+  m = TYPE_RE.search(data[:DETECT_LEN])
+  rec['type'] = m and m.group(1) or None
+  fw = identify_firmware(data)
+  if fw is None:
+    rec['state'] = OTHER
+    return rec
+  rec['firmware'] = fw.name
+  try:
+    stats = MinerStats(fw.name, fw.parse(data), fw.chains)
+  except ApiError, e:
+    rec['state'], rec['error'] = BROKEN, str(e)
+    return rec
+  rec.update({'state': L3, 'frequency': stats.frequency, 'uptime': stats.uptime, 'ghs_av': stats.speed[0],
+              'err': stats.err, 'chainrate': stats.chainrate, 'temp_chip': stats.temp_chip,
+              'bad_chips': [s.count('x') for s in stats.asic_status], 'asic_status': stats.asic_status})
+  return rec
+
+
+def scan(hosts, port=API_PORT, workers=SCAN_WORKERS, timeout=SCAN_TIMEOUT):
+  """Probe all hosts with at most workers at a time, returns their records
+  in the order of hosts"""
+  queue = Queue.Queue()
+  for i, host in enumerate(hosts):
+    queue.put((i, host))
+  results = [None] * len(hosts)
+
+  def worker():
+    # CgminerClient is not thread safe, one per worker
+    client = CgminerClient(SCAN_BUFSIZE, timeout)
+    while True:
+      try:
+        i, host = queue.get_nowait()
+      except Queue.Empty:
+        return
+      results[i] = probe(client, host, port)
+
+  threads = []
+  for i in range(max(1, min(workers, len(hosts)))):
+    t = threading.Thread(target=worker, name="scan-%i" %i)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+  # join with timeout so ^C still reaches the main thread
+  for t in threads:
+    while t.isAlive():
+      t.join(1)
+  return results
+
+
+def inventory_table(records):
+  """One line per host, per chain values separated by slashes"""
+  rep = "| host            | firmware | type                      | MHz | uptime h | GH/s  | hw errors               | chip C      | bad chips |\n"
+  for r in records:
+    if r['state'] != L3:
+      rep += "| %-15s | %-8s | %-25s | %s |\n" %(r['host'], r['state'], (r.get('type') or '-')[:25], r.get('error', ''))
+      continue
+    rep += "| %-15s | %-8s | %-25s | %3s | %8.1f | %5.1f | %-23s | %-11s | %-9s |\n" %(r['host'], r['firmware'],
+      (r['type'] or '-')[:25], r['frequency'], r['uptime'] / 3600.0, r['ghs_av'], "/".join([str(e) for e in r['err']]),
+      "/".join([str(t) for t in r['temp_chip']]), "/".join([str(b) for b in r['bad_chips']]))
+  return rep
+
+
+def summary(records, seconds):
+  counts = dict([(s, 0) for s in STATES])
+  for r in records:
+    counts[r['state']] += 1
+  return "%i hosts scanned in %.1fs: %i L3+/L3++, %i other miners, %i unparsable, %i not answering" %(len(records),
+    seconds, counts[L3], counts[OTHER], counts[BROKEN], counts[DOWN])
+
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "jap:w:t:", ["json", "all", "port=", "workers=", "timeout="])
+  except getopt.GetoptError, e:
+    print e
+    args = None
+  if not args:
+    print "Usage: %s [-j|--json] [-a|--all] [-p <port>] [-w <workers>] [-t <timeout>] <fleet>" %sys.argv[0]
+    print "<fleet> is a file with one ip/hostname/CIDR per line or a comma separated list,"
+    print "-a also lists hosts that do not answer, -j prints JSON instead of a table."
+    sys.exit(1)
+  as_json, show_all, port, workers, timeout = False, False, API_PORT, SCAN_WORKERS, SCAN_TIMEOUT
+  for opt, arg in opts:
+    if opt in ("-j", "--json"):
+      as_json = True
+    elif opt in ("-a", "--all"):
+      show_all = True
+    elif opt in ("-p", "--port"):
+      port = int(arg)
+    elif opt in ("-w", "--workers"):
+      workers = int(arg)
+    elif opt in ("-t", "--timeout"):
+      timeout = float(arg)
+  try:
+    hosts = parse_fleet(",".join(args))
+  except (ValueError, socket.error), e:
+    print "Invalid fleet given: %s" %e
+    sys.exit(1)
+  start = time.time()
+  records = scan(hosts, port, workers, timeout)
+  took = time.time() - start
+  shown = [r for r in records if show_all or r['state'] != DOWN]
+  if as_json:
+    print json.dumps(shown, indent=1, sort_keys=True)
+    # keep stdout valid JSON
+    sys.stderr.write(summary(records, took) + "\n")
+  else:
+    sys.stdout.write(inventory_table(shown))
+    print summary(records, took)
+
+
+if __name__ == '__main__':
+  main()
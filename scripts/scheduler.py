@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# scheduler.py: when to sample a miner and when to change its voltages
+# --------------------------------------------------------------------------
+#
+# Every chain runs through its own states: SETTLING after a voltage change
+# until the errors at the new voltage can be judged, PROBING while it is
+# tuned, LOCKED once a change was decided but could not be made, and STABLE
+# once it is done. A miner is done when all of its chains are, a change on
+# one chain does not restart the clocks of the others.
+#
+# FixedSchedule is the classic behaviour of l3plus_autotune.py: sample every
+# minute, consider voltage changes every 5 minutes based on the windowed
+# error rates and finish a chain after 15 minutes without a change.
+#
+# AdaptiveSchedule counts the hw errors of every chain since its last voltage
+# change and puts a poisson confidence interval on the error rate. A chain is
+# changed as soon as the interval is clearly above or below the limits, the
+# windowed rules are only used when no confident answer came up within
+# TUNE_REPEAT. Sampling is fast while errors come in and backs off while
+# waiting for a chain to become confidently good or stable, stable chains
+# are not waited for.
+
+import math
+
+RAISE = 'raise'
+LOWER = 'lower'
+
+# chain states
+SETTLING = 'settling'
+PROBING = 'probing'
+LOCKED = 'locked'
+STABLE = 'stable'
+
+# seconds between samples of the fixed schedule
+REPEAT = 60
+# bounds of the seconds between samples of the adaptive schedule
+MIN_REPEAT = 15
+MAX_REPEAT = 300
+# seconds between voltage decisions of the fixed schedule, and until the
+# adaptive one falls back to the windowed rules
+TUNE_REPEAT = 300
+# seconds of history needed before the windowed rates lower a voltage
+WINDOW_TIME = 600
+# seconds without a voltage change until a chain is stable
+STABLE_TIME = 900
+# seconds without a change after which a chain of the adaptive schedule is
+# stable even if its error rate is still uncertain
+MAX_STABLE_TIME = 1800
+# seconds a chain stays at a new voltage before it is judged
+MIN_DWELL = 60
+# one sided z score of the confidence bounds, 1.645 = 95%
+CONFIDENCE_Z = 1.645
+# chains are undervolted further below this fraction of the max error rate
+LOWER_FACTOR = 0.75
+
+
+def error_bounds(errors, z=CONFIDENCE_Z):
+  """Confidence bounds of the mean of a poisson count, Byar's approximation
+  of the exact interval"""
+  lo = 0.0
+  if errors > 0:
+    lo = errors * (1 - 1.0/(9*errors) - z/(3*math.sqrt(errors)))**3
+  k = errors + 1
+  hi = k * (1 - 1.0/(9*k) + z/(3*math.sqrt(k)))**3
+  return max(lo, 0.0), hi
+
+
+def rate_interval(errors, seconds, z=CONFIDENCE_Z):
+  """Confidence bounds in errors/min of a rate of errors counted over seconds"""
+  if seconds <= 0:
+    return 0.0, float('inf')
+  lo, hi = error_bounds(errors, z)
+  return lo * 60 / seconds, hi * 60 / seconds
+
+
+class FixedSchedule(object):
+  """Sample every repeat seconds, decide on every chain every tune_repeat seconds"""
+
+  def __init__(self, chains, max_err_rate, repeat=REPEAT, tune_repeat=TUNE_REPEAT, stable_time=STABLE_TIME):
+    self.chains = chains
+    self.max_err_rate = max_err_rate
+    self.repeat = repeat
+    self.tune_repeat = tune_repeat
+    self.stable_time = stable_time
+    # per chain (timestamp, error count) of the last change
+    self.since = {}
+    # per chain timestamp of the last decision
+    self.decided = {}
+    # per chain state and timestamp it was entered
+    self.state = {}
+    self.entered = {}
+    # timestamp from which the windowed rates can lower voltages
+    self.windowed = 0
+
+  def start(self, ts, errors):
+    """(Re)start tuning at ts with the given error counters"""
+    for c in self.chains:
+      self.since[c] = (ts, errors[c])
+      self.decided[c] = ts
+      self.enter(c, SETTLING, ts)
+
+  def enter(self, chain, state, ts):
+    if self.state.get(chain) != state:
+      self.state[chain] = state
+      self.entered[chain] = ts
+
+  def exposure(self, chain, ts, errors):
+    """(errors, seconds) of chain since its last change"""
+    since_ts, since_err = self.since[chain]
+    return errors[chain] - since_err, ts - since_ts
+
+  def settled(self, chain, ts):
+    """True once the errors at the current voltage of chain can be judged"""
+    return ts - self.since[chain][0] >= self.tune_repeat - 5
+
+  def finished(self, chain, ts, errors):
+    """True once chain was not changed for stable_time while it could have been"""
+    return ts - max(self.since[chain][0], self.windowed) > self.stable_time
+
+  def update(self, hist, ts):
+    """Advance the chain states to ts"""
+    errors = hist.rates.errors()
+    self.windowed = hist.get('timestamp', 0) + WINDOW_TIME
+    for c in self.chains:
+      if self.state[c] == SETTLING and self.settled(c, ts):
+        self.enter(c, PROBING, ts)
+      if self.state[c] in (PROBING, LOCKED) and self.finished(c, ts, errors):
+        self.enter(c, STABLE, ts)
+
+  def window_action(self, hist, chain, ts):
+    """RAISE, LOWER or None from the windowed error rates of the history"""
+    if hist.get('error_rate5')[chain] > self.max_err_rate:
+      return RAISE
+    if hist.get('error_rate10')[chain] == 0 and hist.get('error_rate15')[chain] < self.max_err_rate * LOWER_FACTOR \
+        and ts - hist.get('timestamp', 0) > WINDOW_TIME:
+      return LOWER
+    return None
+
+  def decide(self, hist, ts):
+    """Chains to change now, as a dict of chain index to RAISE or LOWER. Stable
+    chains are only raised, locked ones are not lowered again."""
+    self.update(hist, ts)
+    actions = {}
+    for c in self.chains:
+      if self.state[c] == SETTLING or ts - self.decided[c] <= self.tune_repeat - 5:
+        continue
+      self.decided[c] = ts
+      action = self.window_action(hist, c, ts)
+      if action == RAISE or (action == LOWER and self.state[c] == PROBING):
+        actions[c] = action
+    return actions
+
+  def changed(self, chain, ts, errors):
+    """The voltage of chain was changed at ts"""
+    self.since[chain] = (ts, errors[chain])
+    self.decided[chain] = ts
+    self.enter(chain, SETTLING, ts)
+
+  def unchanged(self, chain, ts, errors):
+    """A decision on chain did not lead to a voltage change, it is as low or
+    as high as it goes"""
+    self.enter(chain, LOCKED, ts)
+
+  def stable(self, hist, ts):
+    """True once every chain is done"""
+    self.update(hist, ts)
+    for c in self.chains:
+      if self.state[c] != STABLE:
+        return False
+    return True
+
+  def next_sample(self, hist, ts):
+    """Seconds until the next sample"""
+    return self.repeat
+
+
+class AdaptiveSchedule(FixedSchedule):
+  """Decide per chain as soon as its error rate is known with confidence"""
+
+  def __init__(self, chains, max_err_rate, tune_repeat=TUNE_REPEAT, stable_time=STABLE_TIME,
+               min_repeat=MIN_REPEAT, max_repeat=MAX_REPEAT, min_dwell=MIN_DWELL, z=CONFIDENCE_Z,
+               max_stable_time=MAX_STABLE_TIME):
+    FixedSchedule.__init__(self, chains, max_err_rate, min_repeat, tune_repeat, stable_time)
+    self.max_stable_time = max_stable_time
+    self.min_repeat = min_repeat
+    self.max_repeat = max_repeat
+    self.min_dwell = min_dwell
+    self.z = z
+
+  def interval(self, chain, ts, errors):
+    """Error rate bounds of chain since its last change"""
+    count, seconds = self.exposure(chain, ts, errors)
+    return rate_interval(count, seconds, self.z)
+
+  def rate(self, chain, ts, errors):
+    """Error rate of chain since its last change"""
+    since_ts, since_err = self.since[chain]
+    if ts <= since_ts:
+      return 0.0
+    return (errors[chain] - since_err) * 60.0 / (ts - since_ts)
+
+  def settled(self, chain, ts):
+    return ts - self.since[chain][0] >= self.min_dwell
+
+  def finished(self, chain, ts, errors):
+    """True once chain is as low as it goes and confidently below the max error
+    rate, or was not changed for stable_time and is confidently too close to
+    the max to be lowered, or for max_stable_time"""
+    lo, hi = self.interval(chain, ts, errors)
+    if self.state[chain] == LOCKED and hi < self.max_err_rate:
+      return True
+    if not FixedSchedule.finished(self, chain, ts, errors):
+      return False
+    return lo > self.max_err_rate * LOWER_FACTOR or \
+      ts - max(self.since[chain][0], self.windowed) > self.max_stable_time
+
+  def decide(self, hist, ts):
+    self.update(hist, ts)
+    actions = {}
+    errors = hist.rates.errors()
+    for c in self.chains:
+      state = self.state[c]
+      if state == SETTLING:
+        continue
+      lo, hi = self.interval(c, ts, errors)
+      if lo > self.max_err_rate:
+        actions[c] = RAISE
+      elif state == STABLE:
+        continue
+      elif hi < self.max_err_rate * LOWER_FACTOR and state == PROBING:
+        actions[c] = LOWER
+      elif ts - self.decided[c] >= self.tune_repeat - 5:
+        # no confident answer yet, fall back to the windowed rates, but only
+        # raise if the rate since the change agrees, the windows are noisy
+        action = self.window_action(hist, c, ts)
+        self.decided[c] = ts
+        if action == RAISE and self.rate(c, ts, errors) > self.max_err_rate:
+          actions[c] = action
+        elif action == LOWER and state == PROBING:
+          actions[c] = action
+    for c in actions:
+      self.decided[c] = ts
+    return actions
+
+  def next_sample(self, hist, ts):
+    """Sample fast while errors come in faster than allowed, otherwise wait
+    for the earliest time a chain could be decided on or become stable"""
+    errors = hist.rates.errors()
+    wait = self.max_repeat
+    for c in self.chains:
+      state = self.state[c]
+      if state == STABLE:
+        continue
+      since_ts, since_err = self.since[c]
+      dwell = ts - since_ts
+      count = errors[c] - since_err
+      if count and dwell > 0 and count * 60.0 / dwell > self.max_err_rate:
+        return self.min_repeat
+      unchanged = max(since_ts, self.windowed)
+      if ts - unchanged > self.stable_time:
+        stable_at = unchanged + self.max_stable_time + 1
+      else:
+        stable_at = unchanged + self.stable_time + 1
+      # the upper bound drops below the threshold to lower or, if locked, to
+      # become stable if no more errors come
+      if state == LOCKED:
+        wait = min(wait, error_bounds(count, self.z)[1] * 60 / self.max_err_rate - dwell)
+      else:
+        wait = min(wait, error_bounds(count, self.z)[1] * 60 / (self.max_err_rate * LOWER_FACTOR) - dwell)
+      if state == SETTLING:
+        wait = min(wait, since_ts + self.min_dwell - ts)
+      wait = min(wait, self.decided[c] + self.tune_repeat - ts, stable_at - ts)
+    return max(self.min_repeat, min(wait, self.max_repeat))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# search.py: strategies picking the next voltage of a chain
+# --------------------------------------------------------------------------
+#
+# Once the schedule decided that a chain has to be undervolted further or
+# needs more voltage, a SearchStrategy picks the voltage code to try next.
+# Higher codes mean lower voltage. Strategies get an Observation of the
+# current code, the errors counted since the last change, and a predicate
+# telling if the outcome index has a code on record as too bad to test.
+#
+# StepSearch is the original heuristic of l3plus_autotune.py. BisectSearch
+# gallops upwards until a code turns out bad and then bisects between the
+# highest good and the lowest bad code. BanditSearch keeps poisson confidence
+# bounds on the error rate of every code it tried and picks the highest code
+# that is not confidently bad, assuming the error rate grows at most by
+# GROWTH_BOUND per code, so a single very bad code rules out its neighbours.
+
+import math
+
+from scheduler import rate_interval, CONFIDENCE_Z
+
+# codes added to the step on every further undervolt in a row
+INITIAL_STEP = 4
+MAX_STEP = 16
+# max. factor the error rate grows by per code of undervolt
+GROWTH_BOUND = 2.0
+
+
+class Observation(object):
+  """What is known about the current code of a chain when deciding"""
+  __slots__ = ['rate5', 'rate10', 'rate15', 'errors', 'seconds', 'since']
+
+  def __init__(self, rate5, rate10, rate15, errors, seconds, since):
+    self.rate5 = rate5
+    self.rate10 = rate10
+    self.rate15 = rate15
+    # errors counted over seconds since the change at timestamp since
+    self.errors = errors
+    self.seconds = seconds
+    self.since = since
+
+
+def raise_step(obs):
+  """Codes to overvolt by, 2 to 7 the more errors are seen"""
+  return min(max(int(obs.rate5 * 5), 2), 7)
+
+
+class SearchStrategy(object):
+  """Base class, strategies return the next code or None to stay"""
+  name = None
+
+  def __init__(self, max_err_rate, min_code, max_code, outcomes=None):
+    self.max_err_rate = max_err_rate
+    # min_code is the highest allowed voltage, max_code the lowest
+    self.min_code = min_code
+    self.max_code = max_code
+    self.outcomes = outcomes
+
+  def lower_voltage(self, freq, chain, code, obs, acceptable):
+    """Next (higher) code for a chain doing fine at code"""
+    raise NotImplementedError
+
+  def raise_voltage(self, freq, chain, code, obs, acceptable):
+    """Next (lower) code for a chain making too many errors at code"""
+    raise NotImplementedError
+
+
+class StepSearch(SearchStrategy):
+  """Steps of up to 7 codes, the smaller the more errors are seen"""
+  name = 'step'
+
+  def lower_voltage(self, freq, chain, code, obs, acceptable):
+    step = min(int(0.35 / (obs.rate15 + 0.01)), 7)
+    new = min(code + step, self.max_code)
+    while not acceptable(new) and new > code:
+      new -= 1
+    return new
+
+  def raise_voltage(self, freq, chain, code, obs, acceptable):
+    new = max(code - raise_step(obs), self.min_code)
+    while not acceptable(new) and new < code:
+      new += 1
+    return new
+
+
+class BisectSearch(SearchStrategy):
+  """Gallop until bracketed, then bisect between good and bad codes"""
+  name = 'bisect'
+
+  def __init__(self, max_err_rate, min_code, max_code, outcomes=None):
+    SearchStrategy.__init__(self, max_err_rate, min_code, max_code, outcomes)
+    # per (freq, chain) [highest good code, lowest bad code, gallop step]
+    self.brackets = {}
+
+  def bracket(self, freq, chain, code, acceptable):
+    key = (freq, chain)
+    if not self.brackets.has_key(key):
+      # start with the lowest code above the current one on record as bad
+      bad = None
+      if self.outcomes is not None:
+        for c, o in self.outcomes.tested(freq, chain):
+          if c > code and not acceptable(c):
+            bad = c
+            break
+      self.brackets[key] = [None, bad, INITIAL_STEP]
+    return self.brackets[key]
+
+  def lower_voltage(self, freq, chain, code, obs, acceptable):
+    b = self.bracket(freq, chain, code, acceptable)
+    b[0] = code
+    if b[1] is not None and b[1] <= code:
+      # the chain got better, forget the old bad code
+      b[1] = None
+    while True:
+      if b[1] is None:
+        new = min(code + b[2], self.max_code)
+      else:
+        new = (code + b[1]) / 2
+      if new <= code:
+        return None
+      if acceptable(new):
+        break
+      b[1] = new
+    if b[1] is None:
+      b[2] = min(b[2] * 2, MAX_STEP)
+    return new
+
+  def raise_voltage(self, freq, chain, code, obs, acceptable):
+    b = self.bracket(freq, chain, code, acceptable)
+    b[1] = code
+    b[2] = INITIAL_STEP
+    if b[0] is not None and b[0] >= code:
+      b[0] = None
+    if b[0] is None:
+      new = code - raise_step(obs)
+    else:
+      new = (b[0] + code) / 2
+    new = max(new, self.min_code)
+    while not acceptable(new) and new > self.min_code:
+      new -= 1
+    if new >= code:
+      return None
+    return new
+
+
+class BanditSearch(SearchStrategy):
+  """Confidence bounded search over the codes of a chain.
+
+  Every code is an arm with the errors and seconds observed at it. The lower
+  confidence bound of a code's rate is raised by the bounds of lower codes
+  (rates only grow with the code) and of higher codes divided by
+  GROWTH_BOUND per code. Undervolting gallops like BisectSearch but never
+  past the highest code that is not confidently bad. Overvolting steps down
+  like StepSearch and from there to the highest code that is not confidently
+  bad. Stepping down by a single code got chains back to the code above the
+  best one from above, where the error rate is too close to the max to be
+  confidently bad before the chain becomes stable."""
+  name = 'bandit'
+
+  def __init__(self, max_err_rate, min_code, max_code, outcomes=None, z=CONFIDENCE_Z, growth=GROWTH_BOUND):
+    SearchStrategy.__init__(self, max_err_rate, min_code, max_code, outcomes)
+    self.z = z
+    self.growth = growth
+    # per (freq, chain) {code: {since: (errors, seconds)}}
+    self.arms = {}
+    self.steps = {}
+
+  def _arms(self, freq, chain):
+    key = (freq, chain)
+    if not self.arms.has_key(key):
+      arms = self.arms[key] = {}
+      if self.outcomes is not None:
+        # outcomes only hold windowed rates, samples are assumed a minute apart
+        for c, o in self.outcomes.tested(freq, chain):
+          arms[c] = {None: (int(round(o.means()[1] * o.count)), o.count * 60)}
+    return self.arms[key]
+
+  def observe(self, freq, chain, code, obs):
+    """Account the errors seen at code since the last change"""
+    self._arms(freq, chain).setdefault(code, {})[obs.since] = (obs.errors, obs.seconds)
+
+  def bounds(self, arms):
+    """Per arm (code, lower, upper) error rate bounds"""
+    res = []
+    for c, visits in arms.items():
+      errors = sum([v[0] for v in visits.values()])
+      seconds = sum([v[1] for v in visits.values()])
+      if seconds > 0:
+        res.append((c,) + rate_interval(errors, seconds, self.z))
+    return res
+
+  def lower_bound(self, bounds, code):
+    """Lower confidence bound of the error rate at code"""
+    lo = 0.0
+    for c, l, h in bounds:
+      if c <= code:
+        lo = max(lo, l)
+      else:
+        lo = max(lo, l / self.growth ** (c - code))
+    return lo
+
+  def plausible(self, bounds, code):
+    """True unless code is confidently too bad"""
+    return self.lower_bound(bounds, code) <= self.max_err_rate
+
+  def lower_voltage(self, freq, chain, code, obs, acceptable):
+    self.observe(freq, chain, code, obs)
+    bounds = self.bounds(self._arms(freq, chain))
+    step = self.steps.get((freq, chain), INITIAL_STEP)
+    new = min(code + step, self.max_code)
+    while new > code and not (self.plausible(bounds, new) and acceptable(new)):
+      new -= 1
+    if new <= code:
+      return None
+    self.steps[(freq, chain)] = min(step * 2, MAX_STEP)
+    return new
+
+  def raise_voltage(self, freq, chain, code, obs, acceptable):
+    self.observe(freq, chain, code, obs)
+    bounds = self.bounds(self._arms(freq, chain))
+    self.steps[(freq, chain)] = INITIAL_STEP
+    new = code - raise_step(obs)
+    while new > self.min_code and not (self.plausible(bounds, new) and acceptable(new)):
+      new -= 1
+    new = max(new, self.min_code)
+    if new >= code:
+      return None
+    return new
+
+
+SEARCHES = dict([(s.name, s) for s in (StepSearch, BisectSearch, BanditSearch)])
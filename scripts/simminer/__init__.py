@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# simminer: simulated L3+ miners to run l3plus_autotune.py against
+# --------------------------------------------------------------------------
+#
+# model.py holds the per chain error/temperature model and the miner state,
+# server.py serves their stats over the cgminer API and ssh.py answers the
+# sv commands of the tuner in place of SSHPool. bench_sim.py tunes fleets of
+# them on a simulated clock.
+
+from simminer.model import ChainModel, SimMiner, SimClock, random_miner
+from simminer.server import CgminerServer, stats_reply, loopback_ips, FIRMWARE_TYPES
+from simminer.ssh import SimSSH, SimChannel
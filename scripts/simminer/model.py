@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# simminer/model.py: error, temperature and hash rate model of a simulated L3+
+# --------------------------------------------------------------------------
+#
+# Every chain has a sweet spot voltage code at the reference frequency and
+# temperature. At or above the voltage of the sweet spot it makes BASE_RATE
+# hw errors/min, every code of undervolt past it multiplies the rate by
+# GROWTH. Higher frequencies move the sweet spot to higher voltages, hotter
+# chips make more errors. Errors are drawn from a poisson distribution over
+# the time since the miner was last advanced.
+
+import math, random, threading, time
+
+# errors/min of a chain at or above the voltage of its sweet spot
+BASE_RATE = 0.02
+# error rate factor per code of undervolt past the sweet spot
+GROWTH = 1.5
+# frequency (MHz) and chip temperature (C) the sweet spot is given for
+REF_FREQ = 384
+REF_TEMP = 60
+# sweet spot codes lost per MHz above REF_FREQ
+CODES_PER_MHZ = 0.1
+# error rate factor per degree above REF_TEMP
+TEMP_GROWTH = 1.03
+# chip temperature rise over ambient at REF_FREQ and 10V
+TEMP_RISE = 35.0
+AMBIENT = 25.0
+# MH/s of one chain at REF_FREQ
+CHAIN_RATE = 126.0
+# error rate at which a chain stops producing useful work, hash rate drops
+# linearly towards it
+COLLAPSE_RATE = 120.0
+# voltage code the PICs come up with
+DEFAULT_VOLTAGE = 0x80
+
+
+class SimClock(object):
+  """Stand-in for the time module, hours of tuning pass in seconds"""
+
+  def __init__(self, now=1500000000.0):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+def code_volts(code):
+  """Chain voltage of a PIC voltage code, 0x80 is 10V, 0x00 11V, 0xfe ~9V"""
+  return 10.0 + (DEFAULT_VOLTAGE - code) / 128.0
+
+
+def poisson(lam, rnd):
+  """Poisson distributed random count with mean lam"""
+  if lam > 30:
+    return max(0, int(rnd.gauss(lam, math.sqrt(lam)) + 0.5))
+  limit = math.exp(-lam)
+  k, p = 0, rnd.random()
+  while p > limit:
+    k += 1
+    p *= rnd.random()
+  return k
+
+
+class ChainModel(object):
+  """Error rate and temperature of one hash board"""
+
+  def __init__(self, sweet, base_rate=BASE_RATE, growth=GROWTH, codes_per_mhz=CODES_PER_MHZ,
+               temp_growth=TEMP_GROWTH, temp_rise=TEMP_RISE):
+    self.sweet = sweet
+    self.base_rate = base_rate
+    self.growth = growth
+    self.codes_per_mhz = codes_per_mhz
+    self.temp_growth = temp_growth
+    self.temp_rise = temp_rise
+
+  def sweet_spot(self, freq):
+    """Highest code without extra errors at freq"""
+    return self.sweet - (freq - REF_FREQ) * self.codes_per_mhz
+
+  def temp(self, code, freq, ambient=AMBIENT):
+    """Chip temperature, power goes with frequency and voltage squared"""
+    return ambient + self.temp_rise * freq / REF_FREQ * (code_volts(code) / 10.0) ** 2
+
+  def rate(self, code, freq, temp):
+    """hw errors/min"""
+    over = max(code - self.sweet_spot(freq), 0)
+    return self.base_rate * self.growth ** over * self.temp_growth ** (temp - REF_TEMP)
+
+  def best(self, freq, max_rate, ambient=AMBIENT):
+    """Highest code with an error rate below max_rate"""
+    code = 0xfe
+    while code > 0 and self.rate(code, freq, self.temp(code, freq, ambient)) > max_rate:
+      code -= 1
+    return code
+
+
+class SimMiner(object):
+  """State of one simulated miner, advanced lazily to the time of each access"""
+
+  def __init__(self, ip, chains, frequency=REF_FREQ, firmware='stock', ambient=AMBIENT,
+               seed=None, clock=time.time):
+    self.ip = ip
+    self.chains = chains
+    self.frequency = frequency
+    self.firmware = firmware
+    self.ambient = ambient
+    self.clock = clock
+    self.rnd = random.Random(seed)
+    self.lock = threading.Lock()
+    self.voltage = [DEFAULT_VOLTAGE] * len(chains)
+    self.errors = [0] * len(chains)
+    self.started = self.last = clock()
+    # MH of work done and what it would have been without errors
+    self.work = 0.0
+    self.ideal = 0.0
+    # work done before the last restart, not part of GHS av
+    self.restart_work = 0.0
+    self.voltage_writes = 0
+
+  def _advance(self):
+    now = self.clock()
+    minutes = (now - self.last) / 60.0
+    self.last = now
+    if minutes <= 0:
+      return
+    nominal = CHAIN_RATE * self.frequency / REF_FREQ
+    for c, chain in enumerate(self.chains):
+      rate = chain.rate(self.voltage[c], self.frequency, self.temp(c))
+      self.errors[c] += poisson(rate * minutes, self.rnd)
+      self.ideal += nominal * minutes * 60
+      self.work += nominal * max(0.0, 1 - rate / COLLAPSE_RATE) * minutes * 60
+
+  def temp(self, chain):
+    return self.chains[chain].temp(self.voltage[chain], self.frequency, self.ambient)
+
+  def chain_rates(self):
+    """Current MH/s per chain"""
+    nominal = CHAIN_RATE * self.frequency / REF_FREQ
+    return [nominal * max(0.0, 1 - c.rate(self.voltage[i], self.frequency, self.temp(i)) / COLLAPSE_RATE)
+            for i, c in enumerate(self.chains)]
+
+  def get_voltage(self, chain):
+    self.lock.acquire()
+    try:
+      self._advance()
+      return self.voltage[chain]
+    finally:
+      self.lock.release()
+
+  def set_voltage(self, chain, code):
+    """Set the voltage code of chain, errors so far are accounted at the old one"""
+    self.lock.acquire()
+    try:
+      self._advance()
+      self.voltage[chain] = code
+      self.voltage_writes += 1
+    finally:
+      self.lock.release()
+
+  def restart(self, frequency):
+    """Restart cgminer at frequency, the PICs come up at their default voltage"""
+    self.lock.acquire()
+    try:
+      self._advance()
+      self.frequency = frequency
+      self.voltage = [DEFAULT_VOLTAGE] * len(self.chains)
+      self.errors = [0] * len(self.chains)
+      self.started = self.last
+      self.restart_work = self.work
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    """The values of a cgminer stats reply, keyed like the reply"""
+    self.lock.acquire()
+    try:
+      self._advance()
+      rates = self.chain_rates()
+      values = {'Elapsed': int(self.last - self.started), 'frequency': str(self.frequency),
+                'GHS 5s': '%.3f' %sum(rates), 'GHS av': round((self.work - self.restart_work) / max(self.last - self.started, 1), 2),
+                'Device Hardware%': 0.0}
+      for c in range(len(self.chains)):
+        temp = self.temp(c)
+        values['chain_hw%i' %(c+1)] = self.errors[c]
+        values['chain_rate%i' %(c+1)] = '%.2f' %rates[c]
+        values['temp%i' %(c+1)] = int(temp - 6)
+        values['temp2_%i' %(c+1)] = int(temp)
+        values['chain_acs%i' %(c+1)] = ' ' + ' '.join(['oooooooo'] * 9)
+      return values
+    finally:
+      self.lock.release()
+
+  def lost(self):
+    """Fraction of the work lost to hw errors so far"""
+    self.lock.acquire()
+    try:
+      self._advance()
+      if not self.ideal:
+        return 0.0
+      return 1 - self.work / self.ideal
+    finally:
+      self.lock.release()
+
+
+def random_miner(ip, rnd, clock=time.time, firmware=None):
+  """A miner with random sweet spots, frequency and firmware"""
+  chains = [ChainModel(rnd.randint(0xa0, 0xe8)) for c in range(4)]
+  return SimMiner(ip, chains, frequency=rnd.choice([384, 400, 425, 450]),
+                  firmware=firmware or rnd.choice(['stock', 'l3++', 'blissz']),
+                  ambient=rnd.uniform(20, 35), seed=rnd.randint(0, 1 << 30), clock=clock)
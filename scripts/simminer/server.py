@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# simminer/server.py: cgminer API server for simulated miners
+# --------------------------------------------------------------------------
+#
+# Answers the cgminer 'stats' command like the L3 firmwares do, including
+# their quirk of a missing comma after the first STATS object and the
+# trailing NUL byte. One listening socket serves any number of miners, each
+# on its own loopback address (127.0.0.0/8 is routed to lo on Linux), the
+# miner is picked by the address a connection was made to.
+
+import json, socket, struct, threading, SocketServer
+
+API_PORT = 4028
+# Type of the first STATS object per firmware, the tuner detects firmwares by it
+FIRMWARE_TYPES = {
+  'stock': 'Antminer L3+',
+  'l3++': 'Antminer L3++',
+  'blissz': 'Antminer L3+ Blissz v1.02',
+}
+
+
+def stats_reply(miner):
+  """Raw stats reply of a SimMiner"""
+  head = {"STATUS": [{"STATUS": "S", "When": int(miner.last), "Code": 70, "Msg": "CGMiner stats",
+                      "Description": "cgminer 4.9.0"}]}
+  # Type has to be the last field, the tuner's fixup() relies on it
+  first = '{"CGMiner":"4.9.0","Miner":"1.0.1.3","Type":"%s"}' %FIRMWARE_TYPES[miner.firmware]
+  chain = {"STATS": 0, "ID": "L30", "miner_count": len(miner.chains)}
+  chain.update(miner.stats())
+  # the firmwares put no comma between the two STATS objects
+  return json.dumps(head)[:-1] + ',"STATS":[' + first + json.dumps(chain) + '],"id":1}\x00'
+
+
+def error_reply(msg):
+  return json.dumps({"STATUS": [{"STATUS": "E", "Code": 14, "Msg": msg, "Description": "cgminer 4.9.0"}],
+                     "id": 1}) + '\x00'
+
+
+def loopback_ips(count, first=1):
+  """count loopback addresses from 127.1.0.<first> on, one per simulated miner"""
+  base = struct.unpack('!I', socket.inet_aton('127.1.0.0'))[0] + first
+  return [socket.inet_ntoa(struct.pack('!I', base + i)) for i in range(count)]
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+
+  def handle(self):
+    miner = self.server.miners.get(self.request.getsockname()[0])
+    if miner is None:
+      return
+    data = ''
+    while True:
+      chunk = self.request.recv(1024)
+      if not chunk:
+        break
+      data += chunk
+      try:
+        cmd = json.loads(data.strip('\x00')).get('command')
+        break
+      except ValueError:
+        continue
+    else:
+      return
+    if cmd == 'stats':
+      reply = stats_reply(miner)
+    else:
+      reply = error_reply("Invalid command")
+    self.request.sendall(reply)
+
+
+class CgminerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """Serves the stats of SimMiners keyed by ip, on all loopback addresses"""
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+  def __init__(self, miners, port=API_PORT):
+    self.miners = dict([(m.ip, m) for m in miners])
+    # a single miner on 127.0.0.1 does not need the wildcard address
+    if self.miners.keys() == ['127.0.0.1']:
+      host = '127.0.0.1'
+    else:
+      host = ''
+    SocketServer.TCPServer.__init__(self, (host, port), _Handler)
+    self.port = self.server_address[1]
+    self.thread = None
+
+  def verify_request(self, request, client_address):
+    # the wildcard address is only bound to reach all of 127/8
+    return client_address[0].startswith('127.')
+
+  def start(self):
+    """Serve in a background thread"""
+    self.thread = threading.Thread(target=self.serve_forever, name="cgminer-sim")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# simminer/ssh.py: stand-in for SSHPool running the sv tool on SimMiners
+# --------------------------------------------------------------------------
+#
+# Implements the SSHPool interface used by l3plus_autotune.py. Commands are
+# not executed, the sv invocations (read, single set, batch and agent mode)
+# are answered with the output set_voltage_new.c would print, against the
+# voltages of the simulated miner. The frequency change of the tuner (a sed
+# of "bitmain-freq" in cgminer.conf and a cgminer restart) restarts the
+# simulated miner at the new frequency. Files written with put() or cat and
+# the md5sum, mv -f and rm -f of the deployment are kept per host in memory.
+# Anything else fails like a missing binary.
+
+import re, time, hashlib
+
+# the frequency the tuner writes to cgminer.conf
+FREQ_RE = re.compile(r'"bitmain-freq" : "(\d+)"')
+# seconds a PIC takes to apply a voltage, only slept if latency is enabled
+PIC_SET_TIME = 1.5
+
+
+class SimChannel(object):
+  """An 'sv agent' session, answers each request line as it is sent"""
+
+  def __init__(self, pool, miner):
+    self.pool = pool
+    self.miner = miner
+    self.closed = False
+    self.lines = ["ready"]
+
+  def settimeout(self, timeout):
+    pass
+
+  def makefile(self, mode='r'):
+    return self
+
+  def readline(self):
+    if not self.lines:
+      return ''
+    return self.lines.pop(0) + "\n"
+
+  def sendall(self, data):
+    for cmd in data.strip().split("\n"):
+      args = cmd.split()
+      if not args or args[0] == 'quit':
+        self.closed = True
+        return
+      if args[0] == 'get':
+        chains = len(args) > 1 and [int(args[1]) - 1] or range(len(self.miner.chains))
+        self.lines.extend(["chain %i: voltage = 0x%02x" %(c+1, self.miner.get_voltage(c)) for c in chains])
+        self.lines.append("ok")
+      elif args[0] == 'set':
+        lines = self.pool.set_pairs(self.miner, args[1:])
+        self.lines.extend(lines)
+        failed = len([l for l in lines if not l.endswith(" OK")])
+        self.lines.append(failed and "error %i chain(s) failed" %failed or "ok")
+      else:
+        self.lines.append("error unknown command %s" %args[0])
+
+  def close(self):
+    self.closed = True
+
+
+class SimSSH(object):
+  """SSHPool look-alike whose hosts are SimMiners keyed by ip"""
+
+  def __init__(self, miners, latency=False):
+    self.miners = dict([(m.ip, m) for m in miners])
+    # sleep like the PICs do when setting voltages
+    self.latency = latency
+    self.stats = {}
+    # (host, path): data of the files deployed
+    self.files = {}
+
+  def _stats(self, host):
+    if not self.stats.has_key(host):
+      self.stats[host] = {'handshakes': 0, 'handshake_time': 0.0, 'handshake_total': 0.0,
+                          'commands': 0, 'command_time': 0.0, 'command_total': 0.0, 'reconnects': 0}
+    return self.stats[host]
+
+  def set_pairs(self, miner, pairs):
+    """Apply chain:voltage pairs, returns the result lines of batch mode"""
+    lines = []
+    for pair in pairs:
+      chain, voltage = pair.split(':')
+      chain, voltage = int(chain) - 1, int(voltage, 16)
+      old = miner.get_voltage(chain)
+      if old != voltage:
+        if self.latency:
+          time.sleep(PIC_SET_TIME)
+        miner.set_voltage(chain, voltage)
+      lines.append("chain %i: voltage = 0x%02x -> 0x%02x OK" %(chain+1, old, voltage))
+    return lines
+
+  def run(self, host, password, cmd, data=None):
+    """Answer an sv command line, returns (stdout, stderr)"""
+    start = time.time()
+    miner = self.miners[host]
+    args = cmd.split()
+    if args[0] in ('md5sum', 'mv', 'rm', 'cat'):
+      out, err = self.file_command(host, args, data)
+      self.record(host, time.time() - start)
+      return out, err
+    freq = FREQ_RE.search(cmd)
+    if freq and cmd.find('cgminer.sh restart') > -1:
+      miner.restart(int(freq.group(1)))
+      self.record(host, time.time() - start)
+      return '', ''
+    if not args[0].endswith('sv'):
+      return '', "sh: %s: not found\n" %args[0]
+    args = args[1:]
+    if not args:
+      out = "Reading all voltages" + "".join(["\nchain %i: voltage = 0x%02x" %(c+1, miner.get_voltage(c))
+                                              for c in range(len(miner.chains))]) + "\n"
+    elif args[0] == 'batch':
+      out = "\n".join(self.set_pairs(miner, args[1:])) + "\n"
+    elif len(args) == 1:
+      chain = int(args[0]) - 1
+      out = "Reading voltage chain %i:\nchain %i: voltage = 0x%02x\n" %(chain+1, chain+1, miner.get_voltage(chain))
+    else:
+      chain = int(args[0]) - 1
+      old = miner.get_voltage(chain)
+      self.set_pairs(miner, ["%s:%s" %(args[0], args[1])])
+      out = "Reading voltage\nchain %i: voltage = 0x%02x\nSetting voltage on chain %i\nReading voltage\n" \
+            "chain %i: voltage = 0x%02x\nSuccess: Voltage updated!\n" %(chain+1, old, chain+1, chain+1, miner.get_voltage(chain))
+    self.record(host, time.time() - start)
+    return out, ''
+
+  def file_command(self, host, args, data):
+    """Answer the shell commands of deploy.py on the files of host"""
+    if args[0] == 'md5sum':
+      if not self.files.has_key((host, args[1])):
+        return '', "md5sum: can't open '%s': No such file or directory\n" %args[1]
+      return "%s  %s\n" %(hashlib.md5(self.files[(host, args[1])]).hexdigest(), args[1]), ''
+    if args[0] == 'mv':
+      self.files[(host, args[3])] = self.files.pop((host, args[2]))
+    elif args[0] == 'rm':
+      self.files.pop((host, args[2]), None)
+    else:
+      # cat > path && chmod mode path
+      self.files[(host, args[2])] = data
+    return '', ''
+
+  def put(self, host, password, data, path, mode=0644):
+    start = time.time()
+    self.files[(host, path)] = data
+    self.record(host, time.time() - start)
+
+  def open_session(self, host, password, cmd):
+    if not cmd.endswith(' agent'):
+      raise ValueError("only the sv agent runs in a session")
+    return SimChannel(self, self.miners[host])
+
+  def record(self, host, took):
+    stats = self._stats(host)
+    stats['commands'] += 1
+    stats['command_time'] = took
+    stats['command_total'] += took
+
+  def timings(self, host):
+    return dict(self._stats(host))
+
+  def drop(self, host):
+    pass
+
+  def close(self):
+    pass
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# sshpool.py: keep-alive ssh connections to miners for l3plus_autotune.py
+# --------------------------------------------------------------------------
+#
+# Every miner gets one paramiko transport that is kept open between tuning
+# cycles, each remote command runs on a fresh channel of that transport.
+# Dead connections are re-established transparently on the next command.
+
+import socket, time, threading
+
+try:
+  import paramiko
+except ImportError:
+  paramiko = None
+
+# seconds between ssh keepalive packets on idle transports
+KEEPALIVE = 30
+
+
+class SSHPool(object):
+  """Pool of keep-alive ssh connections keyed by host"""
+
+  def __init__(self, username='root', port=22, keepalive=KEEPALIVE):
+    if paramiko is None:
+      raise ImportError("paramiko module missing")
+    self.username = username
+    self.port = port
+    self.keepalive = keepalive
+    self.clients = {}
+    self.locks = {}
+    self.stats = {}
+    self.lock = threading.Lock()
+
+  def _host_lock(self, host):
+    self.lock.acquire()
+    try:
+      if not self.locks.has_key(host):
+        self.locks[host] = threading.Lock()
+        self.stats[host] = {'handshakes': 0, 'handshake_time': 0.0, 'handshake_total': 0.0,
+                            'commands': 0, 'command_time': 0.0, 'command_total': 0.0, 'reconnects': 0}
+      return self.locks[host]
+    finally:
+      self.lock.release()
+
+  def _connect(self, host, password):
+    """Open a new connection to host, records handshake timing"""
+    start = time.time()
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy( paramiko.AutoAddPolicy() )
+    client.load_system_host_keys()
+    client.connect(host, port=self.port, username=self.username, password=password)
+    client.get_transport().set_keepalive(self.keepalive)
+    took = time.time() - start
+    stats = self.stats[host]
+    stats['handshakes'] += 1
+    stats['handshake_time'] = took
+    stats['handshake_total'] += took
+    self.clients[host] = client
+    return client
+
+  def client(self, host, password):
+    """Return a connected client for host, connecting if needed"""
+    lock = self._host_lock(host)
+    lock.acquire()
+    try:
+      client = self.clients.get(host)
+      if client is None or client.get_transport() is None or not client.get_transport().is_active():
+        if client is not None:
+          self.stats[host]['reconnects'] += 1
+          client.close()
+        client = self._connect(host, password)
+      return client
+    finally:
+      lock.release()
+
+  def drop(self, host):
+    """Close and forget the connection to host"""
+    lock = self._host_lock(host)
+    lock.acquire()
+    try:
+      client = self.clients.pop(host, None)
+      if client is not None:
+        client.close()
+    finally:
+      lock.release()
+
+  def run(self, host, password, cmd, data=None):
+    """Run cmd on host, optionally feeding data to its stdin, returns (stdout, stderr)
+
+    A broken connection is re-established once, authentication errors are
+    passed on to the caller."""
+    for attempt in (0, 1):
+      client = self.client(host, password)
+      start = time.time()
+      try:
+        stdin, stdout, stderr = client.exec_command(cmd)
+        if data is not None:
+          stdin.write(data)
+          stdin.flush()
+        stdin.channel.shutdown_write()
+        res = stdout.read()
+        err = stderr.read()
+      except (paramiko.SSHException, socket.error, EOFError), e:
+        self.drop(host)
+        if attempt > 0:
+          raise
+        continue
+      self.record(host, time.time() - start)
+      return res, err
+
+  def put(self, host, password, data, path, mode=0644):
+    """Write data to path on host over sftp and set its mode, a broken
+    connection is re-established once"""
+    for attempt in (0, 1):
+      client = self.client(host, password)
+      start = time.time()
+      try:
+        sftp = client.open_sftp()
+        try:
+          fh = sftp.open(path, 'wb')
+          try:
+            fh.write(data)
+          finally:
+            fh.close()
+          sftp.chmod(path, mode)
+        finally:
+          sftp.close()
+      except (socket.error, EOFError), e:
+        self.drop(host)
+        if attempt > 0:
+          raise
+        continue
+      self.record(host, time.time() - start)
+      return
+
+  def open_session(self, host, password, cmd):
+    """Start a long running cmd on host, returns its paramiko channel"""
+    try:
+      channel = self.client(host, password).get_transport().open_session()
+    except (paramiko.SSHException, socket.error, EOFError):
+      # the transport died since the last command, retry once on a fresh one
+      self.drop(host)
+      channel = self.client(host, password).get_transport().open_session()
+    channel.exec_command(cmd)
+    return channel
+
+  def record(self, host, took):
+    """Account a command that ran on a channel of our own"""
+    self._host_lock(host)
+    stats = self.stats[host]
+    stats['commands'] += 1
+    stats['command_time'] = took
+    stats['command_total'] += took
+
+  def timings(self, host):
+    """Copy of the handshake/command timing counters of host"""
+    self._host_lock(host)
+    return dict(self.stats[host])
+
+  def close(self):
+    for host in self.clients.keys():
+      self.drop(host)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# svagent.py: client for the resident 'sv agent' mode of set_voltage_new.c
+# --------------------------------------------------------------------------
+#
+# The agent keeps /dev/i2c-0 open on the miner and answers line commands on
+# stdin, so the tuner keeps one ssh channel open to it instead of running
+# the sv binary for every read or write. Each reply is a number of
+# 'chain <n>: ...' lines terminated by 'ok' or 'error <reason>'.
+
+import socket, time
+
+# seconds to wait for a single agent reply, setting 4 chains takes ~6s at
+# 1.5s per PIC, a busy miner takes several times that
+AGENT_TIMEOUT = 30
+
+
+class AgentError(Exception):
+  """The agent could not be started or stopped answering"""
+  pass
+
+
+class AgentUnsupported(AgentError):
+  """The sv binary on the miner has no agent mode"""
+  pass
+
+
+class SvAgent(object):
+  """One resident sv agent on a miner, reached over a pooled ssh channel"""
+
+  def __init__(self, pool, host, password, setv_bin):
+    self.pool = pool
+    self.host = host
+    self.password = password
+    self.setv_bin = setv_bin
+    self.channel = None
+    self.rfile = None
+
+  def start(self):
+    """Start the agent, raises AgentUnsupported on binaries without agent mode"""
+    self.channel = self.pool.open_session(self.host, self.password, self.setv_bin + " agent")
+    self.channel.settimeout(AGENT_TIMEOUT)
+    self.rfile = self.channel.makefile('r')
+    try:
+      line = self._readline()
+    except AgentError, e:
+      # binaries without agent mode exit or wait for arguments that never come
+      self.close()
+      raise AgentUnsupported("%s agent did not come up: %s" %(self.setv_bin, e))
+    if line != "ready":
+      # old binaries answer with usage help, a missing binary with a shell error
+      self.close()
+      raise AgentUnsupported("%s agent not available: %s" %(self.setv_bin, line))
+
+  def _readline(self):
+    try:
+      line = self.rfile.readline()
+    except socket.timeout:
+      raise AgentError("timeout waiting for %s agent" %self.host)
+    if not line:
+      raise AgentError("%s agent went away" %self.host)
+    return line.strip()
+
+  def request(self, cmd):
+    """Send one command, returns (ok, reply lines), the lines end with the
+    'error <reason>' line if not ok. Restarts a dead agent once."""
+    for attempt in (0, 1):
+      if self.channel is None or self.channel.closed:
+        self.start()
+      start = time.time()
+      try:
+        self.channel.sendall(cmd + "\n")
+        lines = []
+        while True:
+          line = self._readline()
+          if line == "ok":
+            break
+          lines.append(line)
+          if line.startswith("error"):
+            break
+      except (AgentError, socket.error, EOFError), e:
+        self.close()
+        if attempt > 0:
+          raise AgentError(str(e))
+        continue
+      self.pool.record(self.host, time.time() - start)
+      return line == "ok", lines
+
+  def close(self):
+    if self.channel is not None:
+      try:
+        if not self.channel.closed:
+          self.channel.sendall("quit\n")
+        self.channel.close()
+      except (socket.error, EOFError):
+        pass
+    self.channel = None
+    self.rfile = None
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_autotune.py: tests of MinerTuner of l3plus_autotune.py
+# --------------------------------------------------------------------------
+#
+# MinerTuner is run unmodified against simminer miners on a simulated clock
+# through replay.ReplayTuner, like bench_schedule.py does, so a full tune
+# takes a fraction of a second. Stats come from the miner model and
+# voltages are set through simminer.SimSSH. Failed voltage sets are answered
+# by SimSSH subclasses the way the sv agent of set_voltage_new.c does.
+#
+# Run from the scripts directory: python -m unittest test_autotune
+
+import unittest
+
+import l3plus_autotune
+from replay import ReplayMiner, ReplayTuner
+from scheduler import LOCKED, STABLE
+from simminer import ChainModel, SimClock
+from simminer.ssh import SimSSH, SimChannel
+
+
+def sim_tuner(sweet, seed, search=l3plus_autotune.DEFAULT_SEARCH):
+  """ReplayTuner of a simulated miner with chains of the given sweet spots"""
+  clock = SimClock()
+  miner = ReplayMiner('sim', [ChainModel(s) for s in sweet], seed=seed, clock=clock.time)
+  return ReplayTuner(miner, False, search, clock=clock), miner, clock
+
+
+class TimelineTest(unittest.TestCase):
+  """Every chain is changed, settles, locks and becomes stable on its own"""
+
+  # chain 1 can go as low as the PICs go and locks there, the others are
+  # still tuned at their own pace
+  SWEET = [0x108, 0xa0, 0xd0, 0xb8]
+
+  def run_tuner(self, seed=0):
+    """Tune to the end, returns per step the (timestamp, changed chains)
+    and per chain the timestamp each state was entered first"""
+    tuner, miner, clock = sim_tuner(self.SWEET, seed)
+    start = clock.now
+    steps = []
+    entered = [{} for c in miner.chains]
+    while True:
+      before = list(miner.voltage)
+      since = dict(tuner.schedule.since)
+      delay = tuner.step()
+      changed = [c for c in range(len(miner.chains)) if miner.voltage[c] != before[c]]
+      steps.append((clock.now - start, changed))
+      for c in range(len(miner.chains)):
+        entered[c].setdefault(tuner.schedule.state.get(c), clock.now - start)
+        # a change of one chain leaves the clocks of the others alone
+        if c not in changed and since.has_key(c):
+          self.assertEqual(tuner.schedule.since[c], since[c])
+      if delay is None:
+        break
+      self.assertTrue(clock.now - start < 24 * 3600)
+      clock.sleep(delay)
+    return tuner, miner, steps, entered
+
+  def test_final_codes(self):
+    tuner, miner, steps, entered = self.run_tuner()
+    self.assertTrue(tuner.finished)
+    best = [chain.best(miner.frequency, l3plus_autotune.MAX_ERR_RATE, miner.ambient) for chain in miner.chains]
+    self.assertEqual(best[0], 0xfe)
+    # chain 1 at the lowest voltage, the others at most 3 codes below the
+    # highest code that keeps the error limit
+    self.assertEqual(miner.voltage[0], 0xfe)
+    for c in range(1, 4):
+      self.assertTrue(best[c] - 3 <= miner.voltage[c] <= best[c], "chain %i at %#x, best %#x" %(c+1,
+        miner.voltage[c], best[c]))
+    self.assertEqual(tuner.current_voltage, [hex(v) for v in miner.voltage])
+    self.assertEqual(tuner.schedule.state, {0: STABLE, 1: STABLE, 2: STABLE, 3: STABLE})
+
+  def test_independent_timelines(self):
+    tuner, miner, steps, entered = self.run_tuner()
+    locked = entered[0][LOCKED]
+    # chain 1 locks at 0xfe while the others keep probing and being changed
+    self.assertTrue([c for c in range(1, 4) if entered[c].get(LOCKED, entered[c][STABLE]) > locked])
+    later = set(sum([changed for ts, changed in steps if ts > locked], []))
+    self.assertFalse(0 in later)
+    self.assertTrue(later & set([1, 2, 3]))
+    # chains are changed at different times and become stable at different times
+    times = [set([ts for ts, changed in steps if c in changed]) for c in range(4)]
+    for c in range(1, 4):
+      self.assertNotEqual(times[c], times[0])
+    self.assertEqual(len(set([entered[c][STABLE] for c in range(4)])), 4)
+
+
+class FailingSSH(SimSSH):
+  """SimSSH whose PICs fail to set the chains in failing"""
+
+  def __init__(self, miners, failing):
+    SimSSH.__init__(self, miners)
+    self.failing = failing
+
+  def set_pairs(self, miner, pairs):
+    lines = []
+    for pair in pairs:
+      if int(pair.split(':')[0]) in self.failing:
+        lines.append("chain %s: voltage = ERROR" %pair.split(':')[0])
+      else:
+        lines.extend(SimSSH.set_pairs(self, miner, [pair]))
+    return lines
+
+
+class RejectingChannel(SimChannel):
+  """sv agent that rejects every set command"""
+
+  def sendall(self, data):
+    if data.startswith("set"):
+      self.lines.append("error incorrect arguments")
+    else:
+      SimChannel.sendall(self, data)
+
+
+class RejectingSSH(SimSSH):
+
+  def open_session(self, host, password, cmd):
+    SimSSH.open_session(self, host, password, cmd)
+    return RejectingChannel(self, self.miners[host])
+
+
+class SetVoltagesTest(unittest.TestCase):
+  """Replies of the sv agent to set commands"""
+
+  def tuner(self, ssh, *args):
+    tuner, miner, clock = sim_tuner([0xa0] * 4, 0)
+    tuner.ssh = ssh([miner], *args)
+    return tuner, miner
+
+  def test_set(self):
+    tuner, miner = self.tuner(SimSSH)
+    self.assertEqual(tuner.set_voltages({1: '0xa4', 3: '0xa8'}), {1: ['0x80', '0xa4'], 3: ['0x80', '0xa8']})
+    self.assertEqual(miner.voltage, [0xa4, 0x80, 0xa8, 0x80])
+
+  def test_failed_chain(self):
+    # the chains that were set are returned, the failed one is left out
+    tuner, miner = self.tuner(FailingSSH, [3])
+    self.assertEqual(tuner.set_voltages({1: '0xa4', 3: '0xa8'}), {1: ['0x80', '0xa4']})
+    self.assertEqual(miner.voltage, [0xa4, 0x80, 0x80, 0x80])
+
+  def test_all_chains_failed(self):
+    tuner, miner = self.tuner(FailingSSH, [1, 3])
+    self.assertRaises(l3plus_autotune.TuneError, tuner.set_voltages, {1: '0xa4', 3: '0xa8'})
+
+  def test_rejected(self):
+    # an error reply without any chain lines must not pass as nothing to set
+    tuner, miner = self.tuner(RejectingSSH)
+    try:
+      tuner.set_voltages({2: '0xa4'})
+    except l3plus_autotune.TuneError, e:
+      self.assertTrue(str(e).find("error incorrect arguments") > -1)
+    else:
+      self.fail("rejected set passed")
+    self.assertEqual(miner.voltage, [0x80] * 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
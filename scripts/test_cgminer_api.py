@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_cgminer_api.py: tests of the stats reply parsing of cgminer_api.py
+# --------------------------------------------------------------------------
+#
+# Fixtures are stats replies as the stock, L3++ and Blissz firmwares send
+# them: no comma after the first STATS object and a trailing NUL byte. The
+# L3++ one has its numbers quoted and the Blissz one is broken beyond that
+# quirk, so it goes through the "key":value fallback. All have to give the
+# same typed record. Replies cut off anywhere and replies of unknown
+# firmwares have to raise ApiError instead of giving a partial or wrong one.
+#
+# Run from the scripts directory: python -m unittest test_cgminer_api
+
+import socket, threading, unittest
+
+from cgminer_api import CgminerClient, MinerStats, ApiError, identify_firmware, detect_firmware
+
+HEAD = '{"STATUS":[{"STATUS":"S","When":1526135868,"Code":70,"Msg":"CGMiner stats","Description":"cgminer 4.9.0"}],' \
+  '"STATS":[{"CGMiner":"4.9.0","Miner":"1.0.1.3","CompileTime":"Fri Jan 12 15:06:21 CST 2018","Type":"%s"}'
+ACS = '" oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo oooooooo"'
+ACS_BAD = '" oooooooo oooooooo ooxooooo oooooooo oooooooo oooooooo oooooooo oooooooo ooooooo-"'
+
+STOCK = HEAD %'Antminer L3+' + \
+  '{"STATS":0,"ID":"L30","Elapsed":282139,"GHS 5s":"523.897","GHS av":520.37,"miner_count":4,"frequency":"384",' \
+  '"temp1":55,"temp2":56,"temp3":56,"temp4":54,"temp2_1":61,"temp2_2":63,"temp2_3":63,"temp2_4":60,' \
+  '"Device Hardware%":0.0012,"chain_acs1":' + ACS + ',"chain_acs2":' + ACS + ',"chain_acs3":' + ACS_BAD + \
+  ',"chain_acs4":' + ACS + ',"chain_hw1":3,"chain_hw2":10167,"chain_hw3":186,"chain_hw4":2,' \
+  '"chain_rate1":"131.20","chain_rate2":"130.93","chain_rate3":"130.97","chain_rate4":"130.80"}],"id":1}\x00'
+
+# numbers quoted, temperatures as floats
+L3PP = HEAD %'Antminer L3++' + \
+  '{"STATS":0,"ID":"L30","Elapsed":"282139","GHS 5s":"523.897","GHS av":"520.37","miner_count":4,"frequency":"384",' \
+  '"temp1":"55","temp2":"56","temp3":"56","temp4":"54","temp2_1":"61.0","temp2_2":"63.5","temp2_3":"63","temp2_4":"60",' \
+  '"Device Hardware%":"0.0012","chain_acs1":' + ACS + ',"chain_acs2":' + ACS + ',"chain_acs3":' + ACS_BAD + \
+  ',"chain_acs4":' + ACS + ',"chain_hw1":"3","chain_hw2":"10167","chain_hw3":"186","chain_hw4":"2",' \
+  '"chain_rate1":"131.20","chain_rate2":"130.93","chain_rate3":"130.97","chain_rate4":"130.80"}],"id":1}\x00'
+
+# commas missing between fields of the chain data too, and a nested object
+# with fields of the same name before it
+BLISSZ = HEAD %'Antminer L3+ Blissz v1.02' + \
+  '{"STATS":0,"ID":"L30","pools":{"chain_hw1":999,"frequency":"100"}' \
+  '"Elapsed":282139,"GHS 5s":"523.897","GHS av":520.37"miner_count":4,"frequency":"384",' \
+  '"temp1":55,"temp2":56,"temp3":56,"temp4":54,"temp2_1":61,"temp2_2":63,"temp2_3":63,"temp2_4":60,' \
+  '"Device Hardware%":0.0012,"chain_acs1":' + ACS + ',"chain_acs2":' + ACS + ',"chain_acs3":' + ACS_BAD + \
+  ',"chain_acs4":' + ACS + ',"chain_hw1":3,"chain_hw2":10167,"chain_hw3":186,"chain_hw4":2,' \
+  '"chain_rate1":"131.20","chain_rate2":"130.93","chain_rate3":"130.97""chain_rate4":"130.80"}],"id":1}\x00'
+
+UNKNOWN = STOCK.replace('Antminer L3+', 'Antminer S9')
+ERROR = '{"STATUS":[{"STATUS":"E","Code":14,"Msg":"Invalid command","Description":"cgminer 4.9.0"}],"id":1}\x00'
+
+
+def parse(data):
+  fw = identify_firmware(data)
+  if fw is None:
+    raise ApiError("Unknown firmware")
+  return MinerStats(fw.name, fw.parse(data), fw.chains)
+
+
+def serve(reply):
+  """Answer one connection on a local port with reply, returns the port"""
+  srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  srv.bind(('127.0.0.1', 0))
+  srv.listen(1)
+  def answer():
+    c, addr = srv.accept()
+    c.recv(1024)
+    c.sendall(reply)
+    c.close()
+    srv.close()
+  t = threading.Thread(target=answer)
+  t.daemon = True
+  t.start()
+  return srv.getsockname()[1]
+
+
+class ParseTest(unittest.TestCase):
+
+  def assertRecord(self, stats, firmware):
+    self.assertEqual(stats.firmware, firmware)
+    self.assertEqual(stats.err, [3, 10167, 186, 2])
+    self.assertEqual(stats.chainrate, [131.20, 130.93, 130.97, 130.80])
+    self.assertEqual(stats.temp_pcb, [55, 56, 56, 54])
+    self.assertEqual(stats.temp_chip, [61, 63, 63, 60])
+    self.assertEqual(stats.asic_status, [ACS[1:-1], ACS[1:-1], ACS_BAD[1:-1], ACS[1:-1]])
+    self.assertEqual(stats.speed, [520.37, 523.897])
+    self.assertEqual(stats.uptime, 282139)
+    self.assertEqual(stats.frequency, '384')
+    self.assertEqual(stats.device_error, 0.0012)
+    for f in ('err', 'temp_pcb', 'temp_chip'):
+      for v in getattr(stats, f):
+        self.assertTrue(isinstance(v, int), "%s %r" %(f, v))
+    for v in stats.chainrate + stats.speed + [stats.device_error]:
+      self.assertTrue(isinstance(v, float))
+
+  def test_firmwares_are_identified(self):
+    self.assertEqual(identify_firmware(STOCK).name, 'stock')
+    self.assertEqual(identify_firmware(L3PP).name, 'l3++')
+    self.assertEqual(identify_firmware(BLISSZ).name, 'blissz')
+    self.assertEqual(identify_firmware(UNKNOWN), None)
+    self.assertEqual(detect_firmware(UNKNOWN).name, 'stock')
+
+  def test_stock(self):
+    self.assertRecord(parse(STOCK), 'stock')
+
+  def test_l3pp(self):
+    self.assertRecord(parse(L3PP), 'l3++')
+
+  def test_blissz(self):
+    # the chain data is no valid JSON, it is parsed as "key":value pairs
+    self.assertRecord(parse(BLISSZ), 'blissz')
+
+  def test_as_dict(self):
+    d = parse(STOCK).as_dict()
+    self.assertEqual(sorted(d.keys()), sorted(MinerStats.__slots__))
+    self.assertEqual(d['firmware'], 'stock')
+    self.assertEqual(d['err'], [3, 10167, 186, 2])
+
+  def test_truncated(self):
+    for reply in (STOCK, L3PP, BLISSZ):
+      end = reply.index('}],"id":1}')
+      for cut in range(len(HEAD), end + 1):
+        try:
+          stats = parse(reply[:cut])
+        except ApiError:
+          continue
+        self.fail("%i of %i bytes parsed as %r" %(cut, len(reply), stats.as_dict()))
+
+  def test_truncated_after_chain_data(self):
+    # the chain data is complete, only the end of the document is missing
+    self.assertRecord(parse(STOCK[:STOCK.index('],"id":1}')]), 'stock')
+
+  def test_error_reply(self):
+    self.assertRaises(ApiError, parse, ERROR)
+    self.assertRaises(ApiError, parse, STOCK.replace('"chain_hw3":186,', ''))
+    self.assertRaises(ApiError, parse, STOCK.replace('"GHS av":520.37', '"GHS av":"n/a"'))
+
+
+class ClientTest(unittest.TestCase):
+
+  def test_stats(self):
+    # a small buffer has to grow to hold the reply
+    client = CgminerClient(bufsize=64, timeout=5)
+    for reply, firmware in ((STOCK, 'stock'), (L3PP, 'l3++'), (BLISSZ, 'blissz')):
+      stats = client.stats('127.0.0.1', serve(reply))
+      self.assertEqual(stats.firmware, firmware)
+      self.assertEqual(stats.err, [3, 10167, 186, 2])
+
+  def test_unknown_firmware(self):
+    client = CgminerClient(timeout=5)
+    self.assertRaises(ApiError, client.stats, '127.0.0.1', serve(UNKNOWN))
+
+  def test_truncated(self):
+    client = CgminerClient(timeout=5)
+    cut = STOCK.index('"chain_hw2":1016') + len('"chain_hw2":1016')
+    self.assertRaises(ApiError, client.stats, '127.0.0.1', serve(STOCK[:cut]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_export.py: tests of the export writers and read_export of export.py
+# --------------------------------------------------------------------------
+#
+# Samples of a ChainHistory are written in every format and read back with
+# read_export(), which has to return the records as they were written, up
+# to the float32 and '%.6g' precision of the binary and csv formats. A
+# record cut short by a crash is dropped, appending to an existing file does
+# not repeat the header and writers keep no file open between writes.
+#
+# Run from the scripts directory: python -m unittest test_export
+
+import os, random, shutil, tempfile, unittest
+
+from export import EXPORT_FORMATS, EXPORT_MAGIC, CHAIN_FIELDS, SAMPLE_FIELDS, ExportError, open_export, \
+  history_record, read_export, csv_header
+from history import ChainHistory
+
+
+def sample_history(count, seed=1):
+  """ChainHistory of count samples every 60s with random values"""
+  rnd = random.Random(seed)
+  hist = ChainHistory('384')
+  err = [0] * 4
+  for n in range(count):
+    err = [e + rnd.randint(0, 3) for e in err]
+    stats = {'err': list(err), 'temp_pcb': [rnd.randint(40, 60) for c in range(4)],
+             'temp_chip': [rnd.randint(55, 80) for c in range(4)],
+             'chainrate': [rnd.uniform(120, 140) for c in range(4)], 'speed': [rnd.uniform(480, 520), rnd.uniform(480, 520)],
+             'uptime': 1000 + n * 60, 'device_error': rnd.uniform(0, 0.01), 'asic_status': [' oooooooo'] * 4}
+    hist.push(stats, [hex(rnd.randint(0xa0, 0xe0)) for c in range(4)], 1500000000 + n * 60)
+  return hist
+
+
+class ExportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def assertRecord(self, got, expected, fmt):
+    self.assertEqual(sorted(got.keys()), sorted(expected.keys()))
+    self.assertEqual(got['frequency'], expected['frequency'])
+    for f in ('timestamp', 'uptime', 'err', 'temp_pcb', 'temp_chip', 'voltage'):
+      self.assertEqual(got[f], expected[f], "%s %s" %(fmt, f))
+    for f in [f for f, t in CHAIN_FIELDS if t == 'f'] + ['speed', 'device_error']:
+      g, e = got[f], expected[f]
+      if not isinstance(e, list):
+        g, e = [g], [e]
+      for a, b in zip(g, e):
+        self.assertAlmostEqual(a, b, delta=abs(b) * 1e-5 + 1e-9, msg="%s %s" %(fmt, f))
+
+  def export(self, fmt, hist):
+    writer = open_export(fmt, '10.0.0.1-', self.directory)
+    for i in range(len(hist)):
+      writer.write(history_record(hist, i))
+    return writer
+
+  def test_round_trip(self):
+    hist = sample_history(50)
+    for fmt in EXPORT_FORMATS:
+      writer = self.export(fmt, hist)
+      self.assertTrue(writer.path.endswith('.' + fmt))
+      self.assertTrue(os.path.basename(writer.path).startswith('10.0.0.1-'))
+      self.assertEqual(writer.count, 50)
+      recs = list(read_export(writer.path))
+      self.assertEqual(len(recs), 50)
+      for i, rec in enumerate(recs):
+        self.assertRecord(rec, history_record(hist, i), fmt)
+
+  def test_headers(self):
+    hist = sample_history(1)
+    self.assertEqual(open(self.export('bin', hist).path, 'rb').read(len(EXPORT_MAGIC)), EXPORT_MAGIC)
+    self.assertEqual(open(self.export('csv', hist).path).readline().strip().split(','), csv_header())
+    self.assertEqual(open(self.export('jsonl', hist).path).read(1), '{')
+    self.assertEqual(len(csv_header()), len(SAMPLE_FIELDS) + 1 + 4 * len(CHAIN_FIELDS))
+
+  def test_batch_write(self):
+    hist = sample_history(10)
+    for fmt, writer in EXPORT_FORMATS.items():
+      w = open_export(fmt, 'batch-', self.directory)
+      w.write(*[history_record(hist, i) for i in range(5)])
+      w.write(*[history_record(hist, i) for i in range(5, 10)])
+      self.assertEqual(w.count, 10)
+      recs = list(read_export(w.path))
+      self.assertEqual([r['timestamp'] for r in recs], [history_record(hist, i)['timestamp'] for i in range(10)])
+
+  def test_append_to_existing(self):
+    hist = sample_history(6)
+    for fmt, writer in EXPORT_FORMATS.items():
+      first = self.export(fmt, hist)
+      # a writer on the same file, e.g. after a restart, adds no second header
+      again = writer(first.path)
+      again.write(history_record(hist, -1))
+      recs = list(read_export(first.path))
+      self.assertEqual(len(recs), 7, fmt)
+      self.assertRecord(recs[-1], history_record(hist, -1), fmt)
+
+  def test_torn_record_is_dropped(self):
+    hist = sample_history(5)
+    for fmt in EXPORT_FORMATS:
+      writer = self.export(fmt, hist)
+      size = os.path.getsize(writer.path)
+      writer.write(history_record(hist, 0))
+      # the last write was cut off by a crash
+      fh = open(writer.path, 'r+b')
+      fh.truncate(size + (os.path.getsize(writer.path) - size) / 2)
+      fh.close()
+      recs = list(read_export(writer.path))
+      self.assertEqual(len(recs), 5, fmt)
+      for i, rec in enumerate(recs):
+        self.assertRecord(rec, history_record(hist, i), fmt)
+
+  def test_not_an_export_file(self):
+    path = os.path.join(self.directory, 'other.txt')
+    fh = open(path, 'wb')
+    fh.write('voltage,err\n0xa0,1\n')
+    fh.close()
+    self.assertRaises(ExportError, list, read_export(path))
+
+  def test_no_open_files(self):
+    if not os.path.isdir('/proc/self/fd'):
+      return
+    hist = sample_history(3)
+    before = len(os.listdir('/proc/self/fd'))
+    # one writer per miner of a fleet, all written to in turn
+    writers = [open_export('bin', 'm%i-' %i, self.directory) for i in range(200)]
+    for i in range(len(hist)):
+      for w in writers:
+        w.write(history_record(hist, i))
+    self.assertEqual(len(os.listdir('/proc/self/fd')), before)
+    self.assertEqual(len(list(read_export(writers[-1].path))), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
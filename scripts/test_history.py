@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_history.py: tests of the sliding window error rates of history.py
+# --------------------------------------------------------------------------
+#
+# ErrorRates replaced the index based error rates of process_history, which
+# looked LEN5MIN/LEN10MIN/LEN15MIN samples back with one sample every REPEAT
+# seconds. legacy_rates() below is that computation, with regular 60s
+# samples both have to agree. For irregular spacing, dropped samples and
+# counter resets the rates are checked against a brute force scan of all
+# samples in each window.
+#
+# Run from the scripts directory: python -m unittest test_history
+
+import random, unittest
+
+from history import ErrorRates, ERROR_WINDOWS, rate_field
+from scheduler import REPEAT
+
+LEN5MIN = 5*60 / REPEAT
+LEN10MIN = 10*60 / REPEAT
+LEN15MIN = 15*60 / REPEAT
+
+
+def legacy_rates(timestamps, errs):
+  """5/10/15min and all time rates of the last sample like process_history
+  computed them before ErrorRates, None while there are less than 2 samples"""
+  if len(timestamps) < 2:
+    return None
+  end = len(timestamps) - 1
+  rates = []
+  for length in (LEN5MIN, LEN10MIN, LEN15MIN, end):
+    start = max(0, end - length)
+    timediff = timestamps[end] - timestamps[start]
+    rates.append([float(errs[end][i] - errs[start][i]) / timediff*60 for i in range(4)])
+  return rates
+
+
+def scan_rates(samples, windows):
+  """Rates of the last of samples, a list of (timestamp, monotonic errors),
+  from the oldest sample inside each window and from the first sample"""
+  ts, err = samples[-1]
+  rates = []
+  for w in windows:
+    start = [s for s in samples if s[0] >= ts - w][0]
+    rates.append(rate_of(start, samples[-1]))
+  rates.append(rate_of(samples[0], samples[-1]))
+  return rates
+
+
+def rate_of(start, end):
+  timediff = end[0] - start[0]
+  if timediff <= 0:
+    return [0.0] * 4
+  return [float(end[1][i] - start[1][i]) / timediff*60 for i in range(4)]
+
+
+def random_errors(rnd, count, rate=3):
+  """count error counter samples of 4 chains, growing randomly"""
+  err = [rnd.randint(0, 1000) for i in range(4)]
+  samples = []
+  for n in range(count):
+    err = [e + rnd.randint(0, rate) for e in err]
+    samples.append(list(err))
+  return samples
+
+
+class ErrorRatesTest(unittest.TestCase):
+
+  def assertRates(self, got, expected):
+    self.assertEqual(len(got), len(expected))
+    for g, e in zip(got, expected):
+      for a, b in zip(g, e):
+        self.assertAlmostEqual(a, b, places=9)
+
+  def test_regular_samples_match_legacy(self):
+    rnd = random.Random(1)
+    errs = random_errors(rnd, 100)
+    timestamps = [1500000000 + n * REPEAT for n in range(len(errs))]
+    rates = ErrorRates()
+    for n in range(len(errs)):
+      got = rates.push(timestamps[n], errs[n])
+      expected = legacy_rates(timestamps[:n+1], errs[:n+1])
+      if expected is None:
+        # error rates of a new sample start out as 0
+        self.assertRates(got, [[0.0] * 4] * (len(ERROR_WINDOWS) + 1))
+      else:
+        self.assertRates(got, expected)
+
+  def test_regular_samples_counts(self):
+    errs = [[n, 2 * n, 0, 10 * n] for n in range(30)]
+    rates = ErrorRates()
+    for n in range(len(errs)):
+      rates.push(n * REPEAT, errs[n])
+    self.assertEqual(rates.counts, [[5, 10, 0, 50], [10, 20, 0, 100], [15, 30, 0, 150]])
+    self.assertEqual(rates.total, [29, 58, 0, 290])
+    self.assertEqual(rates.errors(), errs[-1])
+
+  def test_irregular_spacing(self):
+    rnd = random.Random(2)
+    errs = random_errors(rnd, 200)
+    rates = ErrorRates()
+    samples = []
+    ts = 1500000000
+    for err in errs:
+      ts += rnd.choice([15, 20, 45, 60, 90, 300, 301])
+      samples.append((ts, err))
+      self.assertRates(rates.push(ts, err), scan_rates(samples, ERROR_WINDOWS))
+
+  def test_dropped_samples(self):
+    rnd = random.Random(3)
+    errs = random_errors(rnd, 120)
+    rates = ErrorRates()
+    samples = []
+    for n, err in enumerate(errs):
+      # cycles 40-59 never happened, the counters kept going
+      if 40 <= n < 60:
+        continue
+      samples.append((n * REPEAT, err))
+      self.assertRates(rates.push(n * REPEAT, err), scan_rates(samples, ERROR_WINDOWS))
+    # a window spanning the gap only counts from the first sample inside it
+    rates = ErrorRates()
+    for ts, err in [(0, [0] * 4), (60, [6] * 4), (1260, [18] * 4)]:
+      got = rates.push(ts, err)
+    self.assertRates(got, [[0.0] * 4, [0.0] * 4, [0.0] * 4, [18 / 21.0] * 4])
+
+  def test_counter_reset(self):
+    rates = ErrorRates()
+    rates.push(0, [100, 200, 300, 400])
+    rates.push(60, [110, 200, 305, 400])
+    # cgminer restarted, the counters start over
+    got = rates.push(120, [2, 0, 1, 400])
+    self.assertEqual(rates.errors(), [112, 200, 306, 400])
+    self.assertRates(got, [[6.0, 0.0, 3.0, 0.0]] * 4)
+    got = rates.push(180, [5, 1, 1, 401])
+    self.assertEqual(rates.counts[0], [15, 1, 6, 1])
+    self.assertEqual(rates.total, [15, 1, 6, 1])
+    self.assertRates(got, [[5.0, 1/3.0, 2.0, 1/3.0]] * 4)
+
+  def test_counter_reset_matches_scan(self):
+    rnd = random.Random(4)
+    rates = ErrorRates()
+    samples = []
+    raw = [0] * 4
+    total = [0] * 4
+    for n in range(150):
+      if n % 37 == 36:
+        raw = [0] * 4
+      new = [rnd.randint(0, 4) for i in range(4)]
+      raw = [raw[i] + new[i] for i in range(4)]
+      total = [total[i] + new[i] for i in range(4)]
+      samples.append((n * REPEAT, list(total)))
+      self.assertRates(rates.push(n * REPEAT, raw), scan_rates(samples, ERROR_WINDOWS))
+    self.assertEqual(rates.errors(), total)
+
+  def test_custom_windows(self):
+    windows = (60, 120, 1800)
+    self.assertEqual([rate_field(w) for w in windows], ['error_rate1', 'error_rate2', 'error_rate30'])
+    rnd = random.Random(5)
+    errs = random_errors(rnd, 100)
+    rates = ErrorRates(windows)
+    samples = []
+    ts = 0
+    for err in errs:
+      ts += rnd.choice([30, 60, 90])
+      samples.append((ts, err))
+      got = rates.push(ts, err)
+      self.assertEqual(len(got), len(windows) + 1)
+      self.assertRates(got, scan_rates(samples, windows))
+
+
+if __name__ == '__main__':
+  unittest.main()
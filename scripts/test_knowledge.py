@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_knowledge.py: tests of the append-only knowledge file of knowledge.py
+# --------------------------------------------------------------------------
+#
+# Outcomes are written through KnowledgeBase.add() and flush(), the file is
+# reopened and has to load the same outcomes, whether it holds one delta
+# record per flush or was compacted. A record cut short by a crash has to be
+# dropped on load and must not shift the records appended after it.
+#
+# Run from the scripts directory: python -m unittest test_knowledge
+
+import os, random, shutil, tempfile, unittest
+
+from history import Outcome, OutcomeIndex
+from knowledge import KnowledgeBase, KnowledgeError, kb_path, KB_MAGIC, KB_RECORD
+
+FREQS = ('384', '450')
+
+
+def random_samples(rnd, count):
+  """count (freq, chain, code, rate5, rate10, rate15, temp) samples"""
+  return [(rnd.choice(FREQS), rnd.randrange(4), rnd.randint(0xa0, 0xb0), rnd.uniform(0, 5), rnd.uniform(0, 5),
+           rnd.uniform(0, 5), rnd.randint(60, 95)) for n in range(count)]
+
+
+class KnowledgeBaseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = kb_path(self.directory, '10.0.0.1')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def assertOutcomes(self, got, expected):
+    self.assertEqual(sorted(got.outcomes.keys()), sorted(expected.outcomes.keys()))
+    for key, e in expected.outcomes.items():
+      g = got.outcomes[key]
+      for f in e.__slots__:
+        self.assertAlmostEqual(getattr(g, f), getattr(e, f), places=9, msg="%s of %s" %(f, key))
+
+  def size(self):
+    return os.path.getsize(self.path)
+
+  def test_kb_path(self):
+    self.assertEqual(kb_path('/kb', 'miner-1.local'), '/kb/miner-1.local.kb')
+    self.assertEqual(kb_path('/kb', '../etc/passwd'), '/kb/.._etc_passwd.kb')
+
+  def test_missing_file(self):
+    kb = KnowledgeBase(self.path)
+    self.assertEqual(kb.outcomes, {})
+    # nothing added, nothing written
+    kb.flush()
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_flush_and_reopen(self):
+    rnd = random.Random(1)
+    kb = KnowledgeBase(os.path.join(self.directory, 'new', 'miner.kb'))
+    expected = OutcomeIndex()
+    for s in random_samples(rnd, 50):
+      kb.add(*s)
+      expected.add(*s)
+    kb.flush()
+    self.assertEqual(kb.pending, {})
+    self.assertOutcomes(KnowledgeBase(kb.path), expected)
+
+  def test_deltas_are_appended(self):
+    rnd = random.Random(2)
+    kb = KnowledgeBase(self.path, compact_factor=100)
+    expected = OutcomeIndex()
+    keys = 0
+    for flush in range(5):
+      samples = random_samples(rnd, 20)
+      for s in samples:
+        kb.add(*s)
+        expected.add(*s)
+      keys += len(set([s[:3] for s in samples]))
+      kb.flush()
+      # one record per key added since the last flush
+      self.assertEqual(kb.records, keys)
+      self.assertEqual(self.size(), len(KB_MAGIC) + keys * KB_RECORD.size)
+    reopened = KnowledgeBase(self.path, compact_factor=100)
+    self.assertEqual(reopened.records, keys)
+    self.assertOutcomes(reopened, expected)
+
+  def test_compact_on_flush(self):
+    kb = KnowledgeBase(self.path, compact_factor=2)
+    expected = OutcomeIndex()
+    for flush in range(3):
+      for chain in range(4):
+        kb.add('384', chain, 0xa8, flush, flush + 1, flush + 2, 70)
+        expected.add('384', chain, 0xa8, flush, flush + 1, flush + 2, 70)
+      kb.flush()
+    # 12 records of 4 keys are more than 2 per key, one record per key is left
+    self.assertEqual(kb.records, 4)
+    self.assertEqual(self.size(), len(KB_MAGIC) + 4 * KB_RECORD.size)
+    self.assertFalse(os.path.exists(self.path + '.tmp'))
+    self.assertOutcomes(KnowledgeBase(self.path, compact_factor=2), expected)
+
+  def test_compact_on_load(self):
+    kb = KnowledgeBase(self.path, compact_factor=100)
+    for flush in range(10):
+      kb.add('450', 1, 0xb0, 1.0, 1.0, 1.0, 80)
+      kb.flush()
+    self.assertEqual(self.size(), len(KB_MAGIC) + 10 * KB_RECORD.size)
+    reopened = KnowledgeBase(self.path)
+    self.assertEqual(reopened.records, 1)
+    self.assertEqual(self.size(), len(KB_MAGIC) + KB_RECORD.size)
+    self.assertEqual(reopened.lookup('450', 1, 0xb0).count, 10)
+
+  def test_torn_record_is_dropped(self):
+    rnd = random.Random(3)
+    kb = KnowledgeBase(self.path, compact_factor=100)
+    expected = OutcomeIndex()
+    for s in random_samples(rnd, 30):
+      kb.add(*s)
+      expected.add(*s)
+    kb.flush()
+    intact = self.size()
+    torn = Outcome()
+    torn.add(9.0, 9.0, 9.0, 99)
+    for cut in (1, KB_RECORD.size / 2, KB_RECORD.size - 1):
+      # a flush of a new key that crashed after cut bytes
+      fh = open(self.path, 'ab')
+      fh.write(kb._pack(('500', 3, 0xc0), torn)[:cut])
+      fh.close()
+      reopened = KnowledgeBase(self.path, compact_factor=100)
+      self.assertOutcomes(reopened, expected)
+      self.assertEqual(reopened.lookup('500', 3, 0xc0), None)
+      # the partial record is cut off the file
+      self.assertEqual(self.size() % KB_RECORD.size, len(KB_MAGIC) % KB_RECORD.size)
+      self.assertTrue(self.size() <= intact)
+
+  def test_append_after_torn_record(self):
+    kb = KnowledgeBase(self.path, compact_factor=100)
+    kb.add('384', 0, 0xa0, 0.5, 0.5, 0.5, 70)
+    kb.flush()
+    fh = open(self.path, 'ab')
+    fh.write('\xff' * 7)
+    fh.close()
+    # records appended after reopening have to line up with the first one
+    kb = KnowledgeBase(self.path, compact_factor=100)
+    kb.add('384', 1, 0xa4, 2.0, 2.0, 2.0, 75)
+    kb.flush()
+    reopened = KnowledgeBase(self.path, compact_factor=100)
+    self.assertEqual(sorted(reopened.outcomes.keys()), [('384', 0, 0xa0), ('384', 1, 0xa4)])
+    self.assertEqual(reopened.lookup('384', 1, 0xa4).means(), (2.0, 2.0, 2.0))
+    self.assertEqual(reopened.lookup('384', 1, 0xa4).max_temp, 75)
+
+  def test_not_a_knowledge_file(self):
+    fh = open(self.path, 'wb')
+    fh.write('{"voltage": 172}\n')
+    fh.close()
+    self.assertRaises(KnowledgeError, KnowledgeBase, self.path)
+
+
+if __name__ == '__main__':
+  unittest.main()
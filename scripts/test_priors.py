@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_priors.py: tests of the prior store of priors.py
+# --------------------------------------------------------------------------
+#
+# A PriorStore is loaded from a priors.jsonl file as shards and other runs
+# write it: several stores appending to one file, later tunes of a miner
+# replacing earlier ones, broken and half written lines. Lookups have to
+# find the siblings of a chain by firmware, frequency and chain position
+# only. MinerTuner has to start chains from the priors within the
+# MAX_VOLTAGE..0xfe range, like every other voltage it sets.
+#
+# Run from the scripts directory: python -m unittest test_priors
+
+import json, os, shutil, tempfile, unittest
+
+import l3plus_autotune
+from priors import PriorStore, priors_path, PRIOR_MARGIN, PRIOR_MIN_BOARDS
+from replay import ReplayMiner, ReplayTuner
+from simminer import ChainModel, SimClock
+
+
+class PriorStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = priors_path(self.directory)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, data):
+    fh = open(self.path, 'ab')
+    fh.write(data)
+    fh.close()
+
+  def line(self, host, codes, firmware='stock', frequency='384'):
+    return json.dumps({'host': host, 'firmware': firmware, 'frequency': frequency, 'codes': codes,
+                       'timestamp': 1500000000}) + "\n"
+
+  def test_priors_path(self):
+    self.assertEqual(priors_path('/kb'), '/kb/priors.jsonl')
+
+  def test_missing_file(self):
+    store = PriorStore(self.path)
+    self.assertEqual(store.codes('stock', '384', 0), [])
+    self.assertEqual(store.start_code('stock', '384', 0), None)
+
+  def test_load(self):
+    self.write(self.line('10.0.0.1', [0xb0, 0xc0, 0xa8, 0xb8]))
+    self.write(self.line('10.0.0.2', [0xb2, None, 0xaa, 0xba]))
+    # broken lines are skipped
+    self.write('{"host": "10.0.0.3", "codes"\n')
+    self.write('{"host": "10.0.0.4"}\n')
+    self.write(self.line('10.0.0.5', [0xb4, 0xc4, 0xac, 0xbc]))
+    store = PriorStore(self.path)
+    self.assertEqual(sorted(store.codes('stock', '384', 0)), [0xb0, 0xb2, 0xb4])
+    # chains that were not tuned have no code
+    self.assertEqual(sorted(store.codes('stock', '384', 1)), [0xc0, 0xc4])
+
+  def test_latest_tune_wins(self):
+    self.write(self.line('10.0.0.1', [0xb0] * 4))
+    self.write(self.line('10.0.0.1', [0xa0] * 4, frequency='450'))
+    self.write(self.line('10.0.0.1', [0xb8] * 4))
+    store = PriorStore(self.path)
+    self.assertEqual(store.codes('stock', '384', 2), [0xb8])
+    self.assertEqual(store.codes('stock', '450', 2), [0xa0])
+
+  def test_half_written_line(self):
+    line = self.line('10.0.0.2', [0xc0] * 4)
+    self.write(self.line('10.0.0.1', [0xb0] * 4) + line[:20])
+    store = PriorStore(self.path)
+    self.assertEqual(store.codes('stock', '384', 0), [0xb0])
+    # the rest of the line is read once it is complete
+    self.write(line[20:])
+    self.assertEqual(sorted(store.codes('stock', '384', 0)), [0xb0, 0xc0])
+
+  def test_merge(self):
+    # two shards append to the same file and see the tunes of each other
+    a = PriorStore(os.path.join(self.directory, 'new', 'priors.jsonl'))
+    b = PriorStore(a.path)
+    a.add('10.0.0.1', 'stock', '384', [0xb0, 0xb0, 0xb0, 0xb0])
+    b.add('10.0.0.2', 'stock', '384', [0xc0, 0xc0, 0xc0, None])
+    a.add('10.0.0.1', 'stock', '384', [0xb4, 0xb4, 0xb4, 0xb4])
+    for store in (a, b, PriorStore(a.path)):
+      self.assertEqual(sorted(store.codes('stock', '384', 0)), [0xb4, 0xc0])
+      self.assertEqual(store.codes('stock', '384', 3), [0xb4])
+    self.assertEqual(len(open(a.path).readlines()), 3)
+
+  def test_siblings(self):
+    for n in range(10):
+      self.write(self.line('10.0.0.%i' %n, [0xb0 + n, 0xc0 + n, 0xd0, 0xe0]))
+    # other firmwares, frequencies and chain positions are no siblings
+    self.write(self.line('10.0.1.1', [0x90] * 4, firmware='blissz'))
+    self.write(self.line('10.0.1.2', [0x90] * 4, frequency='450'))
+    store = PriorStore(self.path)
+    self.assertEqual(sorted(store.codes('stock', '384', 0)), range(0xb0, 0xba))
+    self.assertEqual(store.codes('blissz', '384', 0), [0x90])
+    self.assertEqual(store.codes('stock', '450', 0), [0x90])
+    self.assertEqual(store.codes('l3++', '384', 0), [])
+    self.assertEqual(store.codes('stock', '384', 4), [])
+    # the 10% quantile of 10 codes is the lowest one
+    self.assertEqual(store.start_code('stock', '384', 0), (0xb0 - PRIOR_MARGIN, 10))
+    self.assertEqual(store.start_code('stock', '384', 1), (0xc0 - PRIOR_MARGIN, 10))
+    self.assertEqual(PriorStore(self.path, quantile=0.5, margin=0).start_code('stock', '384', 0), (0xb4, 10))
+    # too few finished tunes
+    self.assertEqual(store.start_code('blissz', '384', 0), None)
+
+  def test_min_boards(self):
+    for n in range(PRIOR_MIN_BOARDS - 1):
+      self.write(self.line('10.0.0.%i' %n, [0xb0] * 4))
+    store = PriorStore(self.path)
+    self.assertEqual(store.start_code('stock', '384', 0), None)
+    self.write(self.line('10.0.0.99', [0xb0] * 4))
+    self.assertEqual(store.start_code('stock', '384', 0), (0xb0 - PRIOR_MARGIN, PRIOR_MIN_BOARDS))
+
+
+class ApplyPriorsTest(unittest.TestCase):
+  """MinerTuner starting chains from the priors"""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.store = PriorStore(priors_path(self.directory), margin=0)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def start(self, codes, voltage=None):
+    """Start a tuner with the siblings all at codes, returns the voltages
+    of the miner after the first cycle"""
+    for n in range(PRIOR_MIN_BOARDS):
+      self.store.add('10.0.0.%i' %n, 'stock', '384', codes)
+    clock = SimClock()
+    miner = ReplayMiner('sim', [ChainModel(0xe0)] * 4, seed=0, clock=clock.time)
+    if voltage is not None:
+      miner.voltage = list(voltage)
+    tuner = ReplayTuner(miner, False, 'bisect', priors=self.store, clock=clock)
+    tuner.step()
+    return miner.voltage
+
+  def test_start_from_priors(self):
+    self.assertEqual(self.start([0xb0, 0xc0, 0x70, None]), [0xb0, 0xc0, 0x80, 0x80])
+
+  def test_clamped_to_lowest_voltage(self):
+    self.assertEqual(self.start([0x104, 0xff, 0xfe, 0xc0]), [0xfe, 0xfe, 0xfe, 0xc0])
+
+  def test_clamped_to_max_voltage(self):
+    # a chain below MAX_VOLTAGE is not started higher than that
+    max_voltage = int(l3plus_autotune.MAX_VOLTAGE, 16)
+    self.assertEqual(self.start([0x30] * 4, [0x40, 0x48, max_voltage, 0x80]), [max_voltage, max_voltage, max_voltage, 0x80])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_scheduler.py: tests of the chain states and sampling of scheduler.py
+# --------------------------------------------------------------------------
+#
+# The schedules are driven with a ChainHistory fed synthetic error counts of
+# two chains at chosen timestamps, as MinerTuner does every cycle. Checked
+# are the error bounds against the exact poisson interval, when each state
+# is entered, that the adaptive schedule changes a chain right when its
+# confidence interval leaves the limits and how far the sampling interval
+# backs off while it waits for that.
+#
+# Run from the scripts directory: python -m unittest test_scheduler
+
+import unittest
+
+from history import ChainHistory
+from scheduler import FixedSchedule, AdaptiveSchedule, error_bounds, rate_interval, RAISE, LOWER, \
+  SETTLING, PROBING, LOCKED, STABLE, MIN_REPEAT, MAX_REPEAT, MIN_DWELL, TUNE_REPEAT, WINDOW_TIME, STABLE_TIME, \
+  MAX_STABLE_TIME, LOWER_FACTOR
+
+MAX_ERR_RATE = 0.2
+CHAINS = [0, 1]
+
+
+class Miner(object):
+  """History of a miner whose error counters are moved by hand"""
+
+  def __init__(self):
+    self.hist = ChainHistory('384', chains=len(CHAINS))
+    self.err = [0] * len(CHAINS)
+
+  def sample(self, ts, *errors):
+    """Add errors per chain and take a sample at ts"""
+    for c, e in enumerate(errors):
+      self.err[c] += e
+    n = len(CHAINS)
+    stats = {'err': list(self.err), 'temp_pcb': [60] * n, 'temp_chip': [70] * n, 'chainrate': [1000.0] * n,
+             'speed': [4000.0, 4000.0], 'uptime': ts, 'device_error': 0.0, 'asic_status': ['oooooooo'] * n}
+    self.hist.push(stats, ['0xa8'] * n, ts)
+    return self.hist
+
+  def errors(self):
+    return self.hist.rates.errors()
+
+
+def adaptive(**kwargs):
+  return AdaptiveSchedule(CHAINS, MAX_ERR_RATE, **kwargs)
+
+
+class ErrorBoundsTest(unittest.TestCase):
+
+  def test_exact_interval(self):
+    # one sided 95% bounds of the exact poisson interval
+    for errors, lo, hi in ((0, 0.0, 2.996), (1, 0.0513, 4.744), (3, 0.818, 7.754), (10, 5.425, 16.962)):
+      got = error_bounds(errors)
+      self.assertAlmostEqual(got[0], lo, delta=0.015)
+      self.assertAlmostEqual(got[1], hi, delta=0.03)
+
+  def test_rate_interval(self):
+    self.assertEqual(rate_interval(5, 0), (0.0, float('inf')))
+    lo, hi = error_bounds(4)
+    self.assertEqual(rate_interval(4, 120), (lo * 0.5, hi * 0.5))
+
+
+class FixedScheduleTest(unittest.TestCase):
+
+  def test_decides_every_tune_repeat(self):
+    miner = Miner()
+    s = FixedSchedule(CHAINS, MAX_ERR_RATE)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    for ts in range(60, TUNE_REPEAT - 5, 60):
+      # chain 0 makes 2 errors/min
+      self.assertEqual(s.decide(miner.sample(ts, 2, 0), ts), {})
+      self.assertEqual(s.state[0], SETTLING)
+    self.assertEqual(s.decide(miner.sample(TUNE_REPEAT, 2, 0), TUNE_REPEAT), {0: RAISE})
+    self.assertEqual(s.state, {0: PROBING, 1: PROBING})
+    self.assertEqual(s.next_sample(miner.hist, TUNE_REPEAT), 60)
+
+  def test_lower_after_window_time(self):
+    miner = Miner()
+    s = FixedSchedule(CHAINS, MAX_ERR_RATE)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    actions = []
+    for ts in range(60, 2 * WINDOW_TIME, 60):
+      got = s.decide(miner.sample(ts, 0, 0), ts)
+      if got:
+        actions.append((ts, got))
+    # the first decision with WINDOW_TIME of history
+    self.assertEqual(actions[0], (900, {0: LOWER, 1: LOWER}))
+
+  def test_locked_becomes_stable(self):
+    miner = Miner()
+    s = FixedSchedule(CHAINS, MAX_ERR_RATE)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    for ts in range(60, 360, 60):
+      s.decide(miner.sample(ts, 0, 0), ts)
+    s.unchanged(0, 300, miner.errors())
+    s.changed(1, 300, miner.errors())
+    self.assertEqual(s.state, {0: LOCKED, 1: SETTLING})
+    for ts in range(360, 1260, 60):
+      actions = s.decide(miner.sample(ts, 0, 0), ts)
+      # locked chains are not lowered again
+      self.assertFalse(0 in actions)
+      for c in actions:
+        s.changed(c, ts, miner.errors())
+    # stable STABLE_TIME after the window time, chain 1 was changed since
+    self.assertFalse(s.stable(miner.sample(WINDOW_TIME + STABLE_TIME, 0, 0), WINDOW_TIME + STABLE_TIME))
+    self.assertEqual(s.state[0], LOCKED)
+    s.stable(miner.sample(WINDOW_TIME + STABLE_TIME + 1, 0, 0), WINDOW_TIME + STABLE_TIME + 1)
+    self.assertEqual(s.state[0], STABLE)
+    self.assertNotEqual(s.state[1], STABLE)
+
+
+class AdaptiveScheduleTest(unittest.TestCase):
+
+  def test_settling_until_min_dwell(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    # even errors by the hundred are not acted on while settling
+    self.assertEqual(s.decide(miner.sample(MIN_DWELL - 1, 100, 0), MIN_DWELL - 1), {})
+    self.assertEqual(s.state, {0: SETTLING, 1: SETTLING})
+    self.assertEqual(s.decide(miner.sample(MIN_DWELL, 0, 0), MIN_DWELL), {0: RAISE})
+    self.assertEqual(s.state, {0: PROBING, 1: PROBING})
+    s.changed(0, MIN_DWELL, miner.errors())
+    self.assertEqual(s.state[0], SETTLING)
+    self.assertEqual(s.entered[0], MIN_DWELL)
+    self.assertEqual(s.entered[1], MIN_DWELL)
+
+  def test_raise_at_lower_bound(self):
+    # after 120s 2 errors are 0.17/min at the lower bound, 3 are 0.41/min
+    for errors, action in ((2, {}), (3, {0: RAISE})):
+      miner = Miner()
+      s = adaptive()
+      s.start(0, miner.sample(0, 0, 0).rates.errors())
+      s.decide(miner.sample(60, 0, 0), 60)
+      self.assertEqual(rate_interval(errors, 120)[0] > MAX_ERR_RATE, bool(action))
+      self.assertEqual(s.decide(miner.sample(120, errors, 0), 120), action)
+
+  def test_errors_before_change_do_not_count(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 50, 50).rates.errors())
+    s.decide(miner.sample(60, 0, 0), 60)
+    self.assertEqual(s.decide(miner.sample(120, 2, 2), 120), {})
+    s.changed(0, 120, miner.errors())
+    s.decide(miner.sample(180, 0, 0), 180)
+    self.assertEqual(s.exposure(0, 180, miner.errors()), (0, 60))
+    self.assertEqual(s.exposure(1, 180, miner.errors()), (2, 180))
+
+  def test_lower_at_upper_bound(self):
+    # without errors the upper bound is below LOWER_FACTOR of the limit after
+    # 1187.5s, no windowed fallback in between
+    at = error_bounds(0)[1] * 60 / (MAX_ERR_RATE * LOWER_FACTOR)
+    self.assertAlmostEqual(at, 1187.5, places=0)
+    miner = Miner()
+    s = adaptive(tune_repeat=3600)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    for ts in range(60, int(at) + 1, 60) + [int(at)]:
+      self.assertEqual(s.decide(miner.sample(ts, 0, 0), ts), {})
+    self.assertEqual(s.decide(miner.sample(int(at) + 1, 0, 0), int(at) + 1), {0: LOWER, 1: LOWER})
+
+  def test_windowed_fallback(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    got = {}
+    ts = 0
+    while not got:
+      ts += 60
+      got = s.decide(miner.sample(ts, 0, 0), ts)
+    # every TUNE_REPEAT the windowed rates are looked at, they allow lowering
+    # once there is WINDOW_TIME of history
+    self.assertEqual((ts, got), (900, {0: LOWER, 1: LOWER}))
+    self.assertEqual(s.decided[0], 900)
+
+  def test_windowed_raise(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    # 2 errors in 5 minutes are 0.4/min but 0.07/min at the lower bound, it
+    # takes the windowed rates to raise
+    for ts in range(60, 300, 60):
+      self.assertEqual(s.decide(miner.sample(ts, ts == 120 and 1 or 0, 0), ts), {})
+    self.assertTrue(rate_interval(2, 300)[0] < MAX_ERR_RATE)
+    self.assertEqual(s.decide(miner.sample(300, 1, 0), 300), {0: RAISE})
+    self.assertEqual(s.decided[0], 300)
+
+  def test_locked_becomes_stable(self):
+    # locked chains are done once the upper bound is below the limit, 890.6s
+    # without errors
+    at = error_bounds(0)[1] * 60 / MAX_ERR_RATE
+    miner = Miner()
+    s = adaptive(tune_repeat=3600)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    s.decide(miner.sample(60, 0, 0), 60)
+    s.unchanged(0, 60, miner.errors())
+    self.assertEqual(s.state[0], LOCKED)
+    self.assertFalse(s.stable(miner.sample(int(at), 0, 0), int(at)))
+    self.assertEqual(s.state[0], LOCKED)
+    self.assertFalse(s.stable(miner.sample(int(at) + 1, 0, 0), int(at) + 1))
+    self.assertEqual(s.state, {0: STABLE, 1: PROBING})
+    # stable chains are only ever raised
+    self.assertEqual(s.decide(miner.sample(1200, 0, 0), 1200), {1: LOWER})
+    s.changed(1, 1200, miner.errors())
+    self.assertEqual(s.decide(miner.sample(1260, 20, 0), 1260), {0: RAISE})
+
+  def test_stable_when_too_close_to_lower(self):
+    miner = Miner()
+    s = adaptive(tune_repeat=10**6, max_stable_time=10**6)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    # 0.2 errors/min, right at the limit: never confidently above it, stable
+    # once the lower bound is above LOWER_FACTOR of it, after 39 errors
+    ts = 0
+    while s.state[0] != STABLE:
+      ts += 60
+      lo = rate_interval(ts / 300, ts)[0]
+      self.assertEqual(s.decide(miner.sample(ts, ts % 300 == 0 and 1 or 0, 0), ts).get(0), None)
+      self.assertEqual(s.state[0] == STABLE, lo > MAX_ERR_RATE * LOWER_FACTOR)
+    self.assertEqual(ts, 11700)
+
+  def test_stable_after_max_stable_time(self):
+    miner = Miner()
+    s = adaptive(tune_repeat=10**6)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    # 1 error every 6 minutes, neither confidently below LOWER_FACTOR of the
+    # limit nor above it, stable MAX_STABLE_TIME after the window time
+    ts = 0
+    while s.state[0] != STABLE:
+      ts += 60
+      self.assertEqual(s.decide(miner.sample(ts, ts % 360 == 0 and 1 or 0, 0), ts).get(0), None)
+    self.assertEqual(ts, WINDOW_TIME + MAX_STABLE_TIME + 60)
+
+  def test_sample_fast_while_errors_come_in(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    self.assertEqual(s.next_sample(miner.hist, 0), MIN_DWELL)
+    self.assertEqual(s.next_sample(miner.sample(30, 0, 1), 30), MIN_REPEAT)
+
+  def test_backoff(self):
+    miner = Miner()
+    s = adaptive(tune_repeat=3600)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    lower_at = error_bounds(0)[1] * 60 / (MAX_ERR_RATE * LOWER_FACTOR)
+    # settling chains wait for MIN_DWELL, then up to MAX_REPEAT until the upper
+    # bound could drop below the threshold to lower, never less than MIN_REPEAT
+    expected = [(0, MIN_DWELL), (30, MIN_DWELL - 30), (60, MAX_REPEAT), (900, lower_at - 900),
+                (1100, lower_at - 1100), (1180, MIN_REPEAT)]
+    for ts, wait in expected:
+      s.decide(miner.sample(ts, 0, 0), ts)
+      self.assertAlmostEqual(s.next_sample(miner.hist, ts), max(wait, MIN_REPEAT), places=6)
+
+  def test_backoff_with_errors(self):
+    miner = Miner()
+    s = adaptive(tune_repeat=3600)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    s.decide(miner.sample(600, 1, 1), 600)
+    # 1 error pushes the earliest time to lower out to 1891.4s
+    lower_at = error_bounds(1)[1] * 60 / (MAX_ERR_RATE * LOWER_FACTOR)
+    self.assertAlmostEqual(lower_at, 1891.4, places=1)
+    self.assertEqual(s.next_sample(miner.hist, 600), MAX_REPEAT)
+    s.decide(miner.sample(1800, 0, 0), 1800)
+    self.assertAlmostEqual(s.next_sample(miner.hist, 1800), lower_at - 1800, places=6)
+
+  def test_backoff_locked(self):
+    miner = Miner()
+    s = adaptive(tune_repeat=3600)
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    s.decide(miner.sample(60, 0, 0), 60)
+    s.unchanged(0, 60, miner.errors())
+    s.unchanged(1, 60, miner.errors())
+    # locked chains wait for the upper bound to drop below the limit itself
+    locked_at = error_bounds(1)[1] * 60 / MAX_ERR_RATE
+    self.assertAlmostEqual(locked_at, 1418.5, places=1)
+    s.decide(miner.sample(600, 1, 1), 600)
+    self.assertEqual(s.next_sample(miner.hist, 600), MAX_REPEAT)
+    s.decide(miner.sample(1200, 0, 0), 1200)
+    self.assertAlmostEqual(s.next_sample(miner.hist, 1200), locked_at - 1200, places=6)
+
+  def test_stable_chains_are_not_waited_for(self):
+    miner = Miner()
+    s = adaptive()
+    s.start(0, miner.sample(0, 0, 0).rates.errors())
+    s.decide(miner.sample(60, 0, 0), 60)
+    s.unchanged(0, 60, miner.errors())
+    s.unchanged(1, 60, miner.errors())
+    self.assertTrue(s.stable(miner.sample(960, 0, 0), 960))
+    self.assertEqual(s.next_sample(miner.hist, 960), MAX_REPEAT)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_search.py: tests of the voltage search strategies of search.py
+# --------------------------------------------------------------------------
+#
+# Every strategy tunes a simminer ChainModel without noise: each code is
+# observed for an hour at the model's error rate, codes well below the max
+# error rate are undervolted further, codes above it are overvolted and
+# codes in between are kept, like the adaptive schedule decides with enough
+# samples. Codes on record above the max are not acceptable, like
+# MinerTuner.voltage_history() tells. Every strategy has to end at a code
+# within the limit and close to the highest such code.
+#
+# Run from the scripts directory: python -m unittest test_search
+
+import unittest
+
+from scheduler import LOWER_FACTOR
+from search import SEARCHES, StepSearch, BisectSearch, BanditSearch, Observation
+from simminer import ChainModel
+
+MAX_ERR_RATE = 0.2
+MIN_CODE = 0x50
+MAX_CODE = 254
+FREQ = 384
+# seconds every code is observed for
+DWELL = 3600
+
+
+def observation(rate, since):
+  """Observation of DWELL seconds at rate"""
+  return Observation(rate, rate, rate, int(round(rate * DWELL / 60)), DWELL, since)
+
+
+class ConvergeTest(unittest.TestCase):
+
+  def tune(self, search, chain, code=0x80):
+    """Run search on chain from code until it stays, returns the
+    (code, decision) steps"""
+    strategy = SEARCHES[search](MAX_ERR_RATE, MIN_CODE, MAX_CODE)
+    seen = {}
+    acceptable = lambda c: seen.get(c, 0) <= MAX_ERR_RATE
+    steps = []
+    for n in range(100):
+      rate = chain.rate(code, FREQ, chain.temp(code, FREQ))
+      seen[code] = rate
+      obs = observation(rate, n * DWELL)
+      if rate > MAX_ERR_RATE:
+        new = strategy.raise_voltage(str(FREQ), 0, code, obs, acceptable)
+        steps.append((code, 'raise'))
+      elif rate < MAX_ERR_RATE * LOWER_FACTOR:
+        new = strategy.lower_voltage(str(FREQ), 0, code, obs, acceptable)
+        steps.append((code, 'lower'))
+      else:
+        new = None
+      # StepSearch returns the current code when it cannot move
+      if new is None or new == code:
+        return code, steps
+      self.assertTrue(MIN_CODE <= new <= MAX_CODE)
+      code = new
+    self.fail("%s did not converge: %r" %(search, steps))
+
+  def test_converges(self):
+    for sweet in (0xa0, 0xb3, 0xc8, 0xe8):
+      chain = ChainModel(sweet)
+      best = chain.best(FREQ, MAX_ERR_RATE)
+      for search in SEARCHES:
+        code, steps = self.tune(search, chain)
+        rate = chain.rate(code, FREQ, chain.temp(code, FREQ))
+        self.assertTrue(rate <= MAX_ERR_RATE, "%s %#x: %#x at %.2f/min" %(search, sweet, code, rate))
+        self.assertTrue(best - 3 <= code <= best, "%s %#x: %#x, best %#x" %(search, sweet, code, best))
+
+  def test_lowest_voltage(self):
+    # a chain fine at every code ends at the max code
+    for search in SEARCHES:
+      self.assertEqual(self.tune(search, ChainModel(0x108))[0], MAX_CODE)
+
+  def test_raise_from_above(self):
+    # starting far too low every strategy overvolts until within the limit
+    chain = ChainModel(0xa0)
+    best = chain.best(FREQ, MAX_ERR_RATE)
+    for search in SEARCHES:
+      code, steps = self.tune(search, chain, code=0xc0)
+      self.assertEqual(steps[0], (0xc0, 'raise'))
+      self.assertTrue(best - 3 <= code <= best, "%s: %#x, best %#x" %(search, code, best))
+
+  def test_bisect_brackets(self):
+    chain = ChainModel(0xb3)
+    code, steps = self.tune('bisect', chain)
+    lowered = [c for c, d in steps if d == 'lower']
+    # gallops with growing steps until the first bad code
+    self.assertEqual(lowered[:4], [0x80, 0x84, 0x8c, 0x9c])
+    # and the bracket narrows down to the best code
+    self.assertEqual(code, chain.best(FREQ, MAX_ERR_RATE))
+
+  def test_bandit_raises_like_step(self):
+    # overvolting steps at least 2 codes, more the more errors are seen
+    obs = observation(0.3, 0)
+    for cls in (StepSearch, BisectSearch, BanditSearch):
+      self.assertEqual(cls(MAX_ERR_RATE, MIN_CODE, MAX_CODE).raise_voltage('384', 0, 0xb0, obs, lambda c: True), 0xae)
+    obs = observation(1.2, 0)
+    for cls in (StepSearch, BisectSearch, BanditSearch):
+      self.assertEqual(cls(MAX_ERR_RATE, MIN_CODE, MAX_CODE).raise_voltage('384', 0, 0xb0, obs, lambda c: True), 0xaa)
+
+  def test_bandit_rules_out_neighbours(self):
+    bandit = BanditSearch(MAX_ERR_RATE, MIN_CODE, MAX_CODE)
+    # a code observed at 5 errors/min is confidently bad, and so are the codes
+    # below it within a factor GROWTH_BOUND per code of the max error rate
+    bandit.observe('384', 0, 0xb0, observation(5.0, 0))
+    bounds = bandit.bounds(bandit._arms('384', 0))
+    self.assertFalse(bandit.plausible(bounds, 0xb0))
+    self.assertFalse(bandit.plausible(bounds, 0xac))
+    self.assertTrue(bandit.plausible(bounds, 0xab))
+    # so undervolting from below stops short of them
+    self.assertEqual(bandit.lower_voltage('384', 0, 0xa0, observation(0.02, DWELL), lambda c: True), 0xa4)
+    self.assertEqual(bandit.lower_voltage('384', 0, 0xa4, observation(0.02, 2 * DWELL), lambda c: True), 0xab)
+
+
+if __name__ == '__main__':
+  unittest.main()
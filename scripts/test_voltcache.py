@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_voltcache.py: tests of the voltage cache of voltcache.py
+# --------------------------------------------------------------------------
+#
+# VoltageCache is checked on its own with made up samples and through
+# MinerTuner on simminer miners, counting the voltage reads of the tuner:
+# a set reported back by the sv agent is used without reading, a set that
+# failed and a restart of cgminer make the tuner read the voltages again.
+#
+# Run from the scripts directory: python -m unittest test_voltcache
+
+import unittest
+
+from replay import ReplayMiner, ReplayTuner
+from simminer import ChainModel, SimClock
+from test_autotune import FailingSSH
+from voltcache import VoltageCache
+
+VOLTAGES = ['0xa0', '0xa4', '0xa8', '0xac']
+
+
+def stats(uptime, err):
+  return {'uptime': uptime, 'err': list(err)}
+
+
+class VoltageCacheTest(unittest.TestCase):
+
+  def cache(self, ts=1000, verify_interval=1800):
+    """Cache filled at ts and checked against a first sample"""
+    cache = VoltageCache(verify_interval)
+    self.assertEqual(cache.check(stats(100, [0] * 4), ts), "no voltages known yet")
+    cache.fill(VOLTAGES, ts)
+    return cache
+
+  def test_filled(self):
+    cache = self.cache()
+    self.assertEqual(cache.check(stats(160, [1, 0, 2, 0]), 1060), None)
+    self.assertEqual(cache.voltages, VOLTAGES)
+    # fill keeps its own copy
+    cache.voltages[0] = '0xfe'
+    self.assertEqual(VOLTAGES[0], '0xa0')
+
+  def test_update_after_set(self):
+    cache = self.cache()
+    cache.update(2, '0xb0')
+    self.assertEqual(cache.check(stats(160, [0] * 4), 1060), None)
+    self.assertEqual(cache.voltages, ['0xa0', '0xb0', '0xa8', '0xac'])
+    # nothing to update before the first read
+    empty = VoltageCache()
+    empty.update(1, '0xb0')
+    self.assertEqual(empty.voltages, None)
+
+  def test_invalidate_after_failed_set(self):
+    cache = self.cache()
+    cache.invalidate("no result of setting chain 3")
+    self.assertEqual(cache.check(stats(160, [0] * 4), 1060), "no result of setting chain 3")
+    # the reason sticks until the voltages were read
+    self.assertEqual(cache.check(stats(220, [0] * 4), 1120), "no result of setting chain 3")
+    cache.fill(VOLTAGES, 1120)
+    self.assertEqual(cache.check(stats(280, [0] * 4), 1180), None)
+
+  def test_restart(self):
+    cache = self.cache()
+    self.assertEqual(cache.check(stats(160, [5, 5, 5, 5]), 1060), None)
+    self.assertEqual(cache.check(stats(20, [0] * 4), 1120), "miner restarted")
+
+  def test_counters_reset(self):
+    cache = self.cache()
+    self.assertEqual(cache.check(stats(160, [5, 5, 5, 5]), 1060), None)
+    self.assertEqual(cache.check(stats(220, [5, 0, 5, 5]), 1120), "hw error counters were reset")
+
+  def test_error_jump(self):
+    cache = self.cache()
+    self.assertEqual(cache.check(stats(160, [0] * 4), 1060), None)
+    # 10 errors/min are fine, more are not
+    self.assertEqual(cache.check(stats(220, [0, 0, 10, 0]), 1120), None)
+    self.assertEqual(cache.check(stats(280, [0, 0, 21, 0]), 1180), "chain 3 makes 11.0 errors/min")
+
+  def test_periodic_check(self):
+    cache = self.cache(verify_interval=600)
+    self.assertEqual(cache.check(stats(600, [0] * 4), 1599), None)
+    self.assertEqual(cache.check(stats(601, [0] * 4), 1600), "periodic check")
+    self.assertEqual(self.cache(verify_interval=None).check(stats(100000, [0] * 4), 100000), None)
+
+
+class CountingTuner(ReplayTuner):
+  """ReplayTuner counting the voltage reads from the miner"""
+
+  def __init__(self, *args, **kwargs):
+    ReplayTuner.__init__(self, *args, **kwargs)
+    self.reads = 0
+
+  def get_voltage(self, chain=False):
+    self.reads += 1
+    return ReplayTuner.get_voltage(self, chain)
+
+
+class TunerCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = SimClock()
+    self.miner = ReplayMiner('sim', [ChainModel(0xe0)] * 4, seed=0, clock=self.clock.time)
+    self.tuner = CountingTuner(self.miner, False, 'step', clock=self.clock)
+
+  def cycle(self):
+    """Sample the miner a minute later, returns the voltages the tuner uses"""
+    self.clock.sleep(60)
+    return self.tuner.cached_voltage(self.miner.sample(), int(self.clock.time()))
+
+  def set_chains(self, voltages):
+    """Set chains in one go like MinerTuner.adjust_voltage() does"""
+    results = self.tuner.set_voltages(voltages)
+    for c in voltages:
+      if results.has_key(c) and len(results[c]) == 2:
+        self.tuner.vcache.update(c, results[c][1])
+      else:
+        self.tuner.vcache.invalidate("no result of setting chain %i" %c)
+
+  def test_set(self):
+    self.assertEqual(self.cycle(), ['0x80'] * 4)
+    self.assertEqual(self.tuner.reads, 1)
+    self.set_chains({2: '0x90'})
+    # the voltage read back by the agent is used, no read needed
+    self.assertEqual([int(v, 16) for v in self.cycle()], [0x80, 0x90, 0x80, 0x80])
+    self.assertEqual(self.tuner.reads, 1)
+
+  def test_failed_set(self):
+    self.tuner.ssh = FailingSSH([self.miner], [3])
+    self.cycle()
+    self.set_chains({2: '0x90', 3: '0x90'})
+    voltages = self.cycle()
+    self.assertEqual(self.tuner.reads, 2)
+    self.assertEqual([int(v, 16) for v in voltages], [0x80, 0x90, 0x80, 0x80])
+    # read once, cached from then on
+    self.cycle()
+    self.assertEqual(self.tuner.reads, 2)
+
+  def test_cgminer_restart(self):
+    self.cycle()
+    self.set_chains({1: '0x90'})
+    self.cycle()
+    self.clock.sleep(60)
+    # the PICs come up at their default voltage
+    self.miner.restart(self.miner.frequency)
+    self.assertEqual([int(v, 16) for v in self.cycle()], [0x80] * 4)
+    self.assertEqual(self.tuner.reads, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
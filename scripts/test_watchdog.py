@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_watchdog.py: tests of the fault detection of watchdog.py
+# --------------------------------------------------------------------------
+#
+# A FaultDetector is fed polls 5s apart, as the watchdog threads make them,
+# built from a healthy reply and changed one field at a time. Every fault
+# kind has to be reported when it happens, lost chips and heat not again
+# while they last. hw error counters that were reset or restarted with
+# cgminer must not count as errors, and chains that just got more voltage
+# are left alone for the holdoff.
+#
+# Run from the scripts directory: python -m unittest test_watchdog
+
+import unittest
+
+from watchdog import FaultDetector, react, CHIPS, SPIKE, HOT, SPIKE_ERRORS, SPIKE_WINDOW, TEMP_LIMIT, \
+  TEMP_HYSTERESIS, HOLDOFF
+
+CHIPS_OK = ' ' + ' '.join(['oooooooo'] * 9)
+CHIPS_LOST = CHIPS_OK[:-2] + 'xx'
+
+
+class Poller(object):
+  """Polls of one miner, every 5s from ts 1000 on"""
+
+  def __init__(self, detector):
+    self.detector = detector
+    self.ts = 1000
+    self.uptime = 600
+    self.err = [10, 20, 30, 40]
+    self.temp = [70] * 4
+    self.acs = [CHIPS_OK] * 4
+
+  def stats(self):
+    return {'err': list(self.err), 'temp_chip': list(self.temp), 'asic_status': list(self.acs),
+            'uptime': self.uptime, 'frequency': '384'}
+
+  def poll(self, seconds=5):
+    """Next poll, returns the faults"""
+    self.ts += seconds
+    self.uptime += seconds
+    return self.detector.check(self.stats(), self.ts)
+
+
+class FaultDetectorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.poller = Poller(FaultDetector())
+    # the first poll only sets the base
+    self.assertEqual(self.poller.poll(), [])
+
+  def test_healthy(self):
+    p = self.poller
+    for n in range(200):
+      # an error every 5 minutes
+      if n % 60 == 0:
+        p.err[1] += 1
+      self.assertEqual(p.poll(), [])
+
+  def test_chips(self):
+    p = self.poller
+    p.acs[2] = CHIPS_LOST
+    faults = p.poll()
+    self.assertEqual([(c, f) for c, f, msg in faults], [(2, CHIPS)])
+    self.assertTrue(faults[0][2].startswith("lost 2 chip(s)"))
+    # chips that are still gone are not reported again
+    self.assertEqual(p.poll(), [])
+    p.acs[2] = CHIPS_OK
+    self.assertEqual(p.poll(), [])
+    p.acs[2] = CHIPS_LOST
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(2, CHIPS)])
+
+  def test_spike(self):
+    p = self.poller
+    p.err[0] += SPIKE_ERRORS - 1
+    self.assertEqual(p.poll(), [])
+    p.err[0] += 1
+    faults = p.poll()
+    self.assertEqual([(c, f) for c, f, msg in faults], [(0, SPIKE)])
+    self.assertEqual(faults[0][2], "made %i hw errors in 10s" %SPIKE_ERRORS)
+
+  def test_slow_errors_are_no_spike(self):
+    p = self.poller
+    # SPIKE_ERRORS errors, but spread over more than a minute
+    for n in range(SPIKE_ERRORS):
+      p.err[3] += 1
+      self.assertEqual(p.poll(25), [])
+    # and counting starts over after the window
+    p.poll(SPIKE_WINDOW)
+    p.err[3] += SPIKE_ERRORS - 1
+    self.assertEqual(p.poll(), [])
+
+  def test_hot(self):
+    p = self.poller
+    p.temp[1] = TEMP_LIMIT
+    faults = p.poll()
+    self.assertEqual(faults, [(1, HOT, "chips at %i C" %TEMP_LIMIT)])
+    self.assertEqual(p.poll(), [])
+    # cooling down less than the hysteresis is not enough to be warned again
+    p.temp[1] = TEMP_LIMIT - TEMP_HYSTERESIS
+    self.assertEqual(p.poll(), [])
+    p.temp[1] = TEMP_LIMIT + 2
+    self.assertEqual(p.poll(), [])
+    p.temp[1] = TEMP_LIMIT - TEMP_HYSTERESIS - 1
+    self.assertEqual(p.poll(), [])
+    p.temp[1] = TEMP_LIMIT
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(1, HOT)])
+
+  def test_several_faults(self):
+    p = self.poller
+    p.acs[3] = CHIPS_LOST
+    p.err[3] += 50
+    p.temp[0] = TEMP_LIMIT + 5
+    faults = sorted([(c, f) for c, f, msg in p.poll()])
+    self.assertEqual(faults, [(0, HOT), (3, CHIPS), (3, SPIKE)])
+
+  def test_counter_reset(self):
+    p = self.poller
+    p.err = [0, 1, 0, 2]
+    self.assertEqual(p.poll(), [])
+    # counting goes on from the new counters
+    p.err[1] += 1
+    self.assertEqual(p.poll(), [])
+    p.err[1] += SPIKE_ERRORS
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(1, SPIKE)])
+
+  def test_cgminer_restart(self):
+    p = self.poller
+    p.err[2] += 1
+    p.poll()
+    # cgminer restarted between two polls and its counters started over,
+    # the errors of the new run are no spike even where they are above the
+    # counters of the old run, and neither are chips missing since
+    p.uptime = 0
+    p.err = [50, 50, 50, 50]
+    p.acs = [CHIPS_LOST] * 4
+    self.assertEqual(p.poll(), [])
+    p.err = [52, 52, 52, 52]
+    self.assertEqual(p.poll(), [])
+
+  def test_chains_changed(self):
+    p = self.poller
+    p.err.append(0)
+    p.temp.append(70)
+    p.acs.append(CHIPS_OK)
+    self.assertEqual(p.poll(), [])
+    p.err[4] += 10
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(4, SPIKE)])
+
+  def test_holdoff(self):
+    p = self.poller
+    p.detector.hold(0, p.ts)
+    # errors and chips lost while settling at the new voltage are ignored
+    p.err[0] += 20
+    p.acs[0] = CHIPS_LOST
+    self.assertEqual(p.poll(), [])
+    p.err[0] += 20
+    self.assertEqual(p.poll(HOLDOFF - 10), [])
+    # other chains are not held
+    p.err[1] += 20
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(1, SPIKE)])
+    p.detector.hold(1, p.ts)
+    # and after the holdoff chain 1 is watched again
+    p.err[0] += 20
+    self.assertEqual([(c, f) for c, f, msg in p.poll()], [(0, SPIKE)])
+
+
+class Tuner(object):
+  """Tuner protecting the chains given"""
+
+  def __init__(self, raises):
+    self.raises = raises
+    self.faults = []
+
+  def protect(self, stats, faults):
+    self.faults.append(faults)
+    return [c for c, f, msg in faults if c in self.raises]
+
+
+class ReactTest(unittest.TestCase):
+
+  def test_react(self):
+    p = Poller(FaultDetector())
+    tuner = Tuner([1])
+    self.assertEqual(react(tuner, p.detector, p.stats(), p.ts), [])
+    # no faults, the tuner is not bothered
+    p.poll()
+    self.assertEqual(tuner.faults, [])
+    p.ts += 5
+    p.err[1] += 10
+    p.err[2] += 10
+    self.assertEqual(react(tuner, p.detector, p.stats(), p.ts), [1])
+    self.assertEqual([[(c, f) for c, f, msg in faults] for faults in tuner.faults], [[(1, SPIKE), (2, SPIKE)]])
+    # the chain that got more voltage is held, the other one was not raised
+    self.assertEqual(p.detector.held, {1: p.ts + HOLDOFF})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# voltcache.py: write-through cache of the chain voltages of a miner
+# --------------------------------------------------------------------------
+#
+# The tuner is the only one changing voltages and the sv tool reports the
+# value read back from the PIC after every set, so there is no need to read
+# all voltages over ssh every cycle. The cache is filled from those set
+# results and only checked against the miner every verify_interval seconds,
+# or as soon as something looks wrong: the miner restarted (its uptime went
+# backwards, the PICs come up with their default voltage), hw error counters
+# were reset or a chain suddenly makes errors much faster than a tuned chain
+# ever should, or a set did not report its result.
+
+# seconds between reads of the voltages from the miner while nothing looks wrong
+VERIFY_INTERVAL = 1800
+# errors/min of a chain between two samples that make us read the voltages
+ERROR_JUMP_RATE = 10.0
+
+
+class VoltageCache(object):
+  """Last known voltages of the chains of one miner as hex strings"""
+
+  def __init__(self, verify_interval=VERIFY_INTERVAL, error_jump_rate=ERROR_JUMP_RATE):
+    self.verify_interval = verify_interval
+    self.error_jump_rate = error_jump_rate
+    self.voltages = None
+    # timestamp of the last read from the miner
+    self.verified = None
+    self.stale = None
+    self.last = None
+
+  def fill(self, voltages, ts):
+    """Voltages were read from the miner at ts"""
+    self.voltages = list(voltages)
+    self.verified = ts
+    self.stale = None
+
+  def update(self, chain, voltage):
+    """The voltage of chain (1-4) was set and read back as voltage"""
+    if self.voltages is not None:
+      self.voltages[chain-1] = voltage
+
+  def invalidate(self, reason):
+    """Read the voltages from the miner on the next check"""
+    self.stale = reason
+
+  def check(self, stats, ts):
+    """Look at a new sample, returns why the voltages have to be read from
+    the miner or None if the cached ones can be used"""
+    last, self.last = self.last, (ts, stats['uptime'], list(stats['err']))
+    if self.voltages is None:
+      return "no voltages known yet"
+    if self.stale:
+      return self.stale
+    if last is not None:
+      last_ts, uptime, err = last
+      if stats['uptime'] < uptime:
+        return "miner restarted"
+      minutes = (ts - last_ts) / 60.0
+      for c in range(len(err)):
+        if stats['err'][c] < err[c]:
+          return "hw error counters were reset"
+        if minutes > 0 and (stats['err'][c] - err[c]) / minutes > self.error_jump_rate:
+          return "chain %i makes %.1f errors/min" %(c+1, (stats['err'][c] - err[c]) / minutes)
+    if self.verify_interval is not None and ts - self.verified >= self.verify_interval:
+      return "periodic check"
+    return None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# watchdog.py: fast reaction to faults of the miners between tuning cycles
+# --------------------------------------------------------------------------
+#
+# A tuning cycle reads the voltages over ssh, runs the schedule and sleeps
+# up to several minutes, a chain that suddenly makes errors by the hundred
+# or loses chips keeps doing so until the next one. The watchdog polls only
+# the cgminer API of every miner being tuned, every few seconds on threads
+# of its own, and compares each reply to the last ones per chain: chips
+# that dropped out since the last poll, hw errors coming in much faster
+# than any tuned chain makes them and chips getting too hot. The tuner of
+# the miner reacts right away through MinerTuner.protect(), chains with
+# dropped chips or an error spike get more voltage the same way the
+# schedule raises them.
+#
+# The watchdog only starts its threads once the first miner is added, in
+# the process it is added in, so one instance can be handed to the shard
+# processes of a big fleet.
+
+import os, time, heapq, threading
+
+from cgminer_api import CgminerClient, ApiError, API_PORT
+
+# seconds between polls of the cgminer API of a miner
+WATCHDOG_INTERVAL = 5
+# miners polled in parallel
+WATCHDOG_WORKERS = 4
+# seconds to connect to a miner and for each receive of its reply
+WATCHDOG_TIMEOUT = 3.0
+# errors/min of a chain that make it get more voltage right away, and the
+# errors needed for that, a tuned chain makes a few per hour
+SPIKE_RATE = 5.0
+SPIKE_ERRORS = 3
+# seconds errors are counted over before counting starts again
+SPIKE_WINDOW = 60
+# chip temperature (C) warned about, and degrees a chain has to cool down
+# before it is warned about again
+TEMP_LIMIT = 90
+TEMP_HYSTERESIS = 5
+# seconds a chain is left alone after it got more voltage
+HOLDOFF = 60
+
+# the faults
+CHIPS = 'chips'
+SPIKE = 'spike'
+HOT = 'hot'
+
+
+class FaultDetector(object):
+  """Per chain state of the polls of one miner, updated with every poll"""
+
+  def __init__(self, spike_rate=SPIKE_RATE, spike_errors=SPIKE_ERRORS, window=SPIKE_WINDOW,
+               temp_limit=TEMP_LIMIT, hysteresis=TEMP_HYSTERESIS, holdoff=HOLDOFF):
+    self.spike_rate = spike_rate
+    self.spike_errors = spike_errors
+    self.window = window
+    self.temp_limit = temp_limit
+    self.hysteresis = hysteresis
+    self.holdoff = holdoff
+    # per chain (timestamp, error counter) errors are counted from
+    self.base = None
+    # per chain chips not working
+    self.chips = None
+    # per chain whether it was warned about its temperature
+    self.hot = None
+    # chain -> timestamp until which it is left alone
+    self.held = {}
+    self.uptime = None
+
+  def reset(self, stats, ts):
+    self.base = [(ts, e) for e in stats['err']]
+    self.chips = [s.count('x') for s in stats['asic_status']]
+    self.hot = [False] * len(self.base)
+    self.uptime = stats['uptime']
+
+  def check(self, stats, ts):
+    """Look at a new poll, returns a list of (chain index, fault, message)"""
+    if self.base is None or stats['uptime'] < self.uptime or len(stats['err']) != len(self.base):
+      # first poll or cgminer restarted, the counters start over
+      self.reset(stats, ts)
+      return []
+    self.uptime = stats['uptime']
+    faults = []
+    for c in range(len(self.base)):
+      err = stats['err'][c]
+      chips = stats['asic_status'][c].count('x')
+      temp = stats['temp_chip'][c]
+      if temp >= self.temp_limit and not self.hot[c]:
+        self.hot[c] = True
+        faults.append((c, HOT, "chips at %i C" %temp))
+      elif temp < self.temp_limit - self.hysteresis:
+        self.hot[c] = False
+      since, count = self.base[c]
+      if ts < self.held.get(c, 0) or err < count:
+        # settling at the new voltage or the counter was reset
+        self.base[c] = (ts, err)
+        self.chips[c] = chips
+        continue
+      if chips > self.chips[c]:
+        faults.append((c, CHIPS, "lost %i chip(s): %s" %(chips - self.chips[c], stats['asic_status'][c].strip())))
+      self.chips[c] = chips
+      minutes = (ts - since) / 60.0
+      if err - count >= self.spike_errors and minutes > 0 and (err - count) / minutes > self.spike_rate:
+        faults.append((c, SPIKE, "made %i hw errors in %is" %(err - count, ts - since)))
+      elif ts - since > self.window:
+        self.base[c] = (ts, err)
+    return faults
+
+  def hold(self, chain, ts):
+    """chain got more voltage at ts, leave it alone for a while"""
+    self.held[chain] = ts + self.holdoff
+
+
+def react(tuner, detector, stats, ts):
+  """Check a poll of the miner of tuner and have it protect the chains
+  with faults, returns the chains that got more voltage"""
+  faults = detector.check(stats, ts)
+  if not faults:
+    return []
+  raised = tuner.protect(stats, faults)
+  for c in raised:
+    detector.hold(c, ts)
+  return raised
+
+
+class Watchdog(object):
+  """Polls the cgminer API of the miners being tuned every interval seconds
+  on a few threads and has their tuners react to faults. Miners are dropped
+  once their tuner is finished or failed."""
+
+  def __init__(self, interval=WATCHDOG_INTERVAL, workers=WATCHDOG_WORKERS, timeout=WATCHDOG_TIMEOUT, port=API_PORT):
+    self.interval = interval
+    self.workers = workers
+    self.timeout = timeout
+    self.port = port
+    self.queue = []
+    self.seq = 0
+    self.cond = threading.Condition()
+    self.threads = []
+    # process the threads run in
+    self.pid = None
+    self.stopped = False
+
+  def add(self, tuner):
+    """Watch the miner of tuner until tuning it is over"""
+    self.cond.acquire()
+    try:
+      if self.pid != os.getpid():
+        # threads do not survive a fork, start our own
+        self.pid = os.getpid()
+        self.threads = []
+      heapq.heappush(self.queue, (time.time() + self.interval, self.seq, tuner, FaultDetector()))
+      self.seq += 1
+      if len(self.threads) < min(self.workers, len(self.queue)):
+        t = threading.Thread(target=self._worker, name="watchdog-%i" %len(self.threads))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+
+  def stop(self):
+    self.cond.acquire()
+    try:
+      self.stopped = True
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+
+  def _next(self):
+    """Block until a miner is due, returns None once stopped"""
+    self.cond.acquire()
+    try:
+      while not self.stopped:
+        if self.queue:
+          due = self.queue[0][0] - time.time()
+          if due <= 0:
+            return heapq.heappop(self.queue)
+          self.cond.wait(due)
+        else:
+          self.cond.wait(1)
+      return None
+    finally:
+      self.cond.release()
+
+  def _worker(self):
+    # CgminerClient is not thread safe, one per worker
+    client = CgminerClient(timeout=self.timeout)
+    while True:
+      item = self._next()
+      if item is None:
+        return
+      due, seq, tuner, detector = item
+      if tuner.finished or tuner.failed:
+        continue
+      try:
+        stats = client.stats(tuner.ip, self.port).as_dict()
+      except ApiError:
+        # the tuning cycle finds out, cgminer may just be restarting
+        stats = None
+      if stats is not None:
+        react(tuner, detector, stats, time.time())
+      self.cond.acquire()
+      try:
+        heapq.heappush(self.queue, (time.time() + self.interval, seq, tuner, detector))
+        self.cond.notify_all()
+      finally:
+        self.cond.release()
@@ -13,6 +13,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <unistd.h>
+#include <sys/time.h>
 #include <linux/i2c-dev.h>
 #include <sys/ioctl.h>
 #include <sys/types.h>
@@ -27,6 +28,15 @@
 #define JUMP_FROM_LOADER_TO_APP             0x06
 #define RESET_PIC                           0x07
 #define READ_PIC_SOFTWARE_VERSION           0x17
+#define PIC_SOFTWARE_VERSION                0x03
+// a PIC busy with the last command does not answer or answers 0xff, which is
+// no valid voltage. Replies are polled every PIC_POLL_US instead of sleeping
+// a fixed 500ms after every command, for at most PIC_READ_TIMEOUT_US for a
+// reply and PIC_SET_TIMEOUT_US for a new voltage to read back.
+#define PIC_BUSY                            0xff
+#define PIC_POLL_US                         2000
+#define PIC_READ_TIMEOUT_US                 500000
+#define PIC_SET_TIMEOUT_US                  1000000
 static unsigned char Pic_command_1[1] = {PIC_COMMAND_1};
 static unsigned char Pic_command_2[1] = {PIC_COMMAND_2};
 static unsigned char Pic_set_voltage[1] = {SET_VOLTAGE};
@@ -41,67 +51,256 @@ int const i2c_slave_addr[4] = {0xa0,0xa2,0xa4,0xa6};
 
 
 
+long long now_us() {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec * 1000000LL + tv.tv_usec;
+}
+
+// i2c backend: the real /dev/i2c-0 or, if SV_I2C_SIM is set in the
+// environment, a simulated set of PICs for testing off the miner. If
+// SV_I2C_SIM names a file, simulated voltages are kept there between runs.
+// SV_I2C_SIM_BYTE_US is the time a byte takes on the simulated bus and
+// SV_I2C_SIM_SETTLE_US the time a simulated PIC is busy after a set.
+static int sim_i2c = 0;
+static char *sim_file = NULL;
+static unsigned char sim_voltage[4] = {0x80,0x80,0x80,0x80};
+static long long sim_busy_until[4] = {0,0,0,0};
+static long sim_byte_us = 0;
+static long sim_settle_us = 0;
+static int sim_chain = 0;
+static int sim_state = 0;
+static unsigned char sim_command = 0;
+
+void sim_init() {
+    char *env = getenv("SV_I2C_SIM");
+    FILE *f;
+    if (env == NULL || *env == '\0')
+        return;
+    sim_i2c = 1;
+    if (getenv("SV_I2C_SIM_BYTE_US") != NULL)
+        sim_byte_us = atol(getenv("SV_I2C_SIM_BYTE_US"));
+    if (getenv("SV_I2C_SIM_SETTLE_US") != NULL)
+        sim_settle_us = atol(getenv("SV_I2C_SIM_SETTLE_US"));
+    if (strcmp(env, "1") != 0) {
+        sim_file = env;
+        if ((f = fopen(sim_file, "rb")) != NULL) {
+            fread(sim_voltage, 1, 4, f);
+            fclose(f);
+        }
+    }
+}
+
+void sim_save() {
+    FILE *f;
+    if (sim_file == NULL)
+        return;
+    if ((f = fopen(sim_file, "wb")) != NULL) {
+        fwrite(sim_voltage, 1, 4, f);
+        fclose(f);
+    }
+}
+
+// feed one byte into the simulated PIC command parser
+void sim_byte(unsigned char b) {
+    switch (sim_state) {
+    case 0:
+        sim_state = (b == PIC_COMMAND_1) ? 1 : 0;
+        break;
+    case 1:
+        sim_state = (b == PIC_COMMAND_2) ? 2 : 0;
+        break;
+    case 2:
+        sim_command = b;
+        sim_state = (b == SET_VOLTAGE) ? 3 : 0;
+        break;
+    case 3:
+        sim_voltage[sim_chain] = b;
+        sim_busy_until[sim_chain] = now_us() + sim_settle_us;
+        sim_save();
+        sim_state = 0;
+        break;
+    }
+}
+
+int bus_open(const char *filename) {
+    if (sim_i2c)
+        return 0;
+    return open(filename, O_RDWR);
+}
+
+int bus_select(int fd, int addr) {
+    int chain;
+    if (!sim_i2c)
+        return ioctl(fd, I2C_SLAVE, addr);
+    for (chain = 0; chain < 4; chain++) {
+        if (i2c_slave_addr[chain] >> 1 == addr) {
+            sim_chain = chain;
+            sim_state = 0;
+            return 0;
+        }
+    }
+    return -1;
+}
+
+ssize_t bus_write(int fd, const unsigned char *buf, size_t len) {
+    size_t i;
+    if (!sim_i2c)
+        return write(fd, buf, len);
+    if (sim_byte_us)
+        usleep(sim_byte_us * len);
+    for (i = 0; i < len; i++)
+        sim_byte(buf[i]);
+    return len;
+}
+
+ssize_t bus_read(int fd, unsigned char *buf, size_t len) {
+    if (!sim_i2c)
+        return read(fd, buf, len);
+    if (sim_byte_us)
+        usleep(sim_byte_us * len);
+    if (now_us() < sim_busy_until[sim_chain])
+        *buf = PIC_BUSY;
+    else if (sim_command == READ_PIC_SOFTWARE_VERSION)
+        *buf = PIC_SOFTWARE_VERSION;
+    else if (sim_command == GET_VOLTAGE)
+        *buf = sim_voltage[sim_chain];
+    else
+        *buf = 0xff;
+    sim_command = 0;
+    return 1;
+}
+
+void bus_close(int fd) {
+    if (!sim_i2c)
+        close(fd);
+}
+
+// the simulated PICs need no settle time
+void pic_delay(useconds_t usec) {
+    if (!sim_i2c)
+        usleep(usec);
+}
+
+// latency of each PIC operation, printed at exit in --bench mode
+#define OP_SELECT                           0
+#define OP_READ                             1
+#define OP_SET                              2
+#define OP_COUNT                            3
+static const char *op_names[OP_COUNT] = {"select", "read", "set"};
+static int op_count[OP_COUNT];
+static int op_failed[OP_COUNT];
+static long long op_total[OP_COUNT], op_min[OP_COUNT], op_max[OP_COUNT];
+
+void timing_add(int op, long long start, int failed) {
+    long long took = now_us() - start;
+    if (op_count[op] == 0 || took < op_min[op])
+        op_min[op] = took;
+    if (took > op_max[op])
+        op_max[op] = took;
+    op_total[op] += took;
+    op_count[op]++;
+    op_failed[op] += failed != 0;
+}
+
+void print_timings() {
+    int op;
+    for (op = 0; op < OP_COUNT; op++) {
+        if (op_count[op] == 0)
+            continue;
+        printf("timing %s: %i ops, %i failed, min %.2f ms, mean %.2f ms, max %.2f ms\n", op_names[op],
+               op_count[op], op_failed[op], op_min[op] / 1000.0, op_total[op] / 1000.0 / op_count[op], op_max[op] / 1000.0);
+    }
+}
+
 void pic_send_command(int fd)
 {
     //printf("--- %s\n", __FUNCTION__);
     pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_command_1, 1);
-    write(fd, Pic_command_2, 1);
+    bus_write(fd, Pic_command_1, 1);
+    bus_write(fd, Pic_command_2, 1);
     pthread_mutex_unlock(&i2c_mutex);
 }
 
-void pic_read_pic_software_version(unsigned char *version, int fd)
+// one command and its reply byte, returns 0 if the PIC was ready to answer
+int pic_query(int fd, unsigned char *command, unsigned char *reply)
 {
+    ssize_t n;
     pic_send_command(fd);
-    
-    //printf("\n--- %s\n", __FUNCTION__);
     pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_read_pic_software_version, 1);
-    read(fd, version, 1);
+    bus_write(fd, command, 1);
+    n = bus_read(fd, reply, 1);
     pthread_mutex_unlock(&i2c_mutex);
+    return (n == 1 && *reply != PIC_BUSY) ? 0 : -1;
 }
 
-void pic_read_voltage(unsigned char *voltage, int fd)
+// repeat a query until the PIC answers want (any answer if want is PIC_BUSY),
+// returns 0 or -1 if timeout_us passed first. reply keeps the last answer.
+int pic_poll(int fd, unsigned char *command, unsigned char *reply, unsigned char want, long timeout_us)
+{
+    long long start = now_us();
+    unsigned char answer;
+    for (;;) {
+        if (pic_query(fd, command, &answer) == 0) {
+            *reply = answer;
+            if (want == PIC_BUSY || answer == want)
+                return 0;
+        }
+        if (now_us() - start >= timeout_us)
+            return -1;
+        usleep(PIC_POLL_US);
+    }
+}
+
+int pic_read_pic_software_version(unsigned char *version, int fd)
 {
-    
-    pic_send_command(fd);
-    
     //printf("\n--- %s\n", __FUNCTION__);
-    
-    pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_get_voltage, 1);
-    read(fd, voltage, 1);
-    pthread_mutex_unlock(&i2c_mutex);
-    
-    usleep(500000);
+    return pic_poll(fd, Pic_read_pic_software_version, version, PIC_BUSY, PIC_READ_TIMEOUT_US);
 }
 
-void pic_set_voltage(unsigned char *voltage, int fd)
+int pic_read_voltage(unsigned char *voltage, int fd)
 {
-    
+    long long start = now_us();
+    int ret;
+    //printf("\n--- %s\n", __FUNCTION__);
+    ret = pic_poll(fd, Pic_get_voltage, voltage, PIC_BUSY, PIC_READ_TIMEOUT_US);
+    timing_add(OP_READ, start, ret);
+    return ret;
+}
+
+// set the voltage and read it back until the PIC applied it, the last
+// voltage read is left in readback
+int pic_set_voltage(unsigned char *voltage, int fd, unsigned char *readback)
+{
+    long long start = now_us();
+    int ret;
     pic_send_command(fd);
     
     //printf("\n--- %s\n", __FUNCTION__);
     
     pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_set_voltage, 1);
-    write(fd, voltage, 1);
+    bus_write(fd, Pic_set_voltage, 1);
+    bus_write(fd, voltage, 1);
     pthread_mutex_unlock(&i2c_mutex);
     
-    usleep(500000);
+    ret = pic_poll(fd, Pic_get_voltage, readback, *voltage, PIC_SET_TIMEOUT_US);
+    timing_add(OP_SET, start, ret);
+    return ret;
 }
 
 
 
-void pic_jump_from_loader_to_app(int fd)
+int pic_jump_from_loader_to_app(int fd)
 {
+    unsigned char version = 0;
     pic_send_command(fd);
     
     //printf("\n--- %s\n", __FUNCTION__);
     pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_jump_from_loader_to_app, 1);
+    bus_write(fd, Pic_jump_from_loader_to_app, 1);
     pthread_mutex_unlock(&i2c_mutex);
-    usleep(500000);
+    // the app answers with its version once it runs
+    return pic_poll(fd, Pic_read_pic_software_version, &version, PIC_SOFTWARE_VERSION, PIC_SET_TIMEOUT_US);
 }
 
 void pic_reset(int fd)
@@ -110,26 +309,32 @@ void pic_reset(int fd)
     
     printf("\n--- %s\n", __FUNCTION__);
     pthread_mutex_lock(&i2c_mutex);
-    write(fd, Pic_reset, 1);
+    bus_write(fd, Pic_reset, 1);
     pthread_mutex_unlock(&i2c_mutex);
-    usleep(600*1000);
+    pic_delay(600*1000);
 }
 
-int init_i2c(int chain) {
+int open_i2c() {
     char filename[40];
-    unsigned char version = 0;
     int fd;
     sprintf(filename,"/dev/i2c-0");
     
-    if ((fd = open(filename,O_RDWR)) < 0) {
+    if ((fd = bus_open(filename)) < 0) {
         printf("Failed to open the bus\n");
         exit(1);
     }
+    return fd;
+}
 
-    pthread_mutex_lock(&iic_mutex);
-    if (ioctl(fd,I2C_SLAVE,i2c_slave_addr[chain] >> 1 )) {
+// point an open bus at the PIC of chain and check its version
+int select_chain(int fd, int chain) {
+    unsigned char version = 0;
+    long long start = now_us();
+
+    if (bus_select(fd, i2c_slave_addr[chain] >> 1 )) {
         printf("Failed to acquire bus access and/or talk to slave.\n");
-        exit(1);
+        timing_add(OP_SELECT, start, 1);
+        return -1;
     }
     
    // pic_reset(fd);
@@ -137,46 +342,91 @@ int init_i2c(int chain) {
     pic_read_pic_software_version(&version, fd);
     //printf(" version = 0x%02x\n", version);
     
-    if(version != 0x03){
+    if(version != PIC_SOFTWARE_VERSION){
         printf("Wrong PIC version\n");
+        timing_add(OP_SELECT, start, 1);
+        return -1;
+    }
+    timing_add(OP_SELECT, start, 0);
+    return 0;
+}
+
+int init_i2c(int chain) {
+    int fd;
+    fd = open_i2c();
+
+    pthread_mutex_lock(&iic_mutex);
+    if (select_chain(fd, chain) != 0) {
         exit(1);
     }
     return fd;
 }
 
 
-void read_voltage(int chain) {
+// PIC versions already verified on the open bus
+static int pic_checked[4] = {0,0,0,0};
+
+// like select_chain, but only checks the PIC version once per chain
+int select_chain_cached(int fd, int chain) {
+    if (!pic_checked[chain]) {
+        if (select_chain(fd, chain) != 0)
+            return -1;
+        pic_checked[chain] = 1;
+        return 0;
+    }
+    if (bus_select(fd, i2c_slave_addr[chain] >> 1 )) {
+        printf("Failed to acquire bus access and/or talk to slave.\n");
+        pic_checked[chain] = 0;
+        return -1;
+    }
+    return 0;
+}
+
+// read the voltage of a selected chain, exits if the PIC does not answer
+void print_voltage(int fd, int chain) {
     unsigned char voltage = 0;
+    if (pic_read_voltage(&voltage, fd) != 0) {
+        printf("Timeout reading voltage of chain %i\n", chain+1);
+        exit(1);
+    }
+    printf("chain %i: voltage = 0x%02x", chain+1, voltage);
+}
+
+void read_voltage(int chain) {
     int fd;
     fd = init_i2c(chain);
-    pic_read_voltage(&voltage, fd);   
-    printf("chain %i: voltage = 0x%02x", chain+1, voltage);
+    print_voltage(fd, chain);
    // pic_reset(fd);
     pthread_mutex_unlock(&iic_mutex);
-    close(fd);
+    bus_close(fd);
 }
 
+// all chains with a single open of the bus
 void read_voltage_all() {
-    int chain;
+    int fd, chain;
+    fd = open_i2c();
+    pthread_mutex_lock(&iic_mutex);
     for (chain = 0; chain < 4; chain++) {
       //printf("\nchain %i: ", chain+1, "");
       printf("\n");
-      read_voltage(chain);
+      if (select_chain_cached(fd, chain) != 0)
+          exit(1);
+      print_voltage(fd, chain);
     }
+    pthread_mutex_unlock(&iic_mutex);
+    bus_close(fd);
 }
 
 void write_voltage(int chain, unsigned char set_voltage) {
     unsigned char voltage = 0;
     int fd;
     fd = init_i2c(chain);
-    printf("Reading voltage");
-    pic_read_voltage(&voltage, fd);
-    printf("\nchain %i: voltage = 0x%02x\n", chain+1, voltage);
-    printf("Setting voltage on chain %i\n", chain+1);
-    pic_set_voltage(&set_voltage, fd);
+    printf("Reading voltage\n");
+    print_voltage(fd, chain);
+    printf("\nSetting voltage on chain %i\n", chain+1);
+    pic_set_voltage(&set_voltage, fd, &voltage);
     
     printf("Reading voltage");
-    pic_read_voltage(&voltage, fd);
     printf("\nchain %i: voltage = 0x%02x\n", chain+1, voltage);
    // pic_reset(fd);
     pthread_mutex_unlock(&iic_mutex);
@@ -187,7 +437,63 @@ void write_voltage(int chain, unsigned char set_voltage) {
     }
     else
         printf("Success: Voltage updated!\n");
-    close(fd);
+    bus_close(fd);
+}
+
+// set several chains on an open bus, one result line per chain:
+// chain <n>: voltage = 0x<before> -> 0x<after> OK|ERROR
+int set_chains(int fd, int count, int *chains, unsigned char *set_voltages) {
+    unsigned char voltage = 0, old_voltage = 0;
+    int i, failed = 0;
+    for (i = 0; i < count; i++) {
+        if (select_chain_cached(fd, chains[i]) != 0) {
+            printf("chain %i: voltage = ERROR\n", chains[i]+1);
+            failed++;
+            continue;
+        }
+        if (pic_read_voltage(&old_voltage, fd) != 0) {
+            printf("chain %i: voltage = ERROR\n", chains[i]+1);
+            failed++;
+            continue;
+        }
+        voltage = old_voltage;
+        if (old_voltage != set_voltages[i])
+            pic_set_voltage(&set_voltages[i], fd, &voltage);
+        if (voltage != set_voltages[i])
+            failed++;
+        printf("chain %i: voltage = 0x%02x -> 0x%02x %s\n", chains[i]+1, old_voltage, voltage,
+               voltage == set_voltages[i] ? "OK" : "ERROR");
+    }
+    return failed;
+}
+
+// set several chains with a single open of the bus
+int write_voltage_batch(int count, int *chains, unsigned char *set_voltages) {
+    int fd, failed;
+    fd = open_i2c();
+    pthread_mutex_lock(&iic_mutex);
+    failed = set_chains(fd, count, chains, set_voltages);
+    pthread_mutex_unlock(&iic_mutex);
+    bus_close(fd);
+    return failed;
+}
+
+// parse chain:voltage pairs, returns the number of pairs or -1
+int parse_pairs(int argc, char *argv[], int *chains, unsigned char *voltages) {
+    unsigned int chain, voltage;
+    int i, count = 0;
+    if (argc < 1 || argc > 4)
+        return -1;
+    for (i = 0; i < argc; i++) {
+        if (sscanf(argv[i], "%u:%x", &chain, &voltage) != 2 || chain > 4 || chain == 0 || voltage > 0xfe) {
+            printf("Invalid chain:voltage pair %s, valid range 1-4:00-fe\n", argv[i]);
+            return -1;
+        }
+        chains[count] = chain - 1;
+        voltages[count] = voltage;
+        count++;
+    }
+    return count;
 }
 
 void print_help() {
@@ -195,10 +501,121 @@ void print_help() {
     printf("./set_voltage [chain# 1-4] [voltage in hex]\n");
     printf("If no voltage is given, voltage is read out from chain.\n");
     printf("If no chain is given, all chains will be read out.\n");
+    printf("./set_voltage batch [chain#:voltage in hex] ...\n");
+    printf("sets several chains at once, i.e. ./set_voltage batch 1:e0 3:c8\n");
+    printf("./set_voltage agent\n");
+    printf("serves get/set commands on stdin until quit, see README.\n");
+    printf("./set_voltage --bench [command]\n");
+    printf("runs the command and prints the latency of every PIC operation.\n");
+}
+
+void batch_main(int argc, char *argv[]) {
+    int chains[4];
+    unsigned char voltages[4];
+    int count;
+    if ((count = parse_pairs(argc - 2, argv + 2, chains, voltages)) < 0) {
+        printf("Incorrect arguments\n");
+        print_help();
+        exit(1);
+    }
+    if (write_voltage_batch(count, chains, voltages) > 0) {
+        printf("ERROR: Voltage was not successfully set\n");
+        exit(1);
+    }
+    printf("Success: Voltage updated!\n");
+    exit(0);
+}
+
+// resident mode: keep the bus open and serve line commands on stdin.
+//   get [chain#]                 -> chain <n>: voltage = 0x<v>, one per chain
+//   set <chain#:voltage> ...     -> same lines as batch mode
+//   quit
+// every reply ends with a line "ok" or "error <reason>"
+void agent_main() {
+    char line[128];
+    char *args[8];
+    int chains[4];
+    unsigned char voltages[4];
+    unsigned char voltage;
+    int fd, nargs, count, chain, first, last, failed;
+    fd = open_i2c();
+    pthread_mutex_lock(&iic_mutex);
+    printf("ready\n");
+    fflush(stdout);
+    while (fgets(line, sizeof(line), stdin) != NULL) {
+        nargs = 0;
+        args[nargs] = strtok(line, " \t\r\n");
+        while (args[nargs] != NULL && nargs < 7)
+            args[++nargs] = strtok(NULL, " \t\r\n");
+        if (nargs == 0)
+            continue;
+        if (strcmp(args[0], "quit") == 0)
+            break;
+        if (strcmp(args[0], "get") == 0) {
+            first = 0;
+            last = 3;
+            if (nargs > 1) {
+                chain = atoi(args[1]);
+                if (chain > 4 || chain == 0) {
+                    printf("error invalid chain #, valid range 1-4\n");
+                    fflush(stdout);
+                    continue;
+                }
+                first = last = chain - 1;
+            }
+            failed = 0;
+            for (chain = first; chain <= last; chain++) {
+                if (select_chain_cached(fd, chain) != 0) {
+                    printf("chain %i: voltage = ERROR\n", chain+1);
+                    failed++;
+                    continue;
+                }
+                if (pic_read_voltage(&voltage, fd) != 0) {
+                    printf("chain %i: voltage = ERROR\n", chain+1);
+                    failed++;
+                    continue;
+                }
+                printf("chain %i: voltage = 0x%02x\n", chain+1, voltage);
+            }
+        } else if (strcmp(args[0], "set") == 0) {
+            if ((count = parse_pairs(nargs - 1, args + 1, chains, voltages)) < 0) {
+                printf("error incorrect arguments\n");
+                fflush(stdout);
+                continue;
+            }
+            failed = set_chains(fd, count, chains, voltages);
+        } else {
+            printf("error unknown command %s\n", args[0]);
+            fflush(stdout);
+            continue;
+        }
+        if (failed)
+            printf("error %i chain(s) failed\n", failed);
+        else
+            printf("ok\n");
+        fflush(stdout);
+    }
+    pthread_mutex_unlock(&iic_mutex);
+    bus_close(fd);
+    exit(0);
 }
 
 void main (int argc, char *argv[]){
     int chain;
+    sim_init();
+    if (argc > 1 && strcmp(argv[1], "--bench") == 0) {
+      // run the command as usual and report the PIC latencies at exit
+      atexit(print_timings);
+      argv[1] = argv[0];
+      argv++;
+      argc--;
+    }
+    if (argc > 1 && strcmp(argv[1], "batch") == 0) {
+      batch_main(argc, argv);
+    }
+    if (argc == 2 && strcmp(argv[1], "agent") == 0) {
+      agent_main();
+    }
     if (argc == 1) {
       printf("Reading all voltages");   
       read_voltage_all();